@@ -4,7 +4,22 @@
 # Written by Dylan Remus
 # ----------------------------------------------------------------------------------------
 
+import argparse
+import concurrent.futures
+import functools
+import glob
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import re
 import sys
+import time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Iterable, Union
+
+__version__ = '1.2'
 
 # to save me time copying and pasting and reading the 341 notes, I put these values here to use
 instruction_base_values = {
@@ -54,24 +69,258 @@ instruction_num_params = {
     'not': 1   # one's complement - bitwise not
 }
 
+# the operands each instruction takes, in order, as (kind, shift) pairs
+# kind is one of the keys of operand_values below, shift is how far left the operand's value goes in the instruction
+instruction_operands = {
+    'ld' : (('dest', 4), ('nibble', 0)),  # ld <register> <value>
+    'mov': (('dest', 3), ('src', 0)),     # mov <register> <register or i_pins>
+    'jmp': (('nibble', 0),),              # jmp <block>
+    'jnz': (('nibble', 0),),              # jnz <block>
+    # alu instructions
+    'neg': (('x', 4),),
+    'nop': (),
+    'sub': (('x', 4), ('y', 3)),
+    'add': (('x', 4), ('y', 3)),
+    'muh': (('x', 4), ('y', 3)),
+    'mul': (('x', 4), ('y', 3)),
+    'xor': (('x', 4), ('y', 3)),
+    'and': (('x', 4), ('y', 3)),
+    'not': (('x', 4),)
+}
+
+# the operand kinds that are hex numbers instead of names, and the biggest number each one can be
+number_kinds = {
+    'nibble': 15
+}
+
+# the accepted spellings of each kind of operand and the value each one encodes to
+# nibbles not listed here (like 0f) are still accepted, they just take the slow path through int()
+operand_values = {
+    'dest'  : register_values,
+    'src'   : register_values,
+    'nibble': {f'{value:x}': value for value in range(16)},
+    'x'     : {'x0': 0, '0': 0, 'x1': 1, '1': 1},
+    'y'     : {'y0': 0, '0': 0, 'y1': 1, '1': 1}
+}
+
+# the shape of the program rom - jumps can only go to the start of a block, and space nothing is assembled into is
+# filled with FILL
+NUM_BLOCKS = 16
+BLOCK_SIZE = 16
+FILL = instruction_base_values['nop']
+
+# precomputed opcode table used by the encoder - maps each mnemonic to (base value, operands)
+instruction_table = {}
+for _mnemonic, _base in instruction_base_values.items():
+    assert len(instruction_operands[_mnemonic]) == instruction_num_params[_mnemonic]
+    instruction_table[_mnemonic] = (_base, instruction_operands[_mnemonic])
+
+class AssemblyError(Exception):
+    """
+    Raised when a line of asm can't be assembled. assemble() catches these and turns them into error diagnostics,
+    so that every bad line in a file gets reported instead of just the first one.
+    """
+    def __init__(self, code: str, message: str, token: int = 0):
+        """
+        :param code: A short name for the kind of error, e.g. 'not-a-register'. See Diagnostic for the full list.
+        :param message: A description of the error for the user.
+        :param token: Which token on the line caused the error, starting from 0 for the opcode or directive.
+        """
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.token = token
+
+@dataclass
+class Diagnostic:
+    """
+    An error or warning produced while assembling.
+    Error codes: too-few-args, not-a-register, i-pins-destination, bad-number, out-of-range, bad-alu-operand,
+    not-defined, recursive-macro, unknown-directive, unknown-instruction, bad-block-name, duplicate-block, undefined-block, rom-full,
+    include-not-found, include-cycle, block-conflict.
+    Warning codes: r-destination, o-reg-source, block-overflow, block-fallthrough, and from lint341.py, overwrite,
+    unreachable-block and uninitialized-read.
+    """
+    severity: str  # 'error' or 'warning'
+    line: int      # line number in the source, starting from 1
+    column: int    # column of the offending token, starting from 1
+    code: str
+    message: str
+    file: str = None  # the file the line is in, if it isn't the file being assembled (e.g. an included file)
+
+    def __str__(self):
+        where = f' in {self.file}' if self.file is not None else ''
+        return f'{self.severity.capitalize()}{where} on line {self.line}, column {self.column}: {self.message}'
+
+@dataclass
+class AssemblyResult:
+    """
+    The output of assemble() - the program image plus everything that went wrong while making it.
+    """
+    image: bytearray  # NUM_BLOCKS * BLOCK_SIZE bytes (256 normally), accessed with image[BLOCK_SIZE*block + addr]
+    diagnostics: list = field(default_factory=list)
+    placement: dict = field(default_factory=dict)  # the block each relocatable block (.rblock) was placed in, by name
+    bytes_saved: int = 0  # how many instructions the optimizer deleted, if it was used
+    dependencies: dict = field(default_factory=dict)  # the sha256 of every file included with .include, by path
+    line_map: dict = field(default_factory=dict)  # the (line, file) each address of the image was assembled from
+
+    @property
+    def errors(self) -> list:
+        return [d for d in self.diagnostics if d.severity == 'error']
+
+    @property
+    def warnings(self) -> list:
+        return [d for d in self.diagnostics if d.severity == 'warning']
+
+    @property
+    def ok(self) -> bool:
+        """True if the program assembled without errors. Warnings are allowed."""
+        return len(self.errors) == 0
+
+def new_state() -> dict:
+    """
+    Creates a fresh assembler state object, ready to assemble a new file.
+    """
+    return {
+        'defines':{}, # macros similar to c/c++'s #define - just text replacement though, no fancy function-like macros
+        'expansions':{},   # memoized result of fully expanding each token seen so far, cleared whenever defines changes
+        'defines_key':0,   # a hash of every .define and .undef so far, so lines can be cached by the defines they see
+        'line_cache':None, # optional, see assemble_line()
+        'current_line':0,  # the actual line in the file
+        'current_file':None, # the included file the line is in, or None for the file being assembled
+        'current_block':0,
+        'current_addr':0,
+        'line_text':'',    # the unprocessed text of the current line, used to find columns for diagnostics
+        'diagnostics':[],  # list of Diagnostic, filled in as the file is assembled
+        'sections':{},     # relocatable blocks by name, each a dict of code, fixups, line, column and file - see .rblock
+        'current_section':None, # the relocatable block being assembled, or None for code placed with .block
+        'fixups':[],       # jumps to relocatable blocks in .block code, as (address, name, line, column, file)
+        'line_map':[],     # where each instruction came from, as (location, line, file), where location is the address
+                           # for .block code or (name, offset) for relocatable code
+        'used_blocks':{},  # blocks that .block code was placed in, each mapped to the (line, file) that first used it
+                           # relocatable blocks go around these
+        'include_stack':[], # the files being read, innermost last, each a dict of path, label (the file used in
+                            # diagnostics), lines (an iterator) and line (the line number)
+        'dependencies':{}  # the sha256 of every included file, by path
+    }
+
+def _token_column(line: str, token: int) -> int:
+    """
+    Finds which column a token starts at in a line of asm.
+    :param line: The unprocessed line of asm.
+    :param token: The index of the token, starting from 0.
+    :return: The column the token starts at, starting from 1. If the line doesn't have that many tokens, returns 1.
+    """
+    if ';' in line:
+        line = line[:line.index(';')]
+    for index, match in enumerate(re.finditer(r'\S+', line)):
+        if index == token:
+            return match.start() + 1
+    return 1
+
+def warn(state: dict, code: str, message: str, token: int = 0) -> None:
+    """
+    Records a warning for the current line in the assembler state.
+    :param state: The assembler state object.
+    :param code: A short name for the kind of warning, see Diagnostic.
+    :param message: A description of the warning for the user.
+    :param token: Which token on the line the warning is about, starting from 0.
+    """
+    state['diagnostics'].append(Diagnostic('warning', state['current_line'], _token_column(state['line_text'], token), code, message,
+                                           state['current_file']))
+
+def expand_token(token: str, state: dict, index: int = 0) -> str:
+    """
+    Expands one token using the defines, following macros defined as other macros until it gets to something that isn't
+    one, e.g. with .define a b and .define b 5, a expands to 5. The result is memoized in the state.
+    :param token: The token to expand.
+    :param state: The assembler state object - to get defines.
+    :param index: Which token on the line this is, for the error.
+    :return: The expanded token, or the token itself if it isn't a macro.
+    :raises AssemblyError: If the macros go round in a circle, e.g. .define a b and .define b a.
+    """
+    defines = state['defines']
+    chain = [token]
+    value = token
+    while value in defines:
+        value = defines[value]
+        if value in chain:
+            raise AssemblyError('recursive-macro', f"Macro {token} never finishes expanding: {' -> '.join(chain + [value])}", index)
+        chain.append(value)
+
+    state['expansions'][token] = value
+    return value
+
 def preprocess(line: str, state:dict) -> list:
     """
     Processes a line to remove comments and extra spaces, executes previously declared macros,
     changes all chars to lowercase, then splits it into tokens
     :param line: The line of asm to process
     :param state: The assembler state object - to get defines
+    :raises AssemblyError: If a macro on the line is recursive.
     """
     if ';' in line:
         line = line[:line.index(';')] # remove everything to the right of the first semicolon if it exists
 
     splitline = line.lower().split()  # changes to lowercase, removes all spaces - leaves instruction and params, that's it
 
-    if len(splitline) > 0 and splitline[0][0] != '.': # don't process macros for assembler directives
-        for macro in state['defines']:
-            splitline = [(x if x != macro else state['defines'][macro]) for x in splitline] # expand macros by replacing tokens
+    # don't process macros for assembler directives, or when there aren't any
+    if len(splitline) > 0 and splitline[0][0] != '.' and len(state['defines']) > 0:
+        expansions = state['expansions']
+        try:
+            splitline = [expansions[token] for token in splitline] # one lookup per token, however many defines there are
+        except KeyError: # some token hasn't been seen since defines last changed
+            splitline = [expansions[token] if token in expansions else expand_token(token, state, index)
+                         for index, token in enumerate(splitline)]
 
     return splitline
 
+def file_hash(path: str) -> str:
+    """
+    :return: The sha256 of a file's contents as a hex string, or None if it can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def include_file(state: dict) -> None:
+    """
+    Runs an .include directive - the file it names is read next, as if it was pasted in place of the directive.
+    The file name is taken from the unprocessed line, since preprocess() changes it to lowercase, and is relative to
+    the file the directive is in. It can be in quotes.
+    :param state: The assembler state object, with line_text set to the .include line.
+    :raises AssemblyError: If the file can't be read or is already being included.
+    """
+    line = state['line_text']
+    if ';' in line:
+        line = line[:line.index(';')]
+    name = line.strip()[len('.include'):].strip().strip('"')
+
+    stack = state['include_stack']
+    including = stack[-1]['path'] if len(stack) > 0 else None
+    path = os.path.normpath(os.path.join(os.path.dirname(including) if including is not None else '', name))
+    if any(entry['path'] is not None and os.path.abspath(entry['path']) == os.path.abspath(path) for entry in stack):
+        raise AssemblyError('include-cycle', f'{path} includes itself: ' + ' -> '.join(str(entry['path']) for entry in stack) + f' -> {path}', 1)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        raise AssemblyError('include-not-found', f"Could not open included file {path}. Please ensure it exists and that you have "
+                                                 f"the necessary permissions to read it.", 1) from None
+
+    state['dependencies'][path] = hashlib.sha256(data).hexdigest()
+    stack.append({'path':path, 'label':path, 'lines':iter(data.decode(errors='replace').splitlines()), 'line':0})
+
+def is_block_name(token: str) -> bool:
+    """
+    Checks if a token can be the name of a relocatable block. Names that are also hex numbers aren't allowed,
+    otherwise jmp add could mean either block a or the block named add.
+    :param token: A preprocessed token.
+    """
+    return re.fullmatch(r'[a-z_][a-z0-9_]*', token) is not None and re.fullmatch(r'[0-9a-f]+', token) is None
+
 def parse(processed_line: list, state: dict) -> int:
     """
     Parses a preprocessed line of asm and determines if it contains a line of asm code or an assembler directive.
@@ -79,7 +328,8 @@ def parse(processed_line: list, state: dict) -> int:
     If the input is an assembler directive, executes that directive.
     :param processed_line: A line of code that has gone through preprocess().
     :param state: The assembler state object.
-    :return: A byte of machine code which corresponds to the input asm.
+    :return: A byte of machine code which corresponds to the input asm, or -1 if the line was a directive.
+    :raises AssemblyError: If the line is not valid asm.
     """
 
     # one day, separate this into two functions, one for directives and one for instructions
@@ -88,432 +338,1403 @@ def parse(processed_line: list, state: dict) -> int:
     if processed_line[0][0] == '.':
         if processed_line[0] == '.define':
             if len(processed_line) < 3:
-                print(f'Error: Not enough arguments for .define on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-                exit(1)
+                raise AssemblyError('too-few-args', f'Not enough arguments for .define: {" ".join(processed_line)}')
             state['defines'][processed_line[1]] = processed_line[2]
+            state['expansions'].clear() # this could change how any token expands
+            state['defines_key'] = hash((state['defines_key'], tuple(processed_line)))
             return -1
 
         elif processed_line[0] == '.undef':
             if len(processed_line) < 2:
-                print(f'Error: Not enough arguments for .undef on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-                exit(1)
+                raise AssemblyError('too-few-args', f'Not enough arguments for .undef: {" ".join(processed_line)}')
 
             if processed_line[1] not in state['defines']:
-                print(f'Error: Parameter 1 for .undef on line {state["current_line"]} was not previously defined: {" ".join(processed_line)}\nExiting.')
-                exit(1)
+                raise AssemblyError('not-defined', f'Parameter 1 for .undef was not previously defined: {" ".join(processed_line)}', 1)
 
             del state['defines'][processed_line[1]]
+            state['expansions'].clear()
+            state['defines_key'] = hash((state['defines_key'], tuple(processed_line)))
             return -1
 
         elif processed_line[0] == '.block':
             block = 0
             if len(processed_line) < 2:
-                print(f'Error: Not enough arguments for .block on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-                exit(1)
+                raise AssemblyError('too-few-args', f'Not enough arguments for .block: {" ".join(processed_line)}')
             try:
                 block = int(processed_line[1], 16)
             except ValueError:
-                print(f"Error: Could not convert parameter to .block to integer on line {state['current_line']}: {' '.join(processed_line)}\nExiting.")
-                exit(1)
+                raise AssemblyError('bad-number', f"Could not convert parameter to .block to integer: {' '.join(processed_line)}", 1) from None
 
-            if not (0 <= block <= 15):
-                print(f"Error: Parameter to .block out of range on line {state['current_line']}: {' '.join(processed_line)}\nValue must be between 0 and 15 inclusive.\nExiting.")
-                exit(1)
+            if not (0 <= block < NUM_BLOCKS):
+                raise AssemblyError('out-of-range', f"Parameter to .block out of range: {' '.join(processed_line)}\n"
+                                                    f"Value must be between 0 and {NUM_BLOCKS - 1} inclusive.", 1)
 
             state['current_block'] = block
             state['current_addr'] = 0
+            state['current_section'] = None
+            return -1
+
+        elif processed_line[0] == '.rblock':
+            if len(processed_line) < 2:
+                raise AssemblyError('too-few-args', f'Not enough arguments for .rblock: {" ".join(processed_line)}')
+
+            name = processed_line[1]
+            if not is_block_name(name):
+                raise AssemblyError('bad-block-name', f"Invalid name for .rblock: {' '.join(processed_line)}\n"
+                                                      f"Names must start with a letter or underscore, and can't be a hex number like add or f00.", 1)
+            if name in state['sections']:
+                first = state['sections'][name]['line']
+                raise AssemblyError('duplicate-block', f"Relocatable block {name} was already declared on line {first}", 1)
+
+            state['sections'][name] = {'code':bytearray(), 'fixups':[], 'line':state['current_line'],
+                                       'column':_token_column(state['line_text'], 1), 'file':state['current_file']}
+            state['current_section'] = name
+            return -1
+
+        elif processed_line[0] == '.include':
+            if len(processed_line) < 2:
+                raise AssemblyError('too-few-args', f'Not enough arguments for .include: {" ".join(processed_line)}')
+            include_file(state)
             return -1
 
         else:
-            print(f"Error: Unknown assembler directive on line {state['current_line']}: {processed_line[0]}\nExiting.")
-            exit(1)
+            raise AssemblyError('unknown-directive', f"Unknown assembler directive: {processed_line[0]}")
 
-    # now, the line has to either be an instruction or invalid, so parse for instructions
+    # now, the line has to either be an instruction or invalid, so encode it
+    return encode_instruction(processed_line, state)
 
-    # numeric parameters
-    p1 = 0
-    p2 = 0
+def _encode_operand(kind: str, shift: int, param_num: int, processed_line: list) -> tuple:
+    """
+    Converts a single instruction operand to the bits it contributes to the instruction.
+    :param kind: The kind of operand expected, one of the keys of operand_values.
+    :param shift: How far left the operand's value is shifted in the instruction.
+    :param param_num: Which parameter of the instruction this is, starting from 1.
+    :param processed_line: The whole preprocessed line.
+    :return: A tuple of (bits, warning), where warning is None or a (code, message, token) tuple.
+    :raises AssemblyError: If the operand is not valid for its kind.
+    """
+    mnemonic = processed_line[0]
+    token = processed_line[param_num]
+    line_text = ' '.join(processed_line)
+    values = operand_values[kind]
+
+    if token in values:
+        value = values[token]
+    elif kind in number_kinds:
+        try:
+            value = int(token, 16)
+        except ValueError:
+            raise AssemblyError('bad-number', f"Could not convert parameter {param_num} of {mnemonic} to integer: {line_text}", param_num) from None
+        if not (0 <= value <= number_kinds[kind]):
+            raise AssemblyError('out-of-range', f"Parameter {param_num} of {mnemonic} out of range: {line_text}\n"
+                                                f"Value must be between 0 and {number_kinds[kind]:X} inclusive.", param_num)
+    elif kind == 'src' and token == 'i_pins':
+        value = operand_values['dest'][processed_line[1]] # the mcu reads the input pins when the source and destination match
+    elif kind == 'dest' and token == 'i_pins':
+        raise AssemblyError('i-pins-destination', f'Destination for {mnemonic} is i_pins, i_pins can only be source: {line_text}', param_num)
+    elif kind in ('dest', 'src'):
+        raise AssemblyError('not-a-register', f'Parameter {param_num} for {mnemonic} is not a register: {line_text}', param_num)
+    else:
+        raise AssemblyError('bad-alu-operand', f"invalid value for parameter {param_num} for {mnemonic}: {line_text}\n"
+                                               f"Expected one of 0, 1, {kind}0, or {kind}1.", param_num)
 
-    # this part of the parsing would be easier and nicer if I were using a different language or if I didn't want
-    # to keep this program all in 1 file, but whatever
-    # the following code is mostly copied and pasted, the only stuff that changes is the error checking depending
-    # on the datatype of the parameters (number or register)
+    warning = None
+    if kind == 'dest' and token == 'r':
+        warning = ('r-destination', f'r used as destination to {mnemonic}. Treating like the o_reg register instead.', param_num)
+    elif kind == 'src' and token == 'o_reg':
+        warning = ('o-reg-source', f'o_reg used as source of {mnemonic}. Treating like the r register instead.', param_num)
 
-    if processed_line[0] == 'ld':
-        if len(processed_line) < instruction_num_params['ld'] + 1:
-            print(f'Error: Not enough arguments for ld on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
+    return value << shift, warning
 
-        if processed_line[1] not in register_values:
-            print(f'Error: Parameter 1 for ld on line {state["current_line"]} is not a register: {" ".join(processed_line)}\nExiting.')
-            exit(1)
+# memoized encodings - maps a tuple of (mnemonic, operands...) to a tuple of (machine code, warnings)
+# invalid instructions raise before they get here, so only valid ones are ever cached
+# only the operands the instruction takes are in the key, and it's emptied when it gets past _ENCODE_CACHE_SIZE, so
+# long-lived users like the language server don't keep every spelling ever typed (e.g. ld x0 0000f)
+_encode_cache = {}
+_ENCODE_CACHE_SIZE = 4096
 
-        if processed_line[1] == 'r':
-            print(f"Warning: r used as destination to ld on line {state['current_line']}. Treating like the o_reg register instead.\n")
+def encode_instruction(processed_line: list, state: dict) -> int:
+    """
+    Converts a preprocessed line containing an instruction to its corresponding machine code.
+    Uses instruction_table to look up the opcode and operand kinds, and caches the result so that repeated
+    instructions only get validated once.
+    :param processed_line: A line of code that has gone through preprocess(), not containing a directive.
+    :param state: The assembler state object.
+    :return: A byte of machine code which corresponds to the input asm.
+    :raises AssemblyError: If the line is not a valid instruction.
+    """
+    mnemonic = processed_line[0]
+    if mnemonic not in instruction_table:
+        raise AssemblyError('unknown-instruction', f"Unknown instruction: {mnemonic}")
 
-        p1 = register_values[processed_line[1]] << 4
+    base, operands = instruction_table[mnemonic]
+    key = tuple(processed_line[:len(operands) + 1]) # extra operands are ignored, so they aren't part of the key
+    encoded = _encode_cache.get(key)
 
-        try:
-            p2 = int(processed_line[2], 16)
-        except ValueError:
-            print(f"Error: Could not convert parameter 2 of ld to integer on line {state['current_line']}: {' '.join(processed_line)}\nExiting.")
-            exit(1)
-
-        if not (0 <= p2 <= 15):
-            print(
-                f"Error: Parameter 2 of ld out of range on line {state['current_line']}: {' '.join(processed_line)}\nValue must be between 0 and F inclusive.\nExiting.")
-            exit(1)
-
-        return instruction_base_values['ld'] | p1 | p2
-    
-    if processed_line[0] == 'mov':
-        if len(processed_line) < instruction_num_params['mov'] + 1:
-            print(f'Error: Not enough arguments for mov on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == "i_pins":
-            print(f'Error: Destination for mov on line {state["current_line"]} is i_pins, i_pins can only be source: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-        if processed_line[1] not in register_values:
-            print(f'Error: Parameter 1 for mov on line {state["current_line"]} is not a register: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'r':
-            print(f"Warning: r used as destination to mov on line {state['current_line']}. Treating like the o_reg register instead.\n")
-
-        p1 = register_values[processed_line[1]] << 3
-
-        # this if statement is ugly but I forgot about i_pins until the end so I kinda just hacked support for it in
-        if processed_line[2] == "i_pins":
-            p2 = p1
-        elif processed_line[2] not in register_values:
-            print(f'Error: Parameter 2 for mov on line {state["current_line"]} is not a register: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-        elif processed_line[2] == 'o_reg':
-            print(f"Warning: o_reg used as source of mov on line {state['current_line']}. Treating like the r register instead.\n")
-            p2 = register_values[processed_line[2]]
-        else:
-            p2 = register_values[processed_line[2]]
+    if encoded is None:
+        if len(processed_line) < len(operands) + 1:
+            raise AssemblyError('too-few-args', f'Not enough arguments for {mnemonic}: {" ".join(processed_line)}')
 
-        return instruction_base_values['mov'] | p1 | p2
-    
-    if processed_line[0] == 'jmp':
-        if len(processed_line) < instruction_num_params['jmp'] + 1:
-            print(f'Error: Not enough arguments for jmp on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
+        machine_code = base
+        warnings = []
+        for param_num, (kind, shift) in enumerate(operands, 1):
+            bits, warning = _encode_operand(kind, shift, param_num, processed_line)
+            machine_code |= bits
+            if warning is not None:
+                warnings.append(warning)
 
-        try:
-            p1 = int(processed_line[1], 16)
-        except ValueError:
-            print(f"Error: Could not convert parameter 1 of jmp to integer on line {state['current_line']}: {' '.join(processed_line)}\nExiting.")
-            exit(1)
+        if len(_encode_cache) >= _ENCODE_CACHE_SIZE:
+            _encode_cache.clear()
+        encoded = _encode_cache[key] = (machine_code, tuple(warnings))
 
-        if not (0 <= p1 <= 15):
-            print(
-                f"Error: Parameter 2 of jmp out of range on line {state['current_line']}: {' '.join(processed_line)}\nValue must be between 0 and F inclusive.\nExiting.")
-            exit(1)
+    machine_code, warnings = encoded
+    for code, message, token in warnings:
+        warn(state, code, message, token)
 
-        return instruction_base_values['jmp'] | p1
-    
-    if processed_line[0] == 'jnz':
-        if len(processed_line) < instruction_num_params['jnz'] + 1:
-            print(f'Error: Not enough arguments for jnz on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
+    return machine_code
 
-        try:
-            p1 = int(processed_line[1], 16)
-        except ValueError:
-            print(f"Error: Could not convert parameter 1 of jnz to integer on line {state['current_line']}: {' '.join(processed_line)}\nExiting.")
-            exit(1)
+def assemble_line(line: str, state: dict, blocks: bytearray) -> None:
+    """
+    Assembles one line of asm, either running the directive on it or storing its machine code in the program.
+    If the state has a line cache (a dict kept between runs, like --watch does), instructions are looked up in it by
+    their text and the defines they see, and only lines that aren't there yet are preprocessed and encoded.
+    :param line: The unprocessed line of asm.
+    :param state: The assembler state object. current_line should already point at this line.
+    :param blocks: The program being assembled, NUM_BLOCKS * BLOCK_SIZE bytes long.
+    :raises AssemblyError: If the line is not valid asm.
+    """
+    state['line_text'] = line
+
+    line_cache = state['line_cache']
+    cached = line_cache.get((line, state['defines_key'])) if line_cache is not None else None
+    if cached is not None:
+        machine_code_instr, target, warnings = cached
+        for code, message, column in warnings:
+            state['diagnostics'].append(Diagnostic('warning', state['current_line'], column, code, message, state['current_file']))
+        reference = (target, state['current_line'], _token_column(line, 1), state['current_file']) if target is not None else None
+    else:
+        # step 2: remove comments and multiple spaces
+        processed = preprocess(line, state)
+
+        # step 3: parse preprocessed line
+        if len(processed) == 0:
+            return  # empty line, so there's nothing to do
+
+        # jumps to relocatable blocks are assembled as jumps to block 0, then fixed up once the blocks have been placed
+        reference = None
+        if processed[0] in ('jmp', 'jnz') and len(processed) > 1 and is_block_name(processed[1]):
+            reference = (processed[1], state['current_line'], _token_column(line, 1), state['current_file'])
+            processed = [processed[0], '0'] + processed[2:]
+
+        diagnostics_before = len(state['diagnostics'])
+        machine_code_instr = parse(processed, state)
+        if machine_code_instr == -1: # -1 indicates the line was an assembler directive,
+            return                   # so the parse function already did the necessary work
+
+        if line_cache is not None: # directives aren't cached, since they have to run every time
+            warnings = tuple((d.code, d.message, d.column) for d in state['diagnostics'][diagnostics_before:])
+            line_cache[(line, state['defines_key'])] = (machine_code_instr, reference[0] if reference is not None else None, warnings)
+
+    # step 4: store hex code in proper location in array
+    if state['current_section'] is not None: # relocatable code just gets appended, it's placed after the whole file is read
+        section = state['sections'][state['current_section']]
+        if reference is not None:
+            section['fixups'].append((len(section['code']),) + reference)
+        state['line_map'].append(((state['current_section'], len(section['code'])), state['current_line'], state['current_file']))
+        section['code'].append(machine_code_instr)
+        return
+
+    if state['current_addr'] >= BLOCK_SIZE: # the last instruction filled the block, so this one spills into the next block
+        state['current_addr'] = 0
+        state['current_block'] = (state['current_block'] + 1) % NUM_BLOCKS
+        warn(state, 'block-overflow', f"Block {(state['current_block'] - 1) % NUM_BLOCKS} contains more than {BLOCK_SIZE} instructions, extra instructions are placed in block "
+             f"{state['current_block']}. \nMake sure that block is not in use, otherwise some instructions may be overwritten.")
+
+    block = state['current_block']
+    addr = state['current_addr']
+    blocks[block * BLOCK_SIZE + addr] = machine_code_instr
+    state['used_blocks'].setdefault(block, (state['current_line'], state['current_file']))
+    if reference is not None:
+        state['fixups'].append((block * BLOCK_SIZE + addr,) + reference)
+    state['line_map'].append((block * BLOCK_SIZE + addr, state['current_line'], state['current_file']))
+    state['current_addr'] += 1 # proceed to the next address
+
+def _free_runs(free: int) -> list:
+    """
+    Finds every run of consecutive free blocks.
+    :param free: A bit mask of the free blocks, bit n set if block n is free.
+    :return: A list of (first block, length) tuples.
+    """
+    runs = []
+    block = 0
+    while block < NUM_BLOCKS:
+        if free >> block & 1:
+            start = block
+            while block < NUM_BLOCKS and free >> block & 1:
+                block += 1
+            runs.append((start, block - start))
+        else:
+            block += 1
+    return runs
 
-        if not (0 <= p1 <= 15):
-            print(
-                f"Error: Parameter 2 of jnz out of range on line {state['current_line']}: {' '.join(processed_line)}\nValue must be between 0 and F inclusive.\nExiting.")
-            exit(1)
+def _pack(sizes: list, free: int, index: int, starts: list, failed: set) -> bool:
+    """
+    Packs relocatable blocks into the free space, trying the tightest fitting run first and backtracking when a choice
+    leaves no room for the rest. Packing a run from the front loses nothing, since the blocks inside one run can always
+    be shuffled into any order, so only the first free block of each run needs to be tried.
+    :param sizes: How many blocks each relocatable block needs, largest first.
+    :param free: A bit mask of the free blocks.
+    :param index: Which relocatable block to place next.
+    :param starts: Filled in with the first block chosen for each relocatable block.
+    :param failed: (index, free) pairs already known not to work, so the search never repeats itself.
+    :return: True if everything from index on was placed.
+    """
+    if index == len(sizes):
+        return True
+    if (index, free) in failed:
+        return False
 
-        return instruction_base_values['jnz'] | p1
+    size = sizes[index]
+    for start, length in sorted(((s, l) for s, l in _free_runs(free) if l >= size), key=lambda run: (run[1], run[0])):
+        starts[index] = start
+        if _pack(sizes, free & ~(((1 << size) - 1) << start), index + 1, starts, failed):
+            return True
 
-    if processed_line[0] == 'neg':
-        if len(processed_line) < instruction_num_params['neg'] + 1:
-            print(f'Error: Not enough arguments for neg on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
+    failed.add((index, free))
+    return False
 
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(f"Error: invalid parameter for neg on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-        return instruction_base_values['neg'] | p1
-    
-    if processed_line[0] == 'not':
-        if len(processed_line) < instruction_num_params['not'] + 1:
-            print(f'Error: Not enough arguments for not on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(f"Error: invalid parameter for not on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-        return instruction_base_values['not'] | p1
-    
-    if processed_line[0] == 'sub':
-        if len(processed_line) < instruction_num_params['sub'] + 1:
-            print(f'Error: Not enough arguments for sub on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(f"Error: invalid value for parameter 1 for sub on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-            
-        if processed_line[2] == 'y0' or processed_line[2] == '0':
-            p1 = 0
-        elif processed_line[2] == 'y1' or processed_line[2] == '1':
-            p1 = 1 << 3
-        else:
-            print(f"Error: invalid value for parameter 2 for sub on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, y0, or y1. Exiting.")
-            exit(1)
-            
-        return instruction_base_values['sub'] | p1 | p2
-
-    if processed_line[0] == 'add':
-        if len(processed_line) < instruction_num_params['add'] + 1:
-            print(
-                f'Error: Not enough arguments for add on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(
-                f"Error: invalid value for parameter 1 for add on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-
-        if processed_line[2] == 'y0' or processed_line[2] == '0':
-            p1 = 0
-        elif processed_line[2] == 'y1' or processed_line[2] == '1':
-            p1 = 1 << 3
-        else:
-            print(
-                f"Error: invalid value for parameter 2 for add on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, y0, or y1. Exiting.")
-            exit(1)
-
-        return instruction_base_values['add'] | p1 | p2
-
-    if processed_line[0] == 'muh':
-        if len(processed_line) < instruction_num_params['muh'] + 1:
-            print(
-                f'Error: Not enough arguments for muh on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(
-                f"Error: invalid value for parameter 1 for muh on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-
-        if processed_line[2] == 'y0' or processed_line[2] == '0':
-            p1 = 0
-        elif processed_line[2] == 'y1' or processed_line[2] == '1':
-            p1 = 1 << 3
-        else:
-            print(
-                f"Error: invalid value for parameter 2 for muh on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, y0, or y1. Exiting.")
-            exit(1)
-
-        return instruction_base_values['muh'] | p1 | p2
-
-    if processed_line[0] == 'mul':
-        if len(processed_line) < instruction_num_params['mul'] + 1:
-            print(
-                f'Error: Not enough arguments for mul on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(
-                f"Error: invalid value for parameter 1 for mul on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-
-        if processed_line[2] == 'y0' or processed_line[2] == '0':
-            p1 = 0
-        elif processed_line[2] == 'y1' or processed_line[2] == '1':
-            p1 = 1 << 3
-        else:
-            print(
-                f"Error: invalid value for parameter 2 for mul on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, y0, or y1. Exiting.")
-            exit(1)
-
-        return instruction_base_values['mul'] | p1 | p2
-
-    if processed_line[0] == 'xor':
-        if len(processed_line) < instruction_num_params['xor'] + 1:
-            print(
-                f'Error: Not enough arguments for xor on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(
-                f"Error: invalid value for parameter 1 for xor on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-
-        if processed_line[2] == 'y0' or processed_line[2] == '0':
-            p1 = 0
-        elif processed_line[2] == 'y1' or processed_line[2] == '1':
-            p1 = 1 << 3
-        else:
-            print(
-                f"Error: invalid value for parameter 2 for xor on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, y0, or y1. Exiting.")
-            exit(1)
-
-        return instruction_base_values['xor'] | p1 | p2
-
-    if processed_line[0] == 'and':
-        if len(processed_line) < instruction_num_params['and'] + 1:
-            print(
-                f'Error: Not enough arguments for and on line {state["current_line"]}: {" ".join(processed_line)}\nExiting.')
-            exit(1)
-
-        if processed_line[1] == 'x0' or processed_line[1] == '0':
-            p1 = 0
-        elif processed_line[1] == 'x1' or processed_line[1] == '1':
-            p1 = 1 << 4
-        else:
-            print(
-                f"Error: invalid value for parameter 1 for and on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, x0, or x1. Exiting.")
-            exit(1)
-
-        if processed_line[2] == 'y0' or processed_line[2] == '0':
-            p1 = 0
-        elif processed_line[2] == 'y1' or processed_line[2] == '1':
-            p1 = 1 << 3
-        else:
-            print(
-                f"Error: invalid value for parameter 2 for and on {state['current_line']}: {' '.join(processed_line)}\nExpected one of 0, 1, y0, or y1. Exiting.")
-            exit(1)
+def place_sections(state: dict, blocks: bytearray) -> dict:
+    """
+    Places every relocatable block (.rblock) in the blocks not used by .block code, then fixes up the jumps to them.
+    Relocatable blocks longer than a block take up several consecutive blocks. Execution starts at block 0,
+    so if no .block code is in block 0, the first relocatable block in the file is always placed there.
+    Errors are added to the state's diagnostics instead of being raised, since they don't belong to any one line.
+    :param state: The assembler state object, after every line has been assembled.
+    :param blocks: The program being assembled, NUM_BLOCKS * BLOCK_SIZE bytes long.
+    :return: The block each relocatable block was placed in, by name. Empty if they didn't fit.
+    """
+    sections = state['sections']
+    diagnostics = state['diagnostics']
+    free = (1 << NUM_BLOCKS) - 1
+    for block in state['used_blocks']:
+        free &= ~(1 << block)
+
+    sizes = {name: max(1, -(-len(section['code']) // BLOCK_SIZE)) for name, section in sections.items()} # round up, and empty ones still need a block to jump to
+    order = sorted(sections, key=lambda name: -sizes[name]) # biggest first, the small ones fill in the gaps
+    pinned = None
+    if len(sections) > 0 and free & 1:
+        pinned = next(iter(sections)) # the entry point
+        order.remove(pinned)
+
+    starts = [0] * len(order)
+    free_count = bin(free).count('1')
+    fits = sum(sizes.values()) <= free_count
+    if fits and pinned is not None:
+        pinned_mask = (1 << sizes[pinned]) - 1
+        fits = free & pinned_mask == pinned_mask
+        free &= ~pinned_mask
+    if fits:
+        fits = _pack([sizes[name] for name in order], free, 0, starts, set())
+
+    if not fits:
+        largest = max(sections, key=lambda name: sizes[name])
+        needed = ', '.join(f'{name} needs {sizes[name]}' for name in sections)
+        message = (f"The relocatable blocks don't fit in the {free_count} blocks not used by .block code ({needed}). "
+                   f"\nShorten the code, or move .block code out of the way so there are longer runs of free blocks.")
+        if pinned is not None:
+            message += f"\n{pinned} is the first relocatable block in the file, so it has to go in block 0."
+        diagnostics.append(Diagnostic('error', sections[largest]['line'], sections[largest]['column'], 'rom-full', message,
+                                      sections[largest]['file']))
+        return {}
+
+    placement = {}
+    if pinned is not None:
+        placement[pinned] = 0
+    placement.update(zip(order, starts))
+
+    def resolve(name, line, column, file):
+        if name not in placement:
+            diagnostics.append(Diagnostic('error', line, column, 'undefined-block', f'No relocatable block named {name}, declare it with .rblock {name}', file))
+            return 0
+        return placement[name]
+
+    for address, *reference in state['fixups']:
+        blocks[address] |= resolve(*reference)
+
+    for name, section in sections.items():
+        code = bytearray(section['code'])
+        for offset, *reference in section['fixups']:
+            code[offset] |= resolve(*reference)
+        start = placement[name] * BLOCK_SIZE
+        blocks[start:start + len(code)] = code
+
+        jmp, ((jump_kind, _),) = instruction_table['jmp']
+        if len(code) == 0 or code[-1] & ~number_kinds[jump_kind] != jmp:
+            diagnostics.append(Diagnostic('warning', section['line'], section['column'], 'block-fallthrough',
+                                          f"Relocatable block {name} doesn't end in a jmp, so execution carries on into "
+                                          f"whatever was placed after it (block {(placement[name] + sizes[name]) % NUM_BLOCKS}).",
+                                          section['file']))
+
+    return placement
+
+def assemble_object(source: Union[str, Iterable[str]], optimize: bool = False, filename: str = None, line_cache: dict = None) -> dict:
+    """
+    Assembles a program, or one module of a bigger program, without placing its relocatable blocks or fixing up the
+    jumps to them, so it can be linked with other modules by link().
+    :param source: The program, either as one string or as an iterable of lines (like an open file).
+    :param optimize: If True, run the peephole optimizer in opt341.py.
+    :param filename: The file the source came from, so .include can find files next to it. If None, included files
+                     are looked for in the current directory.
+    :param line_cache: A dict to cache encoded lines in, or None. Pass the same one each time the same program is
+                       assembled and only the lines that changed get encoded again.
+    :return: An object - a dict of name, blocks (the code placed with .block, as a dict mapping each block used to a dict
+             of its BLOCK_SIZE bytes of code and the line and file that first used it), sections and fixups (like the assembler
+             state's), line_map (also like the state's), diagnostics, bytes_saved, and dependencies (the sha256 of every
+             included file).
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
 
-        return instruction_base_values['and'] | p1 | p2
+    # code is stored in one of 16 blocks, each 16 bytes long, for 256 instructions total
+    # jump instuctions can only jump to the beginning of a block,
+    # so file can only have up to 16 labels to jump to, less if there are more than
+    # 16 instructions between two labels
+    # (an ISA description file can change the number and size of the blocks, see load_isa())
+
+    blocks = bytearray([FILL] * NUM_BLOCKS * BLOCK_SIZE) # fill with nop instructions by default
+                                                         # one dimension - BLOCK_SIZE bytes per block, NUM_BLOCKS blocks
+                                                         # access with blocks[BLOCK_SIZE*block + addr]
+
+    state = new_state()
+    state['line_cache'] = line_cache
+    stack = state['include_stack']
+    stack.append({'path':filename, 'label':None, 'lines':iter(source), 'line':0})
+
+    # step 1: get next line, from whichever file is being read
+    while len(stack) > 0:
+        current = stack[-1]
+        line = next(current['lines'], None)
+        if line is None: # end of the file, so go back to the one that included it
+            stack.pop()
+            continue
+
+        current['line'] += 1
+        state['current_line'] = current['line']
+        state['current_file'] = current['label']
+        try:
+            assemble_line(line, state, blocks)
+        except AssemblyError as e:
+            state['diagnostics'].append(Diagnostic('error', state['current_line'], _token_column(line, e.token), e.code, e.message,
+                                                   state['current_file']))
+        # repeat until end of file
+
+    bytes_saved = 0
+    if optimize and not any(d.severity == 'error' for d in state['diagnostics']):
+        import opt341 # only loaded when it's used
+        bytes_saved = sum(opt341.optimize(state, blocks).values())
+
+    return {
+        'name':filename if filename is not None else '<source>',
+        'blocks':{block: {'code':bytes(blocks[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE]), 'line':line, 'file':file}
+                  for block, (line, file) in sorted(state['used_blocks'].items())},
+        'sections':state['sections'],
+        'fixups':state['fixups'],
+        'line_map':state['line_map'],
+        'diagnostics':state['diagnostics'],
+        'bytes_saved':bytes_saved,
+        'dependencies':state['dependencies']
+    }
 
-    if processed_line[0] == 'nop':
-        return instruction_base_values['nop']
+def link(objects: list) -> AssemblyResult:
+    """
+    Links objects from assemble_object() into one program: the .block code from each one is put in its block, then
+    the relocatable blocks from all of them are placed together and the jumps between them are fixed up, so any object
+    can jump to a relocatable block from any other one. The first relocatable block of the first object is the one
+    that goes in block 0.
+    :param objects: The objects to link, in order.
+    :return: The linked program, with every diagnostic from the objects plus the ones from linking. When there's more
+             than one object, diagnostics from each object's own file are labelled with its name.
+    """
+    blocks = bytearray([FILL] * NUM_BLOCKS * BLOCK_SIZE)
+    state = new_state()
+    bytes_saved = 0
+
+    for obj in objects:
+        def label(file):
+            return obj['name'] if file is None and len(objects) > 1 else file
+
+        state['diagnostics'] += [replace(d, file=label(d.file)) for d in obj['diagnostics']]
+        bytes_saved += obj['bytes_saved']
+        state['dependencies'].update(obj['dependencies'])
+
+        for block, used in obj['blocks'].items():
+            if block in state['used_blocks']:
+                first_line, first_file = state['used_blocks'][block]
+                state['diagnostics'].append(Diagnostic('error', used['line'], 1, 'block-conflict',
+                                                       f"Block {block:x} is already used by line {first_line} of {first_file}", label(used['file'])))
+                continue
+            state['used_blocks'][block] = (used['line'], label(used['file']))
+            blocks[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] = used['code']
+
+        for name, section in obj['sections'].items():
+            if name in state['sections']:
+                first = state['sections'][name]
+                state['diagnostics'].append(Diagnostic('error', section['line'], section['column'], 'duplicate-block',
+                                                       f"Relocatable block {name} was already declared on line {first['line']} of {first['file']}",
+                                                       label(section['file'])))
+                continue
+            state['sections'][name] = {**section, 'file':label(section['file']),
+                                       'fixups':[(offset, *reference[:-1], label(reference[-1])) for offset, *reference in section['fixups']]}
+
+        state['fixups'] += [(address, *reference[:-1], label(reference[-1])) for address, *reference in obj['fixups']]
+        state['line_map'] += [(location, line, label(file)) for location, line, file in obj['line_map']]
+
+    placement = place_sections(state, blocks)
+
+    line_map = {}
+    for location, line, file in state['line_map']:
+        if isinstance(location, tuple): # relocatable code, so it's wherever its block ended up
+            name, offset = location
+            if name not in placement:
+                continue
+            location = placement[name] * BLOCK_SIZE + offset
+        line_map[location] = (line, file) # later code overwrites earlier code, same as in the image
+    state['diagnostics'].sort(key=lambda d: (d.file is not None, d.file or '', d.line)) # placement errors come last otherwise
+
+    return AssemblyResult(blocks, state['diagnostics'], placement, bytes_saved, state['dependencies'], line_map)
+
+def assemble(source: Union[str, Iterable[str]], optimize: bool = False, filename: str = None, line_cache: dict = None) -> AssemblyResult:
+    """
+    Assembles a whole program without printing anything or exiting, so it can be used as a library.
+    Every line is assembled even after an error, so all errors in the program are reported at once.
+    :param source: The program, either as one string or as an iterable of lines (like an open file).
+    :param optimize: If True, run the peephole optimizer in opt341.py before placing relocatable blocks.
+    :param filename: The file the source came from, so .include can find files next to it.
+    :param line_cache: A dict to cache encoded lines in between calls, see assemble_object().
+    :return: The assembled program and all errors and warnings found while assembling it.
+             If there were any errors, the image is incomplete and should not be used.
+    """
+    return link([assemble_object(source, optimize, filename, line_cache)])
 
-    print(f"Error: Unknown instruction on line {state['current_line']}: {processed_line[0]}\nExiting.")
-    exit(1)
+def _hex_record(record_type: int, address: int, data: bytes) -> str:
+    """
+    Makes one Intel HEX record, with the checksum chosen so that every byte in the record adds up to 0.
+    See https://en.wikipedia.org/wiki/Intel_HEX#Checksum_calculation
+    """
+    checksum = -(len(data) + (address >> 8) + (address & 0xFF) + record_type + sum(data)) & 0xFF
+    return f':{len(data):02x}{address:04x}{record_type:02x}{data.hex()}{checksum:02x}\n'
 
-def write_hex_file(blocks: bytearray, filename: str) -> None:
+def format_hex(image: bytes, record_length: int = 16) -> bytes:
     """
-    Writes a .hex file containing the given data. Currently only supports files up to 256 bytes long, and breaks for anything longer.
-    :param blocks: A byte array up to 256 bytes long.
-    :param filename: The file to write to.
+    Makes an Intel HEX file of a program, which is what Quartus reads to initialise the ROM.
+    Programs bigger than 64 KiB get extended linear address records, so this works for any size of ROM.
+    :param image: The program.
+    :param record_length: How many bytes go in each record, up to 255. Older versions wrote 1.
+    :return: The contents of the file.
     """
     # the intel .hex format is actually really simple for small stuff like this, it's just a super simple text file,
     # the format is well documented, and it's compatible with quartus, so it's perfect for something like this
     # for more info, see https://en.wikipedia.org/wiki/Intel_HEX or https://www.keil.com/support/docs/1584/
     # or just google "intel .hex format", there's tons of info out there
+    records = []
+    addr = 0
+    while addr < len(image):
+        if addr & 0xFFFF == 0 and addr > 0: # records only have 16 bit addresses, so say where the next 64k starts
+            records.append(_hex_record(0x04, 0, (addr >> 16).to_bytes(2, 'big')))
+        end = min(addr + record_length, len(image), (addr | 0xFFFF) + 1) # a record can't cross into the next 64k
+        records.append(_hex_record(0x00, addr & 0xFFFF, image[addr:end]))
+        addr = end
+
+    records.append(':00000001FF') # end of file marker
+    return ''.join(records).encode()
+
+def format_mif(image: bytes) -> bytes:
+    """
+    Makes a Quartus Memory Initialization File of a program. Runs of the same byte, like the nops filling unused space,
+    are written as one range.
+    :param image: The program.
+    :return: The contents of the file.
+    """
+    lines = [f'WIDTH=8;\nDEPTH={len(image)};\n\nADDRESS_RADIX=HEX;\nDATA_RADIX=HEX;\n\nCONTENT BEGIN\n']
+    addr = 0
+    while addr < len(image):
+        end = addr + 1
+        while end < len(image) and image[end] == image[addr]:
+            end += 1
+        if end - addr == 1:
+            lines.append(f'\t{addr:03x} : {image[addr]:02x};\n')
+        else:
+            lines.append(f'\t[{addr:03x}..{end - 1:03x}] : {image[addr]:02x};\n')
+        addr = end
+    lines.append('END;\n')
+    return ''.join(lines).encode()
+
+def format_memh(image: bytes) -> bytes:
+    """
+    Makes a file for Verilog's $readmemh of a program, one block per line, e.g. for simulating the mcu's ROM.
+    :param image: The program.
+    :return: The contents of the file.
+    """
+    return ''.join(f'// block {block:x}\n' + image[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE].hex(' ') + '\n'
+                   for block in range(-(-len(image) // BLOCK_SIZE))).encode()
+
+def format_bin(image: bytes) -> bytes:
+    """
+    :return: The program as raw bytes.
+    """
+    return bytes(image)
+
+# every format programs can be written in - maps each name to (file extension, function that makes the file's contents)
+# when no format is given, it's picked by the output file's extension, and the first format with that extension wins
+output_formats = {
+    'hex':   ('.hex', format_hex),
+    'hex32': ('.hex', functools.partial(format_hex, record_length=32)),
+    'hex1':  ('.hex', functools.partial(format_hex, record_length=1)), # one byte per record, like older versions
+    'mif':   ('.mif', format_mif),
+    'memh':  ('.memh', format_memh),
+    'bin':   ('.bin', format_bin)
+}
+
+def output_format_for(filename: str, output_format: str = None) -> str:
+    """
+    :return: The output format to use for a file - output_format if it's given, otherwise the format for the file's
+             extension, or hex if it doesn't have one of theirs.
+    """
+    if output_format is not None:
+        return output_format
+    extension = os.path.splitext(filename)[1].lower()
+    return next((name for name, (format_extension, _) in output_formats.items() if format_extension == extension), 'hex')
+
+def write_output_file(image: bytes, filename: str, output_format: str = None) -> None:
+    """
+    Writes a program to a file. The whole file is made in memory and written at once.
+    :param image: The program.
+    :param filename: The file to write to.
+    :param output_format: One of the names in output_formats, or None to pick one by the file's extension.
+    :raises OSError: If the file can't be written.
+    """
+    data = output_formats[output_format_for(filename, output_format)][1](image)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def write_hex_file(blocks: bytearray, filename: str, record_length: int = 16) -> None:
+    """
+    Writes a .hex file containing the given data.
+    :param blocks: The program, any length.
+    :param filename: The file to write to.
+    :param record_length: How many bytes go in each record.
+    :raises OSError: If the file can't be written.
+    """
+    with open(filename, 'wb') as f:
+        f.write(format_hex(blocks, record_length))
+
+def read_hex_file(filename: str, size: int = None) -> bytearray:
+    """
+    Reads a .hex file back into a program, checking every record's checksum. Handles any record length, plus the
+    extended address records, so it can read files from other tools too, not just write_hex_file().
+    :param filename: The file to read.
+    :param size: How many bytes long the program is, by default the size of the rom. Addresses not in the file are
+                 filled with nop instructions.
+    :return: The program, size bytes long.
+    :raises OSError: If the file can't be read.
+    :raises ValueError: If the file isn't a valid .hex file or has data past the end of the program.
+    """
+    if size is None:
+        size = NUM_BLOCKS * BLOCK_SIZE
+    blocks = bytearray([FILL] * size)
+    base = 0 # set by extended address records
+
+    with open(filename, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if line[0] != ':':
+                raise ValueError(f'Line {line_num} of {filename} does not start with a colon: {line}')
+            try:
+                record = bytes.fromhex(line[1:])
+            except ValueError:
+                raise ValueError(f'Line {line_num} of {filename} is not valid hex: {line}') from None
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError(f'Line {line_num} of {filename} has the wrong length for its byte count: {line}')
+            if sum(record) & 0xFF != 0: # the checksum is chosen so that every byte in the record adds up to 0
+                raise ValueError(f'Line {line_num} of {filename} has a bad checksum: {line}')
+
+            addr = (record[1] << 8) | record[2]
+            record_type = record[3]
+            data = record[4:-1]
+            if record_type == 0x00: # data
+                start = base + addr
+                if start + len(data) > size:
+                    raise ValueError(f'Line {line_num} of {filename} has data past the end of the {size} byte program: {line}')
+                blocks[start:start + len(data)] = data
+            elif record_type == 0x01: # end of file
+                break
+            elif record_type in (0x02, 0x04) and len(data) != 2:
+                raise ValueError(f'Line {line_num} of {filename} has an extended address record without a 2 byte address: {line}')
+            elif record_type == 0x02: # extended segment address
+                base = ((data[0] << 8) | data[1]) << 4
+            elif record_type == 0x04: # extended linear address
+                base = ((data[0] << 8) | data[1]) << 16
+            # types 3 and 5 are start addresses, which don't mean anything for this mcu
+
+    return blocks
+
+# the build cache keeps assembled programs on disk, keyed by a hash of the source and everything that affects how it's
+# encoded, so files that haven't changed since the last run don't need to be assembled again
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'asm341')
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024  # bytes - the least recently used entries are deleted past this
+
+def cache_key(source: bytes, optimize: bool = False, filename: str = None) -> str:
+    """
+    Works out the build cache key for a program. Any change to the source, the assembler version, the encoding tables
+    or the options changes the key, so stale entries are never used. Changes to included files don't change the key,
+    they're checked when the entry is loaded instead.
+    :param source: The contents of the asm file.
+    :param optimize: Whether the optimizer is used.
+    :param filename: The asm file, since .include looks for files in the same directory.
+    :return: The key, as a hex string.
+    """
+    h = hashlib.sha256()
+    h.update(__version__.encode())
+    h.update(b'-O' if optimize else b'')
+    h.update(os.path.dirname(os.path.abspath(filename)).encode() if filename is not None else b'')
+    h.update(repr(sorted(instruction_base_values.items())).encode())
+    h.update(repr(sorted((kind, sorted(values.items())) for kind, values in operand_values.items())).encode())
+    h.update(repr(sorted(instruction_operands.items())).encode())
+    h.update(repr((sorted(number_kinds.items()), NUM_BLOCKS, BLOCK_SIZE, FILL)).encode())
+    h.update(b'\0')
+    h.update(source)
+    return h.hexdigest()
+
+def load_cached(cache_dir: str, key: str):
+    """
+    Looks up an assembled program in the build cache.
+    :param cache_dir: The directory the cache is kept in.
+    :param key: The key from cache_key().
+    :return: The AssemblyResult stored for the key, or None if it's not in the cache or a file it includes has changed.
+    """
+    path = os.path.join(cache_dir, key + '.json')
     try:
-        with open(filename, 'w') as f:
-            for addr, inst in enumerate(blocks):
-                addrhex = hex(addr)[2:].zfill(4)
-                insthex = hex(inst)[2:].zfill(2)
+        with open(path, 'r') as f:
+            entry = json.load(f)
+        os.utime(path) # mark the entry as recently used, eviction goes by modification time
+    except (IOError, ValueError):
+        return None # missing or unreadable, either way it's a miss
 
-                f.write(":")             # start code
-                f.write('01')            # number of bytes in data
-                f.write(addrhex)         # address
-                f.write('00')            # data type of record - for this file it's always numeric data
-                f.write(insthex)         # data
-                checksum = (~(1 + addr + inst) + 1) & 0xFF
-                f.write(hex(checksum)[2:].zfill(2) + '\n') # checksum - see https://en.wikipedia.org/wiki/Intel_HEX#Checksum_calculation
+    dependencies = entry.get('dependencies', {})
+    if any(file_hash(path) != digest for path, digest in dependencies.items()):
+        return None
 
-            f.write(':00000001FF')       # end of file marker
+    return AssemblyResult(bytearray.fromhex(entry['image']), [Diagnostic(**d) for d in entry['diagnostics']], entry.get('placement', {}),
+                          entry.get('bytes_saved', 0), dependencies)
 
+def store_cached(cache_dir: str, key: str, result: AssemblyResult, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+    """
+    Adds an assembled program to the build cache, then deletes the least recently used entries until the cache
+    fits in max_size bytes. Failing to write the cache isn't an error, the program just gets assembled next time.
+    :param cache_dir: The directory the cache is kept in.
+    :param key: The key from cache_key().
+    :param result: The program to store. Only programs without errors should be stored.
+    :param max_size: The most bytes the cache is allowed to take up.
+    """
+    entry = {'image': result.image.hex(), 'diagnostics': [asdict(d) for d in result.diagnostics], 'placement': result.placement,
+             'bytes_saved': result.bytes_saved, 'dependencies': result.dependencies}
+    path = os.path.join(cache_dir, key + '.json')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that other processes never see half an entry
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, path)
+
+        entries = []
+        total_size = 0
+        for e in os.scandir(cache_dir):
+            if e.name.endswith('.json'):
+                stat = e.stat()
+                entries.append((stat.st_mtime, stat.st_size, e.path))
+                total_size += stat.st_size
+
+        entries.sort() # oldest first
+        for _, size, old_path in entries:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(old_path)
+            except IOError:
+                pass # another process probably got to it first
+            total_size -= size
     except IOError:
-        print(f"Could not open {filename} for writing. Make sure you have write permissions.")
-        exit(1)
+        pass
 
-def main():
+# an ISA description file describes a variant of the instruction set, e.g. one with its opcodes moved around for an
+# exam, as json - Examples/cme341_isa.json describes the standard one, the same as the tables at the top of this file
 
-    if len(sys.argv) < 2:
-        print("Not enough arguments.\nSyntax: python asm341.py <infile> or python asm341.py <infile> <outfile>")
-        return 1
+def compile_isa(description: dict) -> dict:
+    """
+    Checks an ISA description and works out the assembler's tables from it.
+    The description has the number of blocks and instructions per block, the instruction unused space is filled with,
+    the operand kinds (each either a dict of names to values, or the biggest hex number it can be), and for each
+    instruction, its operand kinds and its encoding as a pattern of 8 bits - 0s and 1s for fixed bits and a letter for
+    the bits of each operand, in the same order as the operands, e.g. 10dddsss for mov <dest> <src>.
+    :param description: The ISA description, as read from the json file.
+    :return: A dict of the tables: instruction_base_values, instruction_operands, number_kinds, operand_values,
+             num_blocks, block_size and fill.
+    :raises ValueError: If the description doesn't make sense.
+    """
+    try:
+        num_blocks = int(description.get('blocks', 16))
+        block_size = int(description.get('block_size', 16))
+        kinds = dict(description['operands'])
+        instructions = dict(description['instructions'])
+        fill = description.get('fill', 'nop')
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError('An ISA description needs operands and instructions, and blocks and block_size must be numbers') from None
+
+    number_kinds_, operand_values_ = {}, {}
+    for kind, values in kinds.items():
+        if isinstance(values, int):
+            number_kinds_[kind] = values
+            operand_values_[kind] = {f'{value:x}': value for value in range(values + 1)}
+        elif isinstance(values, dict) and all(isinstance(value, int) for value in values.values()):
+            operand_values_[kind] = {name.lower(): value for name, value in values.items()}
+        else:
+            raise ValueError(f'Operand kind {kind} must be a number or a dict of names to numbers')
+
+    base_values, operands_ = {}, {}
+    for mnemonic, entry in instructions.items():
+        pattern = str(entry.get('encoding', '')).replace(' ', '').replace('_', '')
+        kinds_used = list(entry.get('operands', []))
+        if re.fullmatch(r'[01a-z]{8}', pattern) is None:
+            raise ValueError(f"The encoding of {mnemonic} must be 8 bits, each 0, 1 or a letter for an operand, not {entry.get('encoding')}")
+        letters = list(dict.fromkeys(c for c in pattern if c.isalpha()))
+        if len(letters) != len(kinds_used):
+            raise ValueError(f'{mnemonic} has {len(kinds_used)} operands, but its encoding has {len(letters)}')
+
+        operands = []
+        for letter, kind in zip(letters, kinds_used):
+            if kind not in operand_values_:
+                raise ValueError(f'{mnemonic} uses operand kind {kind}, which is not defined')
+            first, last = pattern.index(letter), pattern.rindex(letter)
+            if pattern[first:last + 1] != letter * (last - first + 1):
+                raise ValueError(f'The bits of operand {letter} of {mnemonic} must be next to each other')
+            if max(operand_values_[kind].values(), default=0) >= 1 << (last - first + 1):
+                raise ValueError(f'Operand {letter} of {mnemonic} is {last - first + 1} bits, too small for every {kind}')
+            operands.append((kind, 7 - last))
+
+        base_values[mnemonic.lower()] = int(re.sub('[a-z]', '0', pattern), 2)
+        operands_[mnemonic.lower()] = tuple(operands)
+
+    # relocatable blocks are placed by putting the block number in the low bits of jmp and jnz
+    for mnemonic in ('jmp', 'jnz'):
+        jump = operands_.get(mnemonic)
+        if jump is None or len(jump) != 1 or jump[0][1] != 0 or jump[0][0] not in number_kinds_:
+            raise ValueError(f'{mnemonic} must take one number, in the lowest bits of its encoding')
+        if number_kinds_[jump[0][0]] < num_blocks - 1:
+            raise ValueError(f'{mnemonic} can only jump to {number_kinds_[jump[0][0]] + 1} blocks, but there are {num_blocks}')
+
+    if isinstance(fill, str):
+        if len(operands_.get(fill, (None,))) != 0:
+            raise ValueError(f'fill must be a number or an instruction without operands, not {fill}')
+        fill = base_values[fill]
+
+    return {
+        'instruction_base_values': base_values,
+        'instruction_operands': operands_,
+        'number_kinds': number_kinds_,
+        'operand_values': operand_values_,
+        'num_blocks': num_blocks,
+        'block_size': block_size,
+        'fill': fill
+    }
 
-    infilename = sys.argv[1]
-    if len(sys.argv) == 2:
-        outfilename = "out.hex"
-    else:
-        outfilename = sys.argv[2]
+def _build_encoder_decoder() -> tuple:
+    """
+    Encodes every way of writing every instruction, which fills in the encoder's cache, and picks the clearest way of
+    writing each byte from the same run, so decoding can never disagree with the encoder.
+    Where several spellings give the same byte (like mov x0 x0 and mov x0 i_pins), the clearest one is kept.
+    :return: A tuple of (every encoding, as stored in _encode_cache, and the decode table - a list of 256 strings
+             indexed by byte, None for bytes the assembler can't produce).
+    """
+    spellings = {}
+    for kind, values in operand_values.items():
+        spellings[kind] = sorted(values, key=lambda token: token.isdigit()) # prefer x0 over 0
+    if 'src' in spellings:
+        spellings['src'] = ['i_pins'] + spellings['src'] # mov x0 i_pins says what it does, mov x0 x0 doesn't
+
+    table = [None] * 256
+    for mnemonic, (base, operands) in instruction_table.items():
+        for tokens in itertools.product(*(spellings[kind] for kind, _ in operands)):
+            line = [mnemonic, *tokens]
+            state = new_state()
+            try:
+                machine_code = encode_instruction(line, state)
+            except AssemblyError:
+                continue # e.g. mov x0 i_pins when x0 isn't the destination
+            if len(state['diagnostics']) == 0 and table[machine_code] is None: # skip spellings like ld r that warn
+                table[machine_code] = ' '.join(line)
+    return dict(_encode_cache), table
 
-    # code is stored in one of 16 blocks, each 16 bytes long, for 256 instructions total
-    # jump instuctions can only jump to the beginning of a block,
-    # so file can only have up to 16 labels to jump to, less if there are more than
-    # 16 instructions between two labels
+_decode_table = None
 
-    blocks = bytearray(b'\xc8'*16*16) # fill with nop instructions by default
-                                      # one dimension - 16 bytes per block, 16 blocks
-                                      # access with blocks[16*block + addr]
-                                      # values that are not set are filled with 0 for now, might change to a nop when done
+def decode_table() -> list:
+    """
+    :return: The asm for every byte, as a list of 256 strings indexed by byte. Bytes the assembler can't produce are None.
+             Worked out the first time it's needed.
+    """
+    global _decode_table
+    if _decode_table is None:
+        _, _decode_table = _build_encoder_decoder()
+    return _decode_table
 
-    assembler_state = {
-        'defines':{}, # macros similar to c/c++'s #define - just text replacement though, no fancy function-like macros
-        'current_line':0,  # the actual line in the file
-        'current_block':0,
-        'current_addr':0
+def install_isa(tables: dict) -> None:
+    """
+    Makes the assembler use the tables from compile_isa(). The tables are changed in place, so other modules that
+    use them see the change too. If the tables include the encodings and decode table from _build_encoder_decoder(),
+    they're used as they are, otherwise they're filled in as they're needed.
+    """
+    global NUM_BLOCKS, BLOCK_SIZE, FILL, _decode_table
+    operands = {mnemonic: tuple(tuple(operand) for operand in ops) for mnemonic, ops in tables['instruction_operands'].items()}
+    new_tables = [
+        (instruction_base_values, dict(tables['instruction_base_values'])),
+        (instruction_operands, operands),
+        (instruction_num_params, {mnemonic: len(ops) for mnemonic, ops in operands.items()}),
+        (instruction_table, {mnemonic: (base, operands[mnemonic]) for mnemonic, base in tables['instruction_base_values'].items()}),
+        (number_kinds, dict(tables['number_kinds'])),
+        (operand_values, dict(tables['operand_values'])),
+        (register_values, dict(tables['operand_values'].get('dest', {})))
+    ]
+    for table, values in new_tables:
+        table.clear()
+        table.update(values)
+
+    NUM_BLOCKS, BLOCK_SIZE, FILL = tables['num_blocks'], tables['block_size'], tables['fill']
+    _encode_cache.clear()
+    _encode_cache.update(tables.get('encodings', {}))
+    _decode_table = tables.get('decode_table')
+
+def load_isa(filename: str, cache_dir: str = DEFAULT_CACHE_DIR) -> None:
+    """
+    Loads an ISA description file and makes the assembler use it. The description is compiled into the encoder's
+    tables, every instruction is encoded ahead of time and a decode table is made, and all of it is saved in the build
+    cache, so loading the same file again is just reading the tables back. After that, a variant ISA assembles at
+    exactly the same speed as the standard one, since it's the same code using different tables.
+    :param filename: The ISA description file, see compile_isa().
+    :param cache_dir: The directory the build cache is kept in, or None to not use the cache.
+    :raises OSError: If the file can't be read.
+    :raises ValueError: If the file isn't a valid ISA description.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'isa-' + hashlib.sha256(__version__.encode() + b'\0' + data).hexdigest() + '.json')
+        try:
+            with open(path, 'r') as f:
+                tables = json.load(f)
+            tables['encodings'] = {tuple(tokens): (code, tuple(tuple(warning) for warning in warnings))
+                                   for tokens, code, warnings in tables['encodings']}
+            install_isa(tables)
+            return
+        except (IOError, ValueError, KeyError, TypeError):
+            pass # not cached yet, or unreadable, so compile it
+
+    try:
+        description = json.loads(data)
+    except ValueError as e:
+        raise ValueError(f'{filename} is not valid json: {e}') from None
+    if not isinstance(description, dict):
+        raise ValueError(f'{filename} is not an ISA description')
+    tables = compile_isa(description)
+    install_isa(tables)
+    tables['encodings'], tables['decode_table'] = _build_encoder_decoder()
+
+    if path is not None:
+        entry = {**tables, 'encodings': [[list(tokens), code, [list(warning) for warning in warnings]]
+                                         for tokens, (code, warnings) in tables['encodings'].items()]}
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+        except IOError:
+            pass # it just gets compiled again next time
+
+def assemble_file(infilename: str, outfilename: str, cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE,
+                  optimize: bool = False, output_format: str = None) -> tuple:
+    """
+    Assembles one file and writes the assembled program to a .hex file (or another output format) if there were no errors.
+    Doesn't print anything, so it can be used from worker processes.
+    :param infilename: The file containing the asm.
+    :param outfilename: The .hex file to write.
+    :param cache_dir: The directory the build cache is kept in, or None to not use the cache.
+    :param cache_size: The most bytes the build cache is allowed to take up.
+    :param optimize: If True, run the peephole optimizer.
+    :param output_format: One of the names in output_formats, or None to pick one by outfilename's extension.
+    :return: A tuple of (ok, messages), where ok is True if the .hex file was written and messages is a list of
+             strings to show the user.
+    """
+    try:
+        with open(infilename, 'rb') as f:
+            source = f.read()
+    except IOError:
+        return False, [f"Could not open {infilename}. Please ensure it exists and that you have the necessary permissions to read it."]
+
+    result = None
+    if cache_dir is not None:
+        key = cache_key(source, optimize, infilename)
+        result = load_cached(cache_dir, key)
+
+    if result is None:
+        result = assemble(source.decode(errors='replace'), optimize, infilename)
+        if cache_dir is not None and result.ok:
+            store_cached(cache_dir, key, result, cache_size)
+
+    messages = [f'{diagnostic}\n' for diagnostic in result.diagnostics]
+    if not result.ok:
+        return False, messages + ['Exiting.']
+    if optimize:
+        messages.append(f'Optimizer saved {result.bytes_saved} bytes.')
+
+    # step 5: put hex codes in output file
+    try:
+        write_output_file(result.image, outfilename, output_format)
+    except IOError:
+        return False, messages + [f"Could not open {outfilename} for writing. Make sure you have write permissions."]
+
+    return True, messages
+
+# object files hold one assembled module before linking, as json - see assemble_object() for what's in one
+OBJECT_EXTENSION = '.o341'
+OBJECT_FORMAT = 'asm341 object'
+
+def write_object_file(obj: dict, filename: str) -> None:
+    """
+    Writes an object from assemble_object() to a file.
+    :param obj: The object. If it has a key (from cache_key()), that's saved too, so compile_file() can tell if the
+                object is up to date.
+    :param filename: The file to write.
+    :raises OSError: If the file can't be written.
+    """
+    entry = {
+        'format': OBJECT_FORMAT,
+        'version': __version__,
+        'key': obj.get('key'),
+        'name': obj['name'],
+        'blocks': {f'{block:x}': {**used, 'code': used['code'].hex()} for block, used in obj['blocks'].items()},
+        'sections': {name: {**section, 'code': bytes(section['code']).hex()} for name, section in obj['sections'].items()},
+        'fixups': obj['fixups'],
+        'line_map': obj['line_map'],
+        'diagnostics': [asdict(d) for d in obj['diagnostics']],
+        'bytes_saved': obj['bytes_saved'],
+        'dependencies': obj['dependencies']
     }
+    temp_path = f'{filename}.{os.getpid()}.tmp' # so a half written object is never left behind
+    with open(temp_path, 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(temp_path, filename)
+
+def read_object_file(filename: str) -> dict:
+    """
+    Reads an object written by write_object_file().
+    :param filename: The file to read.
+    :return: The object, as returned by assemble_object() plus its key.
+    :raises OSError: If the file can't be read.
+    :raises ValueError: If the file isn't an object file, or was written by a different version of the assembler.
+    """
+    with open(filename, 'r') as f:
+        try:
+            entry = json.load(f)
+        except ValueError:
+            raise ValueError(f'{filename} is not an object file') from None
+    if not isinstance(entry, dict) or entry.get('format') != OBJECT_FORMAT:
+        raise ValueError(f'{filename} is not an object file')
+    if entry['version'] != __version__:
+        raise ValueError(f'{filename} was made by version {entry["version"]} of the assembler, it needs to be assembled again')
+
+    return {
+        'key': entry['key'],
+        'name': entry['name'],
+        'blocks': {int(block, 16): {**used, 'code': bytes.fromhex(used['code'])} for block, used in entry['blocks'].items()},
+        'sections': {name: {**section, 'code': bytearray.fromhex(section['code']), 'fixups': [tuple(f) for f in section['fixups']]}
+                     for name, section in entry['sections'].items()},
+        'fixups': [tuple(f) for f in entry['fixups']],
+        'line_map': [(tuple(location) if isinstance(location, list) else location, line, file) for location, line, file in entry['line_map']],
+        'diagnostics': [Diagnostic(**d) for d in entry['diagnostics']],
+        'bytes_saved': entry['bytes_saved'],
+        'dependencies': entry['dependencies']
+    }
+
+def compile_file(infilename: str, objfilename: str, optimize: bool = False) -> tuple:
+    """
+    Assembles one file to an object file, unless the object file is already up to date - made from the same source,
+    with the same options, by the same version of the assembler, and none of the files it includes have changed.
+    Doesn't print anything, so it can be used from worker processes.
+    :param infilename: The file containing the asm.
+    :param objfilename: The object file to write.
+    :param optimize: If True, run the peephole optimizer.
+    :return: A tuple of (ok, messages, rebuilt), where ok is True if the object file is there and up to date, messages
+             is a list of strings to show the user, and rebuilt is False if the file didn't need assembling.
+    """
     try:
-        with open(infilename, 'r') as f:
-            # step 1: get next line
-            for line in f:
-                assembler_state['current_line'] += 1
-
-                # step 2: remove comments and multiple spaces
-                processed = preprocess(line, assembler_state)
-
-                # step 3: parse preprocessed line
-                if len(processed) == 0:
-                    continue  # empty line, so there's nothing to do
-
-                machine_code_instr = parse(processed, assembler_state)
-                if machine_code_instr == -1: # -1 indicates the line was an assembler directive,
-                    continue                 # so the parse function already did the necessary work
-
-                # step 4: store hex code in proper location in array
-                # repeat until end of file
-                block = assembler_state['current_block']
-                addr = assembler_state['current_addr']
-                blocks[block * 16 + addr] = machine_code_instr
-                assembler_state['current_addr'] += 1 # proceed to the next address and check if you will be
-                if assembler_state['current_addr'] > 16: # proceeding into the next block, issue warning if so
-                    assembler_state['current_addr'] = 0
-                    assembler_state['current_block'] += 1
-                    print(f"Warning: Block {assembler_state['current_block'] - 1} contains more than 16 instructions, extra instructions are placed in block "
-                    f"{assembler_state['current_block']}. \nMake sure that block is not in use, otherwise some instructions may be overwritten.")
+        with open(infilename, 'rb') as f:
+            source = f.read()
+    except IOError:
+        return False, [f"Could not open {infilename}. Please ensure it exists and that you have the necessary permissions to read it."], False
+
+    key = cache_key(source, optimize, infilename)
+    try:
+        old = read_object_file(objfilename)
+        if old['key'] == key and all(file_hash(path) == digest for path, digest in old['dependencies'].items()):
+            return True, [], False
+    except (IOError, ValueError):
+        pass # no usable object file, so it has to be made
+
+    obj = assemble_object(source.decode(errors='replace'), optimize, infilename)
+    messages = [f'{diagnostic}\n' for diagnostic in obj['diagnostics']]
+    if any(d.severity == 'error' for d in obj['diagnostics']):
+        return False, messages + ['Exiting.'], True
+
+    obj['key'] = key
+    try:
+        write_object_file(obj, objfilename)
+    except IOError:
+        return False, messages + [f"Could not open {objfilename} for writing. Make sure you have write permissions."], True
+    return True, messages, True
+
+def _compile_batch_file(infilename: str, optimize: bool = False) -> tuple:
+    """
+    Assembles one file to <name>.o341 next to it. Runs in a worker process.
+    :param infilename: The file containing the asm.
+    :param optimize: If True, run the peephole optimizer.
+    :return: A tuple of (infilename, objfilename, ok, messages, rebuilt).
+    """
+    objfilename = os.path.splitext(infilename)[0] + OBJECT_EXTENSION
+    return (infilename, objfilename) + compile_file(infilename, objfilename, optimize)
 
+def project_main(paths: list, outfilename: str = None, jobs: int = 1, optimize: bool = False, output_format: str = None,
+                 isa: str = None, cache_dir: str = DEFAULT_CACHE_DIR) -> int:
+    """
+    Builds a program made of several files. Every .341asm file is assembled to an object file next to it, skipping
+    the ones whose object files are up to date, then if outfilename is given, every object is linked into one program.
+    :param paths: The .341asm files, object files, directories or glob patterns to build, in order.
+    :param outfilename: The .hex file to link into, or None to only make the object files.
+    :param jobs: How many worker processes to assemble with.
+    :param optimize: If True, run the peephole optimizer.
+    :param output_format: One of the names in output_formats, or None to pick one by outfilename's extension.
+    :param isa: The ISA description file this process loaded, if any, so the worker processes can load it too.
+    :param cache_dir: The directory the compiled ISA description is cached in, or None to not use the cache.
+    :return: The exit code - 0 if everything was built, 1 otherwise.
+    """
+    files = expand_inputs(paths)
+    if len(files) == 0:
+        print("No input files found.")
+        return 1
+
+    sources = [path for path in files if not path.endswith(OBJECT_EXTENSION)]
+    compile_one = functools.partial(_compile_batch_file, optimize=optimize)
+    executor = None
+    if jobs > 1 and len(sources) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_isa if isa else None,
+                                                       initargs=(isa, cache_dir) if isa else ())
+    failures = 0
+    try:
+        for infilename, objfilename, ok, messages, rebuilt in (executor.map(compile_one, sources) if executor else map(compile_one, sources)):
+            status = 'FAILED' if not ok else 'built' if rebuilt else 'up to date'
+            print(f"{status:10} {infilename} -> {objfilename}")
+            for message in messages if outfilename is None or not ok else []: # the linker shows the warnings again
+                print('    ' + message.rstrip('\n').replace('\n', '\n    '))
+            if not ok:
+                failures += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if failures > 0 or outfilename is None:
+        return 1 if failures > 0 else 0
+
+    objects = []
+    for path in files:
+        objfilename = path if path.endswith(OBJECT_EXTENSION) else os.path.splitext(path)[0] + OBJECT_EXTENSION
+        try:
+            objects.append(read_object_file(objfilename))
+        except IOError:
+            print(f"Could not open {objfilename}. Please ensure it exists and that you have the necessary permissions to read it.")
+            return 1
+        except ValueError as e:
+            print(e)
+            return 1
+
+    result = link(objects)
+    for diagnostic in result.diagnostics:
+        print(f'{diagnostic}\n')
+    if not result.ok:
+        print('Exiting.')
+        return 1
+    if optimize:
+        print(f'Optimizer saved {result.bytes_saved} bytes.')
+
+    try:
+        write_output_file(result.image, outfilename, output_format)
     except IOError:
-        print(f"Could not open {infilename}. Please ensure it exists and that you have the necessary permissions to read it.")
+        print(f"Could not open {outfilename} for writing. Make sure you have write permissions.")
         return 1
+    print(f'Linked {len(objects)} objects into {outfilename}.')
+    return 0
 
-    # step 5: put hex codes in output file
-    write_hex_file(blocks, outfilename)
+def _modification_times(paths: list) -> dict:
+    """
+    :return: The modification time of each file, or None for files that can't be found.
+    """
+    times = {}
+    for path in paths:
+        try:
+            times[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            times[path] = None
+    return times
+
+def watch_main(infilename: str, outfilename: str, optimize: bool = False, interval: float = 0.25, output_format: str = None) -> int:
+    """
+    Watches a file and the files it includes, assembling it again whenever any of them change, until Ctrl+C is pressed.
+    The assembler stays loaded the whole time and keeps a cache of every line it has encoded, so only the lines that
+    changed are encoded again, and the .hex file is only written when the program actually changes.
+    :param infilename: The file containing the asm.
+    :param outfilename: The .hex file to write.
+    :param optimize: If True, run the peephole optimizer.
+    :param interval: How many seconds to wait between checking the files.
+    :param output_format: One of the names in output_formats, or None to pick one by outfilename's extension.
+    :return: The exit code.
+    """
+    line_cache = {}
+    make_output = output_formats[output_format_for(outfilename, output_format)][1]
+    try:
+        with open(outfilename, 'rb') as f:
+            last_output = f.read() # no need to write it again if it's already up to date
+    except IOError:
+        last_output = None
+
+    watched = _modification_times([infilename])
+    times = None
+    print(f"Watching {infilename}, press Ctrl+C to stop.")
+    try:
+        while True:
+            if watched != times:
+                times = watched
+                start = time.perf_counter()
+                try:
+                    with open(infilename, 'rb') as f:
+                        source = f.read().decode(errors='replace')
+                except IOError:
+                    print(f"Could not open {infilename}. Please ensure it exists and that you have the necessary permissions to read it.")
+                    source = None
+
+                if source is not None:
+                    cached_lines = len(line_cache)
+                    result = assemble(source, optimize, infilename, line_cache)
+                    encoded = len(line_cache) - cached_lines
+                    if len(line_cache) > 4 * (source.count('\n') + 1) + 1000:
+                        line_cache.clear() # mostly lines that have since been edited, so start again
+
+                    for diagnostic in result.diagnostics:
+                        print(f'{diagnostic}\n')
+                    output = make_output(result.image) if result.ok else None
+                    if not result.ok:
+                        status = f'{len(result.errors)} errors, {outfilename} not written'
+                    elif output == last_output:
+                        status = f'program unchanged, {outfilename} not written'
+                    else:
+                        try:
+                            with open(outfilename, 'wb') as f:
+                                f.write(output)
+                            last_output = output
+                            status = f'wrote {outfilename}'
+                        except IOError:
+                            status = f'could not open {outfilename} for writing'
+                    print(f"[{time.strftime('%H:%M:%S')}] {infilename}: {encoded} lines encoded in "
+                          f"{(time.perf_counter() - start) * 1000:.1f} ms, {status}")
+                    # keep the times from before the file was read, so a save made while assembling isn't missed,
+                    # and start watching new includes too
+                    paths = [infilename] + list(result.dependencies)
+                    new_times = _modification_times([path for path in paths if path not in watched])
+                    times = {path: watched[path] if path in watched else new_times[path] for path in paths}
+
+            time.sleep(interval)
+            watched = _modification_times(list(times))
+    except KeyboardInterrupt:
+        return 0
+
+def _assemble_batch_file(infilename: str, cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE, optimize: bool = False,
+                         output_format: str = 'hex') -> tuple:
+    """
+    Assembles one file for batch mode, writing <name>.hex (or the output format's extension) next to it. Runs in a worker process.
+    Every call goes through assemble(), which makes its own assembler state, so nothing is shared between files.
+    :param infilename: The file containing the asm.
+    :param cache_dir: The directory the build cache is kept in, or None to not use the cache.
+    :param cache_size: The most bytes the build cache is allowed to take up.
+    :param optimize: If True, run the peephole optimizer.
+    :param output_format: One of the names in output_formats.
+    :return: A tuple of (infilename, outfilename, ok, messages, seconds taken).
+    """
+    start = time.perf_counter()
+    outfilename = os.path.splitext(infilename)[0] + output_formats[output_format][0]
+    ok, messages = assemble_file(infilename, outfilename, cache_dir, cache_size, optimize, output_format)
+    return infilename, outfilename, ok, messages, time.perf_counter() - start
+
+def expand_inputs(paths: list) -> list:
+    """
+    Turns the input paths given on the command line into a list of files. Directories are replaced by the
+    .341asm files in them, and glob patterns are replaced by the files that match them.
+    :param paths: The paths from the command line.
+    :return: A list of files, in the order they were given.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '*.341asm')))
+        elif glob.has_magic(path):
+            files += sorted(glob.glob(path))
+        else:
+            files.append(path)
+    return files
+
+def batch_main(paths: list, jobs: int, cache_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE, optimize: bool = False,
+               output_format: str = 'hex', isa: str = None) -> int:
+    """
+    Assembles many files at once, spread over a pool of worker processes, and prints a summary.
+    :param paths: The files, directories or glob patterns to assemble.
+    :param jobs: How many worker processes to use.
+    :param cache_dir: The directory the build cache is kept in, or None to not use the cache.
+    :param cache_size: The most bytes the build cache is allowed to take up.
+    :param optimize: If True, run the peephole optimizer.
+    :param output_format: One of the names in output_formats.
+    :param isa: The ISA description file this process loaded, if any, so the worker processes can load it too.
+    :return: The exit code - 0 if every file assembled, 1 otherwise.
+    """
+    files = expand_inputs(paths)
+    if len(files) == 0:
+        print("No input files found.")
+        return 1
+
+    start = time.perf_counter()
+    failures = 0
+    assemble_one = functools.partial(_assemble_batch_file, cache_dir=cache_dir, cache_size=cache_size, optimize=optimize,
+                                     output_format=output_format)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_isa if isa else None,
+                                                initargs=(isa, cache_dir) if isa else ()) as executor:
+        for infilename, outfilename, ok, messages, seconds in executor.map(assemble_one, files):
+            print(f"{'ok' if ok else 'FAILED':6} {seconds * 1000:8.1f} ms  {infilename} -> {outfilename}")
+            for message in messages:
+                print('    ' + message.rstrip('\n').replace('\n', '\n    '))
+            if not ok:
+                failures += 1
+
+    print(f"{len(files) - failures} of {len(files)} files assembled in {time.perf_counter() - start:.2f} s using {jobs} jobs.")
+    return 1 if failures > 0 else 0
+
+def _import_tool(name: str):
+    """
+    Imports one of the other tools (e.g. lint341) for a command line option. They import asm341 themselves, and when
+    this file is run as a script that would load a second copy of it, without the instruction set --isa installed,
+    so this module is registered as asm341 first.
+    :param name: The module to import.
+    :return: The module.
+    """
+    sys.modules.setdefault('asm341', sys.modules[__name__])
+    return importlib.import_module(name)
+
+def main(argv: list = None):
+
+    parser = argparse.ArgumentParser(prog='asm341.py', description='Assembler for the CME341 4-bit microcontroller.',
+                                     usage='python asm341.py <infile> [<outfile>]\n'
+                                           '       python asm341.py --jobs N <infile, directory or glob> ...\n'
+                                           '       python asm341.py --link <outfile> <infile or object file> ...')
+    parser.add_argument('files', nargs='+', help='the file to assemble and the .hex file to write (default out.hex), '
+                                                 'or in batch mode, every file, directory or glob to assemble')
+    parser.add_argument('-j', '--jobs', type=int, help='assemble in batch mode using this many worker processes, '
+                                                       'writing <name>.hex next to each input')
+    parser.add_argument('-c', '--compile', action='store_true',
+                        help=f'assemble each file to an object file (<name>{OBJECT_EXTENSION}) for linking, skipping files that haven\'t changed')
+    parser.add_argument('-l', '--link', metavar='OUTFILE',
+                        help=f'link the files into one .hex file - .341asm files are assembled to objects first, like --compile, '
+                             f'and {OBJECT_EXTENSION} files are used as they are')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running, and assemble the file again every time it or a file it includes is saved')
+    parser.add_argument('-f', '--format', choices=list(output_formats),
+                        help='the output format: hex (Intel HEX, 16 bytes per record), hex32 (32 bytes per record), '
+                             'hex1 (1 byte per record, like older versions), mif (Quartus memory initialization file), '
+                             'memh (for Verilog $readmemh) or bin (raw bytes). By default it goes by the output file\'s extension, '
+                             'or hex in batch mode')
+    parser.add_argument('--isa', help='an ISA description file to use instead of the standard instruction set, '
+                                      'see Examples/cme341_isa.json')
+    parser.add_argument('-O', '--optimize', action='store_true', help='delete instructions that make no difference to what the program does')
+    parser.add_argument('-a', '--analyze', action='store_true',
+                        help='also look for blocks that never run, code that overwrites other code, and registers read before they are set')
+    parser.add_argument('--profile', action='store_true',
+                        help='print how long each stage of assembling the file takes and where the time goes, according to cProfile')
+    parser.add_argument('--no-cache', action='store_true', help='always assemble, without reading or writing the build cache')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help=f'where to keep the build cache (default {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_CACHE_SIZE / 1024 / 1024,
+                        help='the most megabytes the build cache can use before old entries are deleted (default %(default)g)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv[1:])
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = int(args.cache_size * 1024 * 1024)
+
+    if args.isa is not None:
+        if args.optimize:
+            parser.error("--optimize only knows what the standard instruction set's instructions do, so it can't be used with --isa")
+        try:
+            load_isa(args.isa, cache_dir)
+        except (IOError, ValueError) as e:
+            print(f"Could not load ISA description {args.isa}: {e}")
+            return 1
+
+    if args.analyze and (args.compile or args.link is not None or args.watch):
+        parser.error('--analyze only works when assembling one file')
+
+    if args.compile or args.link is not None:
+        return project_main(args.files, args.link, max(1, args.jobs or 1), args.optimize, args.format, args.isa, cache_dir)
+
+    # batch mode is used if asked for, or if there's no way to tell what one output file would be called
+    if args.jobs is not None or any(os.path.isdir(path) or glob.has_magic(path) for path in args.files):
+        if args.analyze:
+            parser.error('--analyze only works when assembling one file')
+        return batch_main(args.files, max(1, args.jobs or os.cpu_count() or 1), cache_dir, cache_size, args.optimize, args.format or 'hex', args.isa)
+
+    if len(args.files) > 2:
+        parser.error('too many files, use --jobs to assemble more than one file at a time')
+
+    infilename = args.files[0]
+    if len(args.files) == 1:
+        outfilename = "out.hex"
+    else:
+        outfilename = args.files[1]
+
+    if args.profile:
+        bench341 = _import_tool('bench341') # only loaded when it's used
+        return bench341.profile_main(infilename, outfilename, args.optimize, args.format)
+
+    if args.watch:
+        return watch_main(infilename, outfilename, args.optimize, output_format=args.format)
+
+    ok, messages = assemble_file(infilename, outfilename, cache_dir, cache_size, args.optimize, args.format)
+    for message in messages:
+        print(message)
+
+    if ok and args.analyze:
+        lint341 = _import_tool('lint341') # only loaded when it's used
+        with open(infilename, 'r') as f:
+            diagnostics = lint341.analyze(f, infilename, args.isa is None)
+        for diagnostic in diagnostics:
+            print(f'{diagnostic}\n')
+        if any(d.severity == 'error' for d in diagnostics):
+            return 1
+
+    return 0 if ok else 1
 
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())
@@ -0,0 +1,353 @@
+
+# ----------------------------------------------------------------------------------------
+# bench341.py - benchmarks for asm341.py
+# Measures how many lines per second the assembler gets through on large synthetic programs, and how long each stage takes
+# ----------------------------------------------------------------------------------------
+
+import argparse
+import cProfile
+import importlib.util
+import io
+import os
+import pstats
+import random
+import tempfile
+import time
+import tracemalloc
+
+import asm341
+
+def generate_source(num_lines: int, seed: int = 341, num_defines: int = 0, directive_rate: float = 0.1,
+                    directive_mix: dict = None) -> list:
+    """
+    Generates a synthetic 341 asm program made up of random valid instructions and directives.
+    The program is only meant to be assembled, not run, so the blocks overflow and overwrite each other freely.
+    :param num_lines: How many lines of asm to generate, not counting the defines.
+    :param seed: Seed for the random number generator, so that runs are repeatable.
+    :param num_defines: How many .define constants to put at the top of the program. If there are any, loads and jumps
+                        use them instead of plain numbers, and some are defined as other defines.
+    :param directive_rate: The fraction of lines that are directives instead of instructions.
+    :param directive_mix: How often each kind of directive comes up, relative to the others, as a dict of weights for
+                          'block', 'rblock', 'define' (changing a constant partway through, which clears the expansion
+                          cache) and 'undef' (an .undef followed by a .define of the same constant). Only .block
+                          directives by default. The program is one line longer for each 'undef'.
+    :return: A list of lines of asm.
+    """
+    rng = random.Random(seed)
+    directive_mix = directive_mix or {'block': 1}
+    if num_defines == 0: # there's nothing to change
+        directive_mix = {kind: weight for kind, weight in directive_mix.items() if kind not in ('define', 'undef')} or {'block': 1}
+
+    lines = []
+    constants = []
+    for n in range(num_defines):
+        if n > 0 and rng.randrange(4) == 0:
+            lines.append(f'.define const_{n} {rng.choice(constants)}') # nested
+        else:
+            lines.append(f'.define const_{n} {rng.randrange(16):x}')
+        constants.append(f'const_{n}')
+    lines.reverse() # older assemblers only expand a nested define if it comes before the one it refers to
+
+    def nibble():
+        return rng.choice(constants) if len(constants) > 0 else f'{rng.randrange(16):x}'
+
+    registers = ['x0', 'x1', 'y0', 'y1', 'm', 'i', 'dm']  # leave out r and o_reg, they print warnings
+    alu_ops = ['sub', 'add', 'muh', 'mul', 'xor', 'and']
+
+    rblocks = 0
+    for _ in range(num_lines):
+        choice = rng.randrange(1, 10)
+        if rng.random() < directive_rate:
+            directive = rng.choices(list(directive_mix), list(directive_mix.values()))[0]
+            if directive == 'block':
+                lines.append(f'.block {rng.randrange(16):x}')
+            elif directive == 'rblock':
+                lines.append(f'.rblock code_{rblocks}')
+                rblocks += 1
+            elif directive == 'define':
+                lines.append(f'.define {rng.choice(constants)} {rng.randrange(16):x}')
+            else:
+                constant = rng.choice(constants)
+                lines += [f'.undef {constant}', f'.define {constant} {rng.randrange(16):x}']
+        elif choice <= 3:
+            lines.append(f'    ld {rng.choice(registers)} {nibble()} ; load a constant')
+        elif choice <= 5:
+            lines.append(f'    mov {rng.choice(registers)} {rng.choice(registers + ["r", "i_pins"])}')
+        elif choice <= 7:
+            lines.append(f'    {rng.choice(alu_ops)} x{rng.randrange(2)} y{rng.randrange(2)}')
+        elif choice == 8:
+            lines.append(f'    {rng.choice(["neg", "not"])} x{rng.randrange(2)}')
+        else:
+            lines.append(f'    {rng.choice(["jmp", "jnz"])} {nibble()}')
+    return lines
+
+def bench_parse(module, lines: list, repeat: int = 5) -> float:
+    """
+    Times preprocess() and parse() from the given assembler module over the given lines.
+    :param module: The assembler module to benchmark, usually asm341.
+    :param lines: The lines of asm to assemble.
+    :param repeat: How many times to repeat the measurement. The fastest run is reported.
+    :return: The number of lines per second assembled in the fastest run.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        if hasattr(module, '_encode_cache'):
+            module._encode_cache.clear()  # don't let earlier runs warm up the cache for later ones
+        if hasattr(module, 'new_state'):
+            state = module.new_state()
+        else:  # older versions of the assembler set up the state in main()
+            state = {'defines': {}, 'current_line': 0, 'current_block': 0, 'current_addr': 0}
+
+        start = time.perf_counter()
+        for line in lines:
+            state['current_line'] += 1
+            processed = module.preprocess(line, state)
+            if len(processed) > 0:
+                module.parse(processed, state)
+        best = min(best, time.perf_counter() - start)
+
+    return len(lines) / best
+
+# the stages of assembling a file, in order - 'other' is everything in assemble() that isn't one of the stages around it,
+# like storing each instruction in its block and linking
+STAGES = ['read', 'preprocess', 'parse', 'other', 'optimize', 'placement', 'write']
+
+def _timed(times: dict, stage: str, function, calls: dict = None):
+    """
+    Wraps a function so the time spent in it is added to times[stage], and the number of calls to calls[stage].
+    """
+    def timed(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            times[stage] += time.perf_counter() - start
+            if calls is not None:
+                calls[stage] += 1
+    return timed
+
+def _wrapper_overhead(repeats: int = 100000) -> float:
+    """
+    Measures how long each call through _timed() takes on top of the time it records, i.e. the part of the wrapper
+    that lands outside the stage it's timing.
+    :return: The overhead of one call, in seconds.
+    """
+    inside = {'stage': 0.0}
+    calls = {'stage': 0}
+    timed = _timed(inside, 'stage', lambda: None, calls)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        timed()
+    outside = time.perf_counter() - start
+    return (outside - inside['stage']) / repeats
+
+def time_stages(infilename: str, outfilename: str, optimize: bool = False, output_format: str = None) -> dict:
+    """
+    Assembles a file the way asm341.py does, timing each stage separately. preprocess(), parse(), the optimizer and
+    place_sections() are timed by wrapping them while the file is assembled, and 'other' is the rest of that same run,
+    less the measured cost of the wrappers themselves. Peak memory is measured in a second run, since tracing memory
+    slows everything down.
+    :param infilename: The file containing the asm.
+    :param outfilename: The file to write the program to.
+    :param optimize: If True, run the peephole optimizer.
+    :param output_format: One of the names in asm341.output_formats, or None to pick one by outfilename's extension.
+    :return: A dict of the seconds taken by each stage in STAGES, plus 'total', 'lines', 'peak_memory' (in bytes) and
+             'result' (the AssemblyResult).
+    """
+    times = dict.fromkeys(STAGES, 0.0)
+    start = time.perf_counter()
+    with open(infilename, 'rb') as f:
+        source = f.read().decode(errors='replace')
+    times['read'] = time.perf_counter() - start
+
+    import opt341
+    wrapped = [(asm341, 'preprocess', 'preprocess'), (asm341, 'parse', 'parse'), (asm341, 'place_sections', 'placement'),
+               (opt341, 'optimize', 'optimize')]
+    originals = [getattr(module, name) for module, name, _ in wrapped]
+    calls = dict.fromkeys(STAGES, 0)
+    asm341._encode_cache.clear() # every run starts cold, like a new process would
+    try:
+        for (module, name, stage), original in zip(wrapped, originals):
+            setattr(module, name, _timed(times, stage, original, calls))
+        start = time.perf_counter()
+        result = asm341.assemble(source, optimize, infilename)
+        assembled = time.perf_counter() - start
+    finally:
+        for (module, name, _), original in zip(wrapped, originals):
+            setattr(module, name, original)
+    # 'other' comes from the same run as the stages it's the rest of, less what the wrappers cost outside those stages
+    overhead = sum(calls.values()) * _wrapper_overhead()
+    times['other'] = assembled - overhead - sum(times[stage] for _, _, stage in wrapped)
+
+    start = time.perf_counter()
+    asm341.write_output_file(result.image, outfilename, output_format)
+    times['write'] = time.perf_counter() - start
+    times['total'] = sum(times[stage] for stage in STAGES)
+
+    asm341._encode_cache.clear()
+    tracemalloc.start()
+    try:
+        asm341.assemble(source, optimize, infilename)
+        times['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    times['lines'] = source.count('\n') + 1
+    times['result'] = result
+    return times
+
+def print_stages(times: dict) -> None:
+    """
+    Prints the timings from time_stages() as a table.
+    """
+    for stage in STAGES:
+        print(f'    {stage:12}{times[stage] * 1000:10.2f} ms {times[stage] / times["total"]:7.1%}')
+    print(f'    {"total":12}{times["total"] * 1000:10.2f} ms    {times["lines"]:,} lines, {times["lines"] / times["total"]:,.0f} lines/sec, '
+          f'peak memory {times["peak_memory"] / 1024 / 1024:.1f} MiB')
+
+def profile_main(infilename: str, outfilename: str, optimize: bool = False, output_format: str = None, top: int = 25) -> int:
+    """
+    Assembles one file, then prints how long each stage took and the functions the most time went to according
+    to cProfile. Used by asm341.py --profile.
+    :param infilename: The file containing the asm.
+    :param outfilename: The file to write the program to.
+    :param optimize: If True, run the peephole optimizer.
+    :param output_format: One of the names in asm341.output_formats, or None to pick one by outfilename's extension.
+    :param top: How many functions to list.
+    :return: The exit code - 0 if the file assembled without errors, 1 otherwise.
+    """
+    output_format = asm341.output_format_for(outfilename, output_format)
+    with tempfile.TemporaryDirectory() as directory:
+        scratch = os.path.join(directory, 'out') # the stages write here, outfilename is only written if there are no errors
+        try:
+            times = time_stages(infilename, scratch, optimize, output_format)
+        except IOError as e:
+            print(f"Could not profile {infilename}: {e}")
+            return 1
+
+        result = times['result']
+        for diagnostic in result.diagnostics:
+            print(f'{diagnostic}\n')
+        print(f'Stages for {infilename}:')
+        print_stages(times)
+
+        asm341._encode_cache.clear()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        with open(infilename, 'rb') as f:
+            result = asm341.assemble(f.read().decode(errors='replace'), optimize, infilename)
+        asm341.write_output_file(result.image, scratch, output_format)
+        profiler.disable()
+
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+    print(f'\ncProfile, top {top} functions by cumulative time:')
+    print(out.getvalue().rstrip())
+
+    if not result.ok:
+        print('Exiting.')
+        return 1
+    if optimize:
+        print(f'Optimizer saved {result.bytes_saved} bytes.')
+    try:
+        asm341.write_output_file(result.image, outfilename, output_format)
+    except IOError:
+        print(f"Could not open {outfilename} for writing. Make sure you have write permissions.")
+        return 1
+    return 0
+
+# the corpora run by --suite, as (name, generate_source() arguments) - each one is run at every size
+SUITE = [
+    ('instructions', {}),
+    ('defines', {'num_defines': 1000}),
+    ('directives', {'num_defines': 100, 'directive_rate': 0.3, 'directive_mix': {'block': 4, 'define': 2, 'undef': 1, 'rblock': 1}})
+]
+SUITE_SIZES = [1000, 10000, 100000]
+
+def run_suite(sizes: list = None, repeat: int = 3, optimize: bool = False) -> list:
+    """
+    Runs time_stages() on every corpus in SUITE at every size, keeping the fastest of several runs.
+    :param sizes: How many lines long to make each corpus, SUITE_SIZES by default.
+    :param repeat: How many times to assemble each corpus.
+    :param optimize: If True, run the peephole optimizer.
+    :return: A list of (name, number of lines, timings) tuples.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes or SUITE_SIZES:
+            for name, options in SUITE:
+                infilename = os.path.join(directory, f'{name}_{size}.341asm')
+                with open(infilename, 'w') as f:
+                    f.write('\n'.join(generate_source(size, **options)))
+                best = min((time_stages(infilename, os.path.join(directory, 'out.hex'), optimize) for _ in range(repeat)),
+                           key=lambda times: times['total'])
+                results.append((name, size, best))
+    return results
+
+def load_module(path: str):
+    """
+    Loads another copy of the assembler from a file, so that an older version can be compared against this one.
+    :param path: The path to the other asm341.py.
+    :return: The loaded module.
+    """
+    spec = importlib.util.spec_from_file_location('asm341_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the asm341 assembler.')
+    parser.add_argument('--lines', type=int, default=200000, help='number of lines in the synthetic program')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs, the fastest is reported')
+    parser.add_argument('--defines', type=int, default=0, help='number of .define constants at the top of the program, e.g. 1000')
+    parser.add_argument('--directives', type=float, default=0.1, help='the fraction of lines that are directives (default %(default)g)')
+    parser.add_argument('--mix', default='block=1', help='how often each kind of directive comes up, as weights for block, rblock, '
+                                                          'define and undef, e.g. block=4,define=1 (default %(default)s)')
+    parser.add_argument('--baseline', help='path to another asm341.py to compare against, e.g. an older version')
+    parser.add_argument('--stages', action='store_true', help='time each stage of assembling the program, like asm341.py --profile')
+    parser.add_argument('--suite', action='store_true', help='time each stage for programs of several sizes and mixes of directives')
+    parser.add_argument('--save', metavar='FILE', help='write the synthetic program to a file instead of benchmarking it')
+    args = parser.parse_args()
+
+    try:
+        mix = {kind: float(weight) for kind, weight in (item.split('=') for item in args.mix.split(','))}
+    except ValueError:
+        parser.error(f'could not understand --mix {args.mix}')
+    if not set(mix) <= {'block', 'rblock', 'define', 'undef'}:
+        parser.error(f'unknown directive in --mix {args.mix}')
+
+    if args.suite:
+        print(f'{"corpus":14}{"lines":>8}' + ''.join(f'{stage:>12}' for stage in STAGES) + f'{"lines/sec":>12}{"peak MiB":>10}')
+        for name, size, times in run_suite(repeat=args.repeat):
+            print(f'{name:14}{size:8}' + ''.join(f'{times[stage] * 1000:9.2f} ms' for stage in STAGES) +
+                  f'{times["lines"] / times["total"]:12,.0f}{times["peak_memory"] / 1024 / 1024:10.1f}')
+        return 0
+
+    lines = generate_source(args.lines, num_defines=args.defines, directive_rate=args.directives, directive_mix=mix)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            f.write('\n'.join(lines))
+        return 0
+
+    if args.stages:
+        with tempfile.TemporaryDirectory() as directory:
+            infilename = os.path.join(directory, 'bench.341asm')
+            with open(infilename, 'w') as f:
+                f.write('\n'.join(lines))
+            print(f'Stages for {len(lines):,} lines:')
+            print_stages(min((time_stages(infilename, os.path.join(directory, 'out.hex')) for _ in range(args.repeat)),
+                             key=lambda times: times['total']))
+        return 0
+
+    if args.baseline is not None:
+        rate = bench_parse(load_module(args.baseline), lines, args.repeat)
+        print(f'baseline: {rate:12,.0f} lines/sec')
+
+    rate = bench_parse(asm341, lines, args.repeat)
+    print(f'current:  {rate:12,.0f} lines/sec')
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,124 @@
+
+# ----------------------------------------------------------------------------------------
+# disasm341.py - a disassembler for the 4-bit microcontroller developed in CME341 at the U of S
+# Turns .hex files and assembled programs back into 341 asm
+# ----------------------------------------------------------------------------------------
+
+import argparse
+
+import asm341
+
+def disassemble(image: bytes) -> str:
+    """
+    Turns a program back into 341 asm. Every block that contains anything other than nops gets a .block directive,
+    and the nops at the end of each block (which is what unused space is filled with) are left out,
+    so assembling the output gives back the same program.
+    :param image: The program, 256 bytes long.
+    :return: The asm, as one string.
+    """
+    decode_table = asm341.decode_table() # made from the assembler's own encoder, so they can never disagree
+    lines = []
+    for block in range(len(image) // asm341.BLOCK_SIZE):
+        code = image[block * asm341.BLOCK_SIZE:(block + 1) * asm341.BLOCK_SIZE]
+        length = len(code)
+        while length > 0 and code[length - 1] == asm341.FILL:
+            length -= 1
+        if length == 0:
+            continue
+
+        lines.append(f'.block {block:x}')
+        for addr in range(length):
+            text = decode_table[code[addr]]
+            if text is None: # nothing the assembler can write makes this byte
+                lines.append(f'    nop ; {code[addr]:#04x} at address {block * asm341.BLOCK_SIZE + addr:#04x} has no 341 asm, it was replaced with a nop')
+            else:
+                lines.append('    ' + text)
+        lines.append('')
+
+    return '\n'.join(lines)
+
+def compare(image: bytes, expected: bytes) -> list:
+    """
+    Finds every address where two programs differ, e.g. the contents of a deployed ROM and the program assembled from
+    its source.
+    :param image: The first program.
+    :param expected: The second program.
+    :return: A list of strings describing each difference, empty if they're the same.
+    """
+    decode_table = asm341.decode_table()
+    differences = []
+    for addr, (actual_byte, expected_byte) in enumerate(zip(image, expected)):
+        if actual_byte != expected_byte:
+            differences.append(f'block {addr // asm341.BLOCK_SIZE:x} address {addr % asm341.BLOCK_SIZE:x}: {decode_table[actual_byte] or hex(actual_byte)} '
+                               f'but expected {decode_table[expected_byte] or hex(expected_byte)}')
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description='Disassemble .hex files made for the CME341 microcontroller.')
+    parser.add_argument('files', nargs='+', help='the .hex files to disassemble')
+    parser.add_argument('-o', '--output', help='write the asm to this file instead of printing it (only for one input file)')
+    parser.add_argument('-c', '--compare', metavar='SOURCE',
+                        help='instead of disassembling, assemble this .341asm file and list every difference from it')
+    parser.add_argument('--isa', help='an ISA description file, for programs made for a variant of the instruction set')
+    args = parser.parse_args()
+
+    if args.output is not None and len(args.files) > 1:
+        parser.error('--output can only be used with one input file')
+
+    if args.isa is not None:
+        try:
+            asm341.load_isa(args.isa)
+        except (IOError, ValueError) as e:
+            print(f'Could not load ISA description {args.isa}: {e}')
+            return 1
+
+    expected = None
+    if args.compare is not None:
+        try:
+            with open(args.compare, 'r') as f:
+                result = asm341.assemble(f, filename=args.compare)
+        except IOError:
+            print(f"Could not open {args.compare}. Please ensure it exists and that you have the necessary permissions to read it.")
+            return 1
+        if not result.ok:
+            print('\n'.join(str(e) for e in result.errors))
+            return 1
+        expected = result.image
+
+    status = 0
+    for filename in args.files:
+        try:
+            image = asm341.read_hex_file(filename)
+        except IOError:
+            print(f"Could not open {filename}. Please ensure it exists and that you have the necessary permissions to read it.")
+            status = 1
+            continue
+        except ValueError as e:
+            print(e)
+            status = 1
+            continue
+
+        if expected is not None:
+            differences = compare(image, expected)
+            print(f"{filename}: {'matches' if len(differences) == 0 else f'{len(differences)} differences from'} {args.compare}")
+            for difference in differences:
+                print('    ' + difference)
+            if len(differences) > 0:
+                status = 1
+        elif args.output is not None:
+            try:
+                with open(args.output, 'w') as f:
+                    f.write(disassemble(image))
+            except IOError:
+                print(f"Could not open {args.output} for writing. Make sure you have write permissions.")
+                status = 1
+        else:
+            if len(args.files) > 1:
+                print(f'; {filename}')
+            print(disassemble(image))
+
+    return status
+
+
+if __name__ == "__main__":
+    exit(main())
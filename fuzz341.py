@@ -0,0 +1,356 @@
+
+# ----------------------------------------------------------------------------------------
+# fuzz341.py - a differential fuzzer for asm341.py
+# Assembles random programs, valid and invalid, and checks every byte and error against a separate reference encoder
+# ----------------------------------------------------------------------------------------
+
+import argparse
+import concurrent.futures
+import os
+import random
+import re
+import time
+
+import asm341
+
+# the reference encoder - written from the instruction formats in the manual, without using any of asm341's tables,
+# so a mistake in those tables shows up as a difference instead of being copied
+#   ld  <dest> <n>   0ddd nnnn
+#   mov <dest> <src> 10dd dsss    (src == dest reads the input pins)
+#   alu <x> <y>      110x yfff
+#   jmp <block>      1110 bbbb
+#   jnz <block>      1111 bbbb
+_REGISTERS = {'x0': 0, 'x1': 1, 'y0': 2, 'y1': 3, 'r': 4, 'o_reg': 4, 'm': 5, 'i': 6, 'dm': 7}
+_ALU = {'neg': 0, 'sub': 1, 'add': 2, 'muh': 3, 'mul': 4, 'xor': 5, 'and': 6, 'not': 7}
+_ONE_OPERAND = ('neg', 'not') # these ignore y, so their y bit is always 0
+_ALU_OPERAND = {'0': 0, '1': 1} # x and y can be given as x0/x1 and y0/y1, or just 0/1
+
+class _Invalid(Exception):
+    """
+    Raised by the reference encoder for a line the assembler should reject, with the error code it should give.
+    """
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.code = code
+
+def _nibble(token: str) -> int:
+    try:
+        value = int(token, 16)
+    except ValueError:
+        raise _Invalid('bad-number') from None
+    if not 0 <= value <= 15:
+        raise _Invalid('out-of-range')
+    return value
+
+def _register(token: str) -> int:
+    if token == 'i_pins':
+        raise _Invalid('i-pins-destination')
+    if token not in _REGISTERS:
+        raise _Invalid('not-a-register')
+    return _REGISTERS[token]
+
+def _alu_operand(token: str, letter: str) -> int:
+    if token[:1] == letter:
+        token = token[1:]
+    if token not in _ALU_OPERAND:
+        raise _Invalid('bad-alu-operand')
+    return _ALU_OPERAND[token]
+
+def reference_encode(tokens: list) -> int:
+    """
+    Encodes one instruction, already split into lowercase tokens with macros expanded. Extra operands are ignored,
+    like the assembler does.
+    :return: The byte of machine code.
+    :raises _Invalid: If the assembler should reject the instruction.
+    """
+    mnemonic = tokens[0]
+    needed = {'ld': 2, 'mov': 2, 'jmp': 1, 'jnz': 1, 'nop': 0, 'neg': 1, 'not': 1}.get(mnemonic, 2 if mnemonic in _ALU else None)
+    if needed is None:
+        raise _Invalid('unknown-instruction')
+    if len(tokens) < needed + 1:
+        raise _Invalid('too-few-args')
+
+    if mnemonic == 'ld':
+        return _register(tokens[1]) << 4 | _nibble(tokens[2])
+    if mnemonic == 'mov':
+        dest = _register(tokens[1])
+        source = dest if tokens[2] == 'i_pins' else _REGISTERS.get(tokens[2])
+        if source is None:
+            raise _Invalid('not-a-register')
+        return 0b10 << 6 | dest << 3 | source
+    if mnemonic in ('jmp', 'jnz'):
+        return (0b1110 if mnemonic == 'jmp' else 0b1111) << 4 | _nibble(tokens[1])
+    if mnemonic == 'nop':
+        return 0b11001000
+    x = _alu_operand(tokens[1], 'x')
+    y = 0 if mnemonic in _ONE_OPERAND else _alu_operand(tokens[2], 'y')
+    return 0b110 << 5 | x << 4 | y << 3 | _ALU[mnemonic]
+
+def _is_name(token: str) -> bool:
+    # a jump to something that looks like a name is a jump to a relocatable block, and the fuzzer never makes any
+    return re.fullmatch(r'[a-z_][a-z0-9_]*', token) is not None and re.fullmatch(r'[0-9a-f]+', token) is None
+
+def reference_assemble(lines: list) -> tuple:
+    """
+    Assembles a program the slow, obvious way: 16 blocks of 16 bytes filled with nop, .block to move around in them,
+    code that runs off the end of a block carrying on into the next one, and .define/.undef text replacement.
+    :param lines: The lines of the program.
+    :return: A tuple of (image, line map, errors), where the line map maps each address to the line it was assembled
+             from, and errors maps each bad line to the error code the assembler should give it.
+    """
+    image = bytearray([0b11001000] * 256)
+    line_map = {}
+    errors = {}
+    defines = {}
+    block = address = 0
+
+    def expand(token):
+        chain = [token]
+        while token in defines:
+            token = defines[token]
+            if token in chain:
+                raise _Invalid('recursive-macro')
+            chain.append(token)
+        return token
+
+    for number, line in enumerate(lines, 1):
+        tokens = line.split(';')[0].lower().split()
+        if len(tokens) == 0:
+            continue
+        try:
+            if tokens[0][0] != '.':
+                tokens = [expand(token) for token in tokens]
+
+            if tokens[0] == '.define':
+                if len(tokens) < 3:
+                    raise _Invalid('too-few-args')
+                defines[tokens[1]] = tokens[2]
+            elif tokens[0] == '.undef':
+                if len(tokens) < 2:
+                    raise _Invalid('too-few-args')
+                if tokens[1] not in defines:
+                    raise _Invalid('not-defined')
+                del defines[tokens[1]]
+            elif tokens[0] == '.block':
+                if len(tokens) < 2:
+                    raise _Invalid('too-few-args')
+                block, address = _nibble(tokens[1]), 0
+            elif tokens[0][0] == '.':
+                raise _Invalid('unknown-directive')
+            else:
+                code = None
+                if tokens[0] in ('jmp', 'jnz') and len(tokens) > 1 and _is_name(tokens[1]):
+                    # assembled as a jump to block 0, then reported when the jump can't be fixed up
+                    code = reference_encode([tokens[0], '0'])
+                    errors[number] = 'undefined-block'
+                else:
+                    code = reference_encode(tokens)
+                if address == 16:
+                    block, address = (block + 1) % 16, 0
+                image[block * 16 + address] = code
+                line_map[block * 16 + address] = number
+                address += 1
+        except _Invalid as e:
+            errors[number] = e.code
+
+    return image, line_map, errors
+
+# tokens used to build programs - mostly valid, with some that are wrong in every way the assembler checks for
+_NIBBLES = [f'{value:x}' for value in range(16)] + ['0f', '00a', '0x3', 'F', '+7', '0_1']
+_BAD_TOKENS = ['10', '-1', 'zz', 'x2', 'y', 'i_pins', 'r2', 'ff', '0x10', 'add', 'loop', '.', '.foo', '2x', 'dm1', '00', 'x']
+_DEFINE_NAMES = ['k', 'reg', 'limit', 'x0', 'add', 'go', 'n']
+
+def _random_operand(rng: random.Random, kind: str, defines: list) -> str:
+    if len(defines) > 0 and rng.random() < 0.1:
+        return rng.choice(defines)
+    if kind == 'dest':
+        return rng.choice(list(_REGISTERS))
+    if kind == 'src':
+        return rng.choice(list(_REGISTERS) + ['i_pins'])
+    if kind == 'nibble':
+        return rng.choice(_NIBBLES)
+    return rng.choice([f'{kind}0', f'{kind}1', '0', '1'])
+
+def _format(rng: random.Random, tokens: list) -> str:
+    """
+    Joins tokens into a line with random indentation, spacing, capitals and comments.
+    """
+    tokens = [token.upper() if rng.random() < 0.1 else token for token in tokens]
+    line = rng.choice(['', '', '    ', '\t']) + ''.join(token + rng.choice([' ', ' ', '\t', '  ']) for token in tokens).rstrip()
+    if rng.random() < 0.1:
+        line += rng.choice([' ; comment', ';x0 y0', '\t; ld x0 f'])
+    return line
+
+def generate_program(rng: random.Random, max_lines: int = 24, invalid_rate: float = 0.05) -> list:
+    """
+    Makes a random program out of instructions, directives, blank lines and comments.
+    :param rng: The random number generator to use.
+    :param max_lines: The longest the program can be.
+    :param invalid_rate: Roughly the fraction of lines that are made wrong on purpose, by swapping a token for a bad
+                         one, leaving out an operand or using an instruction that doesn't exist.
+    :return: The lines of the program.
+    """
+    lines = []
+    defines = []
+    for _ in range(rng.randrange(1, max_lines + 1)):
+        choice = rng.random()
+        if choice < 0.08:
+            tokens = ['.block', rng.choice(_NIBBLES)]
+        elif choice < 0.12:
+            name = rng.choice(_DEFINE_NAMES)
+            tokens = ['.define', name, rng.choice(list(_REGISTERS) + _NIBBLES + _DEFINE_NAMES + ['i_pins', 'mov', 'ld', '.block'])]
+            defines.append(name)
+        elif choice < 0.14:
+            tokens = ['.undef', rng.choice(_DEFINE_NAMES)]
+        elif choice < 0.18:
+            lines.append(rng.choice(['', '; just a comment', '   ']))
+            continue
+        else:
+            mnemonic = rng.choice(['ld', 'ld', 'mov', 'mov', 'jmp', 'jnz', 'nop', 'neg', 'not'] + list(_ALU))
+            kinds = {'ld': ['dest', 'nibble'], 'mov': ['dest', 'src'], 'jmp': ['nibble'], 'jnz': ['nibble'], 'nop': [],
+                     'neg': ['x'], 'not': ['x']}.get(mnemonic, ['x', 'y'])
+            tokens = [mnemonic] + [_random_operand(rng, kind, defines) for kind in kinds]
+
+        if rng.random() < invalid_rate:
+            mutation = rng.randrange(4)
+            if mutation == 0:
+                tokens[rng.randrange(len(tokens))] = rng.choice(_BAD_TOKENS)
+            elif mutation == 1 and len(tokens) > 1:
+                tokens.pop()
+            elif mutation == 2:
+                tokens.append(rng.choice(_BAD_TOKENS + _NIBBLES)) # extra operands should be ignored
+            else:
+                tokens[0] = rng.choice(['lda', 'jz', 'movx', 'halt', '.blok'])
+        lines.append(_format(rng, tokens))
+    return lines
+
+def check_program(lines: list) -> str:
+    """
+    Assembles a program with asm341 and with the reference encoder and compares them.
+    :param lines: The lines of the program.
+    :return: A description of the first difference, or None if they agree.
+    """
+    asm341._encode_cache.clear() # so every program is checked by the encoder itself, not what it cached for another one
+    try:
+        result = asm341.assemble(lines)
+    except Exception as e: # anything that isn't an error diagnostic is a bug
+        return f'assembler raised {type(e).__name__}: {e}'
+    image, line_map, errors = reference_assemble(lines)
+
+    actual_errors = {}
+    for diagnostic in result.errors:
+        actual_errors.setdefault(diagnostic.line, diagnostic.code)
+    for number in sorted(set(errors) | set(actual_errors)):
+        if errors.get(number) != actual_errors.get(number):
+            return f'line {number} ({lines[number - 1].strip()!r}): expected error {errors.get(number)}, got {actual_errors.get(number)}'
+
+    for address in range(256):
+        if result.image[address] != image[address]:
+            number = line_map.get(address)
+            where = f' from line {number} ({lines[number - 1].strip()!r})' if number is not None else ''
+            return f'address {address:02x}{where}: expected {image[address]:02x}, got {result.image[address]:02x}'
+
+    actual_map = {address: line for address, (line, _) in result.line_map.items()}
+    if actual_map != line_map:
+        address = min(a for a in set(line_map) | set(actual_map) if line_map.get(a) != actual_map.get(a))
+        return f'line map at address {address:02x}: expected line {line_map.get(address)}, got line {actual_map.get(address)}'
+    return None
+
+def shrink(lines: list) -> list:
+    """
+    Makes a failing program as short as possible while it still fails, by deleting chunks of lines, starting with
+    big chunks and working down to single lines, then dropping trailing operands and comments from what's left.
+    :param lines: A program check_program() finds a difference in.
+    :return: A shorter program with a difference.
+    """
+    chunk = len(lines) // 2
+    while chunk >= 1:
+        start = 0
+        while start < len(lines):
+            candidate = lines[:start] + lines[start + chunk:]
+            if len(candidate) > 0 and check_program(candidate) is not None:
+                lines = candidate
+            else:
+                start += chunk
+        chunk //= 2
+
+    for index in range(len(lines)):
+        while True:
+            line = lines[index].split(';')[0].rstrip()
+            shorter = [line, ' '.join(line.split()[:-1])] if line != lines[index] else [' '.join(line.split()[:-1])]
+            for candidate_line in shorter:
+                candidate = lines[:index] + [candidate_line] + lines[index + 1:]
+                if candidate_line != lines[index] and check_program(candidate) is not None:
+                    lines = candidate
+                    break
+            else:
+                break
+    return lines
+
+def fuzz_batch(seed: int, count: int, max_lines: int = 24, invalid_rate: float = 0.05) -> list:
+    """
+    Checks a batch of random programs. Used by the worker processes.
+    :param seed: Seed for the random number generator, so a batch can be run again to reproduce a failure.
+    :param count: How many programs to check.
+    :param max_lines: The longest a program can be.
+    :param invalid_rate: Roughly the fraction of lines that are made wrong on purpose.
+    :return: A list of (program, difference) tuples, one for each program the assembler got wrong.
+    """
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(count):
+        lines = generate_program(rng, max_lines, invalid_rate)
+        difference = check_program(lines)
+        if difference is not None:
+            failures.append((lines, difference))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check asm341.py against a reference encoder on random programs.')
+    parser.add_argument('-n', '--count', type=int, default=100000, help='how many programs to check (default %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='how many worker processes to use (default: one per CPU)')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='seed for the random programs (default: a new one every run)')
+    parser.add_argument('--max-lines', type=int, default=24, help='the longest a program can be (default %(default)s)')
+    parser.add_argument('--invalid', type=float, default=0.05,
+                        help='roughly the fraction of lines that are made wrong on purpose (default %(default)g)')
+    parser.add_argument('-o', '--output', default='fuzz_failures',
+                        help='directory to write the shrunk programs the assembler gets wrong to (default %(default)s)')
+    parser.add_argument('--max-failures', type=int, default=10, help='stop after this many failures (default %(default)s)')
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    batch_size = 1000
+    batches = [(seed + n, min(batch_size, args.count - n * batch_size)) for n in range(-(-args.count // batch_size))]
+    print(f'Checking {args.count} programs with seed {seed}')
+
+    checked = 0
+    failures = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max(1, args.jobs)) as pool:
+        futures = {pool.submit(fuzz_batch, batch_seed, count, args.max_lines, args.invalid): count for batch_seed, count in batches}
+        for future in concurrent.futures.as_completed(futures):
+            checked += futures[future]
+            failures += future.result()
+            if len(failures) >= args.max_failures:
+                for other in futures:
+                    other.cancel()
+                break
+    seconds = time.perf_counter() - start
+    print(f'{checked} programs in {seconds:.1f} s ({checked / seconds * 60:,.0f} per minute), {len(failures)} failures')
+
+    if len(failures) > 0:
+        os.makedirs(args.output, exist_ok=True)
+    for number, (lines, difference) in enumerate(failures[:args.max_failures]):
+        lines = shrink(lines)
+        difference = check_program(lines)
+        filename = os.path.join(args.output, f'failure_{number}.341asm')
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + f'\n; {difference}\n') # at the end, so the line numbers stay the same
+        print(f'{filename}: {difference}')
+    return 1 if len(failures) > 0 else 0
+
+
+if __name__ == "__main__":
+    exit(main())
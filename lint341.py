@@ -0,0 +1,214 @@
+
+# ----------------------------------------------------------------------------------------
+# lint341.py - a static analyzer for the 4-bit microcontroller developed in CME341 at the U of S
+# Finds code that can never run, code that overwrites other code, and registers read before they're set,
+# used by asm341.py --analyze
+# ----------------------------------------------------------------------------------------
+
+import argparse
+from typing import Iterable, Union
+
+import asm341
+
+# the registers a program has to set before reading them, as one bit each for the dataflow pass
+TRACKED = ['x0', 'x1', 'y0', 'y1', 'i', 'm']
+_ALL_TRACKED = (1 << len(TRACKED)) - 1
+
+def _masks() -> list:
+    """
+    Works out which tracked registers every opcode reads and writes, as bit masks, from the optimizer's decoding.
+    Any access to dm reads i and m, since that's how the address is found.
+    :return: A list of (reads, writes) tuples, indexed by opcode.
+    """
+    import opt341 # only loaded when it's used, since it only knows the standard instruction set
+    def mask(locations):
+        return sum(1 << bit for bit, register in enumerate(TRACKED) if register in locations)
+    return [(mask(effect['reads']), mask(effect['writes'])) for effect in opt341.effects]
+
+def _jump(opcode: int) -> tuple:
+    """
+    :return: A tuple of (kind, target block), where kind is 'jmp', 'jnz' or None if the opcode isn't a jump.
+    """
+    for kind in ('jmp', 'jnz'):
+        base, ((number_kind, _),) = asm341.instruction_table[kind]
+        target_mask = asm341.number_kinds[number_kind]
+        if opcode & ~target_mask == base:
+            return kind, opcode & target_mask
+    return None, None
+
+def block_graph(image: bytes) -> dict:
+    """
+    Builds the control flow graph of a program, with one node per block. Jumps can only go to the start of a block,
+    so a block is only ever entered at its start: by a jump, or by running off the end of the block before it.
+    Nothing after a jmp in the same block can run.
+    :param image: The program.
+    :return: For each block, a list of (successor block, index of the instruction the edge leaves from) tuples, in the
+             order they can be taken. Running off the end of a block has the index BLOCK_SIZE.
+    """
+    graph = {}
+    for block in range(asm341.NUM_BLOCKS):
+        edges = []
+        start = block * asm341.BLOCK_SIZE
+        for index in range(asm341.BLOCK_SIZE):
+            kind, target = _jump(image[start + index])
+            if kind is not None:
+                edges.append((target, index))
+            if kind == 'jmp':
+                break
+        else:
+            edges.append(((block + 1) % asm341.NUM_BLOCKS, asm341.BLOCK_SIZE)) # the program counter wraps around
+        graph[block] = edges
+    return graph
+
+def reachable_blocks(graph: dict) -> set:
+    """
+    :param graph: The graph from block_graph().
+    :return: Every block that can be run, starting from block 0 where execution starts.
+    """
+    reached = {0}
+    stack = [0]
+    while len(stack) > 0:
+        for successor, _ in graph[stack.pop()]:
+            if successor not in reached:
+                reached.add(successor)
+                stack.append(successor)
+    return reached
+
+def uninitialized_reads(image: bytes, graph: dict) -> list:
+    """
+    Finds every instruction that might read x0, x1, y0, y1, i or m before anything has been written to it, along any
+    path from the start of the program. The registers that might not be set yet are kept as a bit mask at the start of
+    each block, and the masks are pushed along the edges of the graph until they stop changing, so this is quick
+    however loopy the program is.
+    :param image: The program.
+    :param graph: The graph from block_graph().
+    :return: A list of (address, names of the registers) tuples, in address order.
+    """
+    masks = _masks()
+    unset = {0: _ALL_TRACKED} # the registers that might not be set at the start of each reachable block
+    work = [0]
+    while len(work) > 0:
+        block = work.pop()
+        start = block * asm341.BLOCK_SIZE
+        current = unset[block]
+        index = 0
+        for successor, exit_index in graph[block]:
+            for address in range(start + index, start + min(exit_index + 1, asm341.BLOCK_SIZE)):
+                current &= ~masks[image[address]][1]
+            index = exit_index + 1
+            merged = unset.get(successor, 0) | current
+            if successor not in unset or merged != unset[successor]:
+                unset[successor] = merged
+                work.append(successor)
+
+    found = []
+    for block in sorted(unset):
+        start = block * asm341.BLOCK_SIZE
+        current = unset[block]
+        last = graph[block][-1][1] # nothing after the jmp that ends the block runs
+        for address in range(start, start + min(last + 1, asm341.BLOCK_SIZE)):
+            reads, writes = masks[image[address]]
+            if reads & current:
+                found.append((address, [register for bit, register in enumerate(TRACKED) if reads & current & 1 << bit]))
+            current &= ~writes
+    return found
+
+def analyze_object(obj: dict, result: asm341.AssemblyResult, registers: bool = True) -> list:
+    """
+    Looks for mistakes in an assembled program that the assembler itself doesn't catch:
+    - blocks of code that no path from block 0 ever gets to (unreachable-block)
+    - instructions that overwrite other instructions, e.g. when a later .block 3 is put where earlier code ran on
+      into block 3 (overwrite)
+    - instructions that read x0, x1, y0, y1, i or m before the program has set them (uninitialized-read)
+    :param obj: The program's object, from asm341.assemble_object(), without the optimizer so every line is still there.
+    :param result: The program linked from the object, from asm341.link().
+    :param registers: If False, skip looking for uninitialized reads, which only knows the standard instruction set.
+    :return: A list of asm341.Diagnostic warnings, in line order.
+    """
+    diagnostics = []
+
+    def warning(where, code, message):
+        line, file = where
+        diagnostics.append(asm341.Diagnostic('warning', line, 1, code, message, file))
+
+    # step 1: addresses written twice - the object's line map keeps every instruction, not just the last one at each address
+    written = {}
+    for location, line, file in obj['line_map']:
+        if isinstance(location, tuple): # relocatable code only ever goes in free blocks, so it can't overwrite anything
+            continue
+        if location in written:
+            first_line, first_file = written[location]
+            where = f' of {first_file}' if first_file is not None else ''
+            warning((line, file), 'overwrite', f"This instruction overwrites the one from line {first_line}{where} at address "
+                    f"{location:02x} (block {location // asm341.BLOCK_SIZE:x}), so that one is never run.")
+        written[location] = (line, file)
+
+    # step 2: blocks that can't be reached from the start of the program
+    graph = block_graph(result.image)
+    reached = reachable_blocks(graph)
+    for block in range(asm341.NUM_BLOCKS):
+        start = block * asm341.BLOCK_SIZE
+        lines = [result.line_map[address] for address in range(start, start + asm341.BLOCK_SIZE) if address in result.line_map]
+        if block not in reached and len(lines) > 0:
+            warning(lines[0], 'unreachable-block', f"Nothing jumps or runs on into block {block:x}, so its code is never run.")
+
+    # step 3: registers read before they're written
+    if registers:
+        for address, names in uninitialized_reads(result.image, graph):
+            if address in result.line_map:
+                warning(result.line_map[address], 'uninitialized-read',
+                        f"{' and '.join(names)} might be read here before anything is written to {'it' if len(names) == 1 else 'them'}.")
+
+    diagnostics.sort(key=lambda d: (d.file is not None, d.file or '', d.line))
+    return diagnostics
+
+def analyze(source: Union[str, Iterable[str]], filename: str = None, registers: bool = True) -> list:
+    """
+    Assembles a program and looks for mistakes in it, see analyze_object().
+    :param source: The program, either as one string or as an iterable of lines (like an open file).
+    :param filename: The file the source came from, so .include can find files next to it.
+    :param registers: If False, skip looking for uninitialized reads.
+    :return: A list of asm341.Diagnostic warnings, or the errors the program has if it doesn't assemble.
+    """
+    obj = asm341.assemble_object(source, False, filename)
+    result = asm341.link([obj])
+    if not result.ok:
+        return result.errors
+    return analyze_object(obj, result, registers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find unreachable blocks, overwritten code and registers read before '
+                                                 'they are set in CME341 asm programs.')
+    parser.add_argument('files', nargs='+', help='the .341asm files to check')
+    parser.add_argument('--isa', help='an ISA description file, for programs made for a variant of the instruction set - '
+                                      'registers read before they are set are only found with the standard instruction set')
+    args = parser.parse_args()
+
+    if args.isa is not None:
+        try:
+            asm341.load_isa(args.isa)
+        except (IOError, ValueError) as e:
+            print(f'Could not load ISA description {args.isa}: {e}')
+            return 1
+
+    status = 0
+    for filename in args.files:
+        try:
+            with open(filename, 'r') as f:
+                diagnostics = analyze(f, filename, args.isa is None)
+        except IOError:
+            print(f"Could not open {filename}. Please ensure it exists and that you have the necessary permissions to read it.")
+            status = 1
+            continue
+        if len(args.files) > 1:
+            print(f'{filename}:')
+        for diagnostic in diagnostics:
+            print(diagnostic)
+        if any(d.severity == 'error' for d in diagnostics):
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    exit(main())
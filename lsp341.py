@@ -0,0 +1,540 @@
+
+# ----------------------------------------------------------------------------------------
+# lsp341.py - a language server for the 4-bit microcontroller developed in CME341 at the U of S
+# Gives editors errors as you type, the machine code for each line, go to definition and how full each block is
+# ----------------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import re
+import sys
+import urllib.parse
+from dataclasses import replace
+
+import asm341
+
+# LSP constants
+ERROR, WARNING = 1, 2                 # DiagnosticSeverity
+INCREMENTAL = 2                       # TextDocumentSyncKind
+MODULE, FUNCTION = 2, 12              # SymbolKind
+METHOD_NOT_FOUND, INTERNAL_ERROR = -32601, -32603
+
+def read_message(stream):
+    """
+    Reads one JSON-RPC message, framed with a Content-Length header like LSP uses.
+    :param stream: A binary stream, e.g. sys.stdin.buffer.
+    :return: The message, or None at the end of the stream.
+    """
+    length = None
+    while True:
+        header = stream.readline()
+        if header == b'':
+            return None
+        header = header.strip()
+        if header == b'':
+            break
+        name, _, value = header.decode('ascii').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    if length is None:
+        return None
+    return json.loads(stream.read(length).decode('utf-8'))
+
+def write_message(stream, message: dict) -> None:
+    """
+    Writes one JSON-RPC message with a Content-Length header.
+    :param stream: A binary stream, e.g. sys.stdout.buffer.
+    :param message: The message.
+    """
+    body = json.dumps(message).encode('utf-8')
+    stream.write(b'Content-Length: %d\r\n\r\n' % len(body) + body)
+    stream.flush()
+
+def uri_to_path(uri: str) -> str:
+    """
+    :return: The file a file:// uri points to, or None for other uris (e.g. unsaved files).
+    """
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme != 'file':
+        return None
+    return os.path.normpath(urllib.parse.unquote(parsed.path))
+
+def path_to_uri(path: str) -> str:
+    return 'file://' + urllib.parse.quote(os.path.abspath(path))
+
+def _split_lines(text: str) -> list:
+    return re.split(r'\r\n|\r|\n', text) # the line endings LSP counts, str.splitlines() knows a few more
+
+def _context(state: dict) -> tuple:
+    """
+    Everything about the assembler state that affects how the next line is assembled. If two lines start from the same
+    context, they assemble the same way.
+    """
+    return (state['defines_key'], state['current_block'], state['current_addr'], state['current_section'],
+            tuple((name, len(section['code'])) for name, section in state['sections'].items()))
+
+class Document:
+    """
+    An open 341 asm file, kept assembled as it's edited.
+    Every line has an entry in an index, holding the context the line was assembled in and what the line produced:
+    the instructions it encoded and where they went, its diagnostics, and the relocatable blocks and defines it declared.
+    After an edit, the lines are assembled again from the first changed line, until a line after the edit starts from
+    the same context it did before, at which point the rest of the old index is still right and is kept. Encoded lines
+    are also cached by their text, like asm341 --watch does, so assembling a line again is mostly a dict lookup.
+    Positions are counted in characters, which is what LSP counts too as long as the file is ASCII.
+    """
+
+    def __init__(self, uri: str, text: str):
+        self.uri = uri
+        self.path = uri_to_path(uri)
+        self.lines = _split_lines(text)
+        self.line_cache = {}
+        self.reparse()
+
+    def reparse(self) -> None:
+        """
+        Assembles the whole document again, e.g. after a file it includes was saved.
+        """
+        state = asm341.new_state()
+        self.index = [self._new_entry(state, state['defines'])]
+        self._reparse(0, len(self.lines), len(self.lines))
+
+    def edit(self, start: tuple, end: tuple, text: str) -> None:
+        """
+        Replaces a range of the document, then assembles the lines that need it.
+        :param start: The (line, character) the range starts at, both starting from 0.
+        :param end: The (line, character) the range ends at, not included in the range.
+        :param text: The new text.
+        """
+        (start_line, start_char), (end_line, end_char) = start, end
+        if end_line >= len(self.lines): # the end of the document
+            end_line = len(self.lines) - 1
+            end_char = len(self.lines[end_line])
+        new_lines = _split_lines(self.lines[start_line][:start_char] + text + self.lines[end_line][end_char:])
+        self.lines[start_line:end_line + 1] = new_lines
+        self._reparse(start_line, start_line + len(new_lines), len(new_lines) - (end_line - start_line + 1))
+
+    @staticmethod
+    def _new_entry(state: dict, defines: dict) -> dict:
+        return {'before': _context(state), 'defines': defines, 'emitted': [], 'diagnostics': [], 'declared': [],
+                'definitions': [], 'includes': set(), 'redeclared': []}
+
+    def _reparse(self, first: int, changed_end: int, delta: int) -> None:
+        """
+        Assembles lines from first on, stopping as soon as the old index can be reused.
+        :param first: The first line that changed.
+        :param changed_end: The line after the last one that changed, in the new document.
+        :param delta: How many lines longer the document got.
+        """
+        old_index = self.index
+        start = old_index[first]
+        state = asm341.new_state()
+        state['defines_key'], state['current_block'], state['current_addr'], state['current_section'], lengths = start['before']
+        state['defines'] = dict(start['defines'])
+        state['line_cache'] = self.line_cache
+        declared = {}
+        for number, entry in enumerate(old_index[:first]):
+            for name, line, column, file in entry['declared']:
+                declared[name] = (line if file is not None else number + 1, column, file)
+        for name, length in lengths:
+            line, column, file = declared[name]
+            state['sections'][name] = {'code': bytearray(length), 'fixups': [], 'line': line, 'column': column, 'file': file}
+
+        blocks = bytearray(asm341.NUM_BLOCKS * asm341.BLOCK_SIZE)
+        defines, defines_key = start['defines'], state['defines_key'] # entries share a copy of the defines until they change
+        new_entries = []
+        number = first
+        while number < len(self.lines):
+            if number >= changed_end and old_index[number - delta]['before'] == _context(state):
+                new_entries += old_index[number - delta:] # the rest of the file assembles the same as it did before
+                break
+            if state['defines_key'] != defines_key:
+                defines, defines_key = dict(state['defines']), state['defines_key']
+            new_entries.append(self._assemble_line(number, state, blocks, defines))
+            number += 1
+        else:
+            if state['defines_key'] != defines_key:
+                defines = dict(state['defines'])
+            new_entries.append(self._new_entry(state, defines)) # the context at the end of the file
+
+        self.index = old_index[:first] + new_entries
+        self._link()
+
+    def _assemble_line(self, number: int, state: dict, blocks: bytearray, defines: dict) -> dict:
+        """
+        Assembles one line of the document, along with every line of any file it includes, and makes its index entry.
+        """
+        entry = self._new_entry(state, defines)
+        state['diagnostics'] = entry['diagnostics']
+        stack = state['include_stack']
+        stack.append({'path': self.path, 'label': None, 'lines': iter([self.lines[number]]), 'line': number})
+
+        while len(stack) > 0:
+            current = stack[-1]
+            line = next(current['lines'], None)
+            if line is None:
+                stack.pop()
+                continue
+
+            current['line'] += 1
+            state['current_line'] = current['line']
+            state['current_file'] = current['label']
+            if current['label'] is not None:
+                entry['includes'].add(current['label'])
+
+            section = state['sections'].get(state['current_section'])
+            sizes = (len(state['line_map']), len(state['fixups']), len(section['fixups']) if section is not None else 0,
+                     len(state['sections']), state['defines_key'])
+            try:
+                asm341.assemble_line(line, state, blocks)
+            except asm341.AssemblyError as e:
+                state['diagnostics'].append(asm341.Diagnostic('error', state['current_line'], asm341._token_column(line, e.token),
+                                                              e.code, e.message, state['current_file']))
+                if e.code == 'duplicate-block': # the message names the line of the first .rblock, which can move
+                    entry['redeclared'].append(asm341.preprocess(line, state)[1])
+
+            if len(state['line_map']) > sizes[0]:
+                location, line_number, file = state['line_map'][-1]
+                if isinstance(location, tuple):
+                    code = state['sections'][location[0]]['code'][location[1]]
+                    reference = section['fixups'][-1][1:] if len(section['fixups']) > sizes[2] else None
+                else:
+                    code = blocks[location]
+                    reference = state['fixups'][-1][1:] if len(state['fixups']) > sizes[1] else None
+                entry['emitted'].append((location, code, reference, line_number, file))
+            if len(state['sections']) > sizes[3]:
+                name, section = list(state['sections'].items())[-1]
+                entry['declared'].append((name, section['line'], section['column'], section['file']))
+            if state['defines_key'] != sizes[4]:
+                tokens = asm341.preprocess(line, state)
+                if tokens[0] == '.define':
+                    entry['definitions'].append((tokens[1], state['current_line'], asm341._token_column(line, 1), state['current_file']))
+
+        return entry
+
+    def _link(self) -> None:
+        """
+        Puts together the program from the index, then places the relocatable blocks, the same way asm341 does.
+        Line numbers in the index are only kept for included files, lines in the document are numbered by where their
+        entry is now.
+        """
+        state = asm341.new_state()
+        blocks = bytearray([asm341.FILL] * asm341.NUM_BLOCKS * asm341.BLOCK_SIZE)
+        for number, entry in enumerate(self.index[:-1]):
+            for name, line, column, file in entry['declared']:
+                state['sections'][name] = {'code': bytearray(), 'fixups': [], 'line': line if file is not None else number + 1,
+                                           'column': column, 'file': file}
+            for location, code, reference, line, file in entry['emitted']:
+                if file is None:
+                    line = number + 1
+                    if reference is not None:
+                        reference = (reference[0], line) + reference[2:]
+                if isinstance(location, tuple):
+                    section = state['sections'][location[0]]
+                    if reference is not None:
+                        section['fixups'].append((len(section['code']),) + reference)
+                    section['code'].append(code)
+                else:
+                    blocks[location] = code
+                    state['used_blocks'].setdefault(location // asm341.BLOCK_SIZE, (line, file))
+                    if reference is not None:
+                        state['fixups'].append((location,) + reference)
+
+        self.placement = asm341.place_sections(state, blocks)
+        self.image = blocks
+        self.sections = state['sections']
+        self.link_diagnostics = state['diagnostics']
+
+    def address(self, location):
+        """
+        :return: Where an instruction ended up in the program, or None if its relocatable block couldn't be placed.
+        """
+        if isinstance(location, tuple):
+            name, offset = location
+            return self.placement[name] * asm341.BLOCK_SIZE + offset if name in self.placement else None
+        return location
+
+    def _range(self, line: int, column: int) -> dict:
+        """
+        :return: The LSP range of the token starting at a column (starting from 1), or the whole line if it's past the end.
+        """
+        text = self.lines[line]
+        match = re.compile(r'\S+').search(text, column - 1)
+        if match is None:
+            return {'start': {'line': line, 'character': 0}, 'end': {'line': line, 'character': len(text)}}
+        return {'start': {'line': line, 'character': match.start()}, 'end': {'line': line, 'character': match.end()}}
+
+    def diagnostics(self) -> list:
+        """
+        :return: Every diagnostic as LSP Diagnostics. Problems in included files are shown on the .include line.
+        """
+        included_by = {}
+        for number, entry in enumerate(self.index[:-1]):
+            for file in entry['includes']:
+                included_by.setdefault(file, number)
+
+        result = []
+        for number, entry in enumerate(self.index[:-1]):
+            redeclared = iter(entry['redeclared'])
+            for diagnostic in entry['diagnostics']:
+                if diagnostic.code == 'duplicate-block':
+                    # entries are kept when lines before them move, so the line is filled in from where the block is now
+                    name = next(redeclared)
+                    diagnostic = replace(diagnostic, message=f"Relocatable block {name} was already declared on line "
+                                                             f"{self.sections[name]['line']}")
+                result.append(self._diagnostic(diagnostic, number))
+        result += [self._diagnostic(d, d.line - 1 if d.file is None else included_by.get(d.file, 0)) for d in self.link_diagnostics]
+        return result
+
+    def _diagnostic(self, diagnostic: asm341.Diagnostic, line: int) -> dict:
+        message = diagnostic.message
+        if diagnostic.file is not None:
+            message = f'{diagnostic.file}, line {diagnostic.line}: {message}'
+        return {
+            'range': self._range(line, diagnostic.column if diagnostic.file is None else 1),
+            'severity': ERROR if diagnostic.severity == 'error' else WARNING,
+            'code': diagnostic.code,
+            'source': 'asm341',
+            'message': message
+        }
+
+    def token_at(self, line: int, character: int) -> tuple:
+        """
+        :return: A tuple of (the token at a position, its range), or (None, None) if there isn't one or it's in a comment.
+        """
+        if line >= len(self.lines):
+            return None, None
+        text = self.lines[line]
+        comment = text.index(';') if ';' in text else len(text)
+        for match in re.finditer(r'\S+', text[:comment]):
+            if match.start() <= character <= match.end():
+                return match.group().lower(), {'start': {'line': line, 'character': match.start()},
+                                               'end': {'line': line, 'character': match.end()}}
+        return None, None
+
+    def _block_usage(self, block: int) -> int:
+        return len({location for entry in self.index[:-1] for location, *_ in entry['emitted']
+                    if not isinstance(location, tuple) and location // asm341.BLOCK_SIZE == block})
+
+    def hover(self, line: int, character: int):
+        """
+        :return: What to show when hovering over a position, as an LSP Hover, or None.
+                 Defines show what they expand to, .block and .rblock lines show how full the block is, and instructions
+                 show the byte they were encoded to and where it went.
+        """
+        token, token_range = self.token_at(line, character)
+        if token is None:
+            return None
+        entry = self.index[line]
+        tokens = self.lines[line].split(';')[0].lower().split()
+
+        if token in entry['defines'] and tokens[0] != '.define':
+            try:
+                value = asm341.expand_token(token, {'defines': entry['defines'], 'expansions': {}})
+            except asm341.AssemblyError as e:
+                value = e.message
+            return {'contents': {'kind': 'markdown', 'value': f'`{token}` is defined as `{value}`'}, 'range': token_range}
+
+        if tokens[0] == '.block':
+            try:
+                block = int(tokens[1], 16)
+            except (IndexError, ValueError):
+                return None
+            text = f'Block {block:x}: {self._block_usage(block)} of {asm341.BLOCK_SIZE} instructions used'
+        elif tokens[0] == '.rblock' and len(entry['declared']) > 0:
+            name = entry['declared'][0][0]
+            length = len(self.sections[name]['code'])
+            where = f'placed in block {self.placement[name]:x}' if name in self.placement else 'not placed'
+            blocks = max(1, -(-length // asm341.BLOCK_SIZE))
+            text = f"Relocatable block `{name}`: {length} instructions, {blocks} block{'s' if blocks > 1 else ''}, {where}"
+        else:
+            emitted = [item for item in entry['emitted'] if item[4] is None]
+            if len(emitted) == 0:
+                return None
+            location, code = emitted[0][:2]
+            address = self.address(location)
+            if address is not None:
+                code = self.image[address]
+                text = f'`{code:#04x}` = `{code >> 4:04b} {code & 15:04b}` at block {address // asm341.BLOCK_SIZE:x}, address {address % asm341.BLOCK_SIZE:x}'
+            else:
+                text = f'`{code:#04x}` = `{code >> 4:04b} {code & 15:04b}` in relocatable block {location[0]}'
+            try:
+                expanded = asm341.preprocess(self.lines[line], {'defines': entry['defines'], 'expansions': {}})
+            except asm341.AssemblyError:
+                expanded = tokens
+            if expanded != tokens:
+                text += f'\n\nExpands to `{" ".join(expanded)}`'
+        return {'contents': {'kind': 'markdown', 'value': text}}
+
+    def _location(self, line: int, column: int, file: str, name: str) -> dict:
+        uri = self.uri if file is None else path_to_uri(file)
+        return {'uri': uri, 'range': {'start': {'line': line - 1, 'character': column - 1},
+                                      'end': {'line': line - 1, 'character': column - 1 + len(name)}}}
+
+    def definition(self, line: int, character: int):
+        """
+        :return: Where the define or relocatable block at a position was declared, as an LSP Location, or None.
+        """
+        token, _ = self.token_at(line, character)
+        if token is None:
+            return None
+        for number in range(min(line, len(self.index) - 2), -1, -1): # the define in effect is the last one before the line
+            for name, declared_line, column, file in reversed(self.index[number]['definitions']):
+                if name == token:
+                    return self._location(number + 1 if file is None else declared_line, column, file, name)
+        for number, entry in enumerate(self.index[:-1]):
+            for name, declared_line, column, file in entry['declared']:
+                if name == token:
+                    return self._location(number + 1 if file is None else declared_line, column, file, name)
+        return None
+
+    def symbols(self) -> list:
+        """
+        :return: Every block and relocatable block in the document, as LSP DocumentSymbols, with how full each one is.
+        """
+        symbols = []
+        for number, text in enumerate(self.lines):
+            tokens = text.split(';')[0].lower().split()
+            line_range = {'start': {'line': number, 'character': 0}, 'end': {'line': number, 'character': len(text)}}
+            if len(tokens) >= 2 and tokens[0] == '.block' and re.fullmatch(r'[0-9a-f]+', tokens[1]):
+                block = int(tokens[1], 16)
+                symbols.append({'name': f'block {block:x}', 'detail': f'{self._block_usage(block)}/{asm341.BLOCK_SIZE}', 'kind': MODULE,
+                                'range': line_range, 'selectionRange': line_range})
+            for name, *_ in self.index[number]['declared'] if tokens[:1] == ['.rblock'] else []:
+                length = len(self.sections[name]['code'])
+                where = f', block {self.placement[name]:x}' if name in self.placement else ''
+                symbols.append({'name': name, 'detail': f'{length} instructions{where}', 'kind': FUNCTION,
+                                'range': line_range, 'selectionRange': line_range})
+        return symbols
+
+class Server:
+    """
+    Answers LSP requests about open documents, one message at a time.
+    """
+
+    def __init__(self, output):
+        """
+        :param output: The binary stream to write responses and notifications to.
+        """
+        self.output = output
+        self.documents = {}
+        self.shut_down = False
+        self.handlers = {
+            'initialize': self.initialize,
+            'shutdown': self.shutdown,
+            'textDocument/didOpen': self.did_open,
+            'textDocument/didChange': self.did_change,
+            'textDocument/didClose': self.did_close,
+            'textDocument/didSave': self.did_save,
+            'textDocument/hover': lambda params: self._document(params).hover(*self._position(params)),
+            'textDocument/definition': lambda params: self._document(params).definition(*self._position(params)),
+            'textDocument/documentSymbol': lambda params: self._document(params).symbols()
+        }
+
+    def run(self, stream) -> int:
+        """
+        Handles messages until the client says to exit.
+        :param stream: The binary stream to read messages from.
+        :return: The exit code, 0 if the client shut the server down first like it should.
+        """
+        while True:
+            message = read_message(stream)
+            if message is None or message.get('method') == 'exit':
+                return 0 if self.shut_down else 1
+            self.handle(message)
+
+    def handle(self, message: dict) -> None:
+        """
+        Handles one request or notification, responding to requests. Notifications the server doesn't know are ignored.
+        """
+        handler = self.handlers.get(message.get('method'))
+        if 'id' not in message: # a notification
+            if handler is not None:
+                handler(message.get('params', {}))
+            return
+
+        response = {'jsonrpc': '2.0', 'id': message['id']}
+        if handler is None:
+            response['error'] = {'code': METHOD_NOT_FOUND, 'message': f"Unknown method {message.get('method')}"}
+        else:
+            try:
+                response['result'] = handler(message.get('params', {}))
+            except Exception as e: # one bad request shouldn't take down the editor's server
+                response['error'] = {'code': INTERNAL_ERROR, 'message': f'{type(e).__name__}: {e}'}
+        write_message(self.output, response)
+
+    def notify(self, method: str, params: dict) -> None:
+        write_message(self.output, {'jsonrpc': '2.0', 'method': method, 'params': params})
+
+    def publish(self, document: Document) -> None:
+        self.notify('textDocument/publishDiagnostics', {'uri': document.uri, 'diagnostics': document.diagnostics()})
+
+    def _document(self, params: dict) -> Document:
+        return self.documents[params['textDocument']['uri']]
+
+    @staticmethod
+    def _position(params: dict) -> tuple:
+        return params['position']['line'], params['position']['character']
+
+    def initialize(self, params: dict) -> dict:
+        return {
+            'capabilities': {
+                'textDocumentSync': {'openClose': True, 'change': INCREMENTAL, 'save': True},
+                'hoverProvider': True,
+                'definitionProvider': True,
+                'documentSymbolProvider': True
+            },
+            'serverInfo': {'name': 'asm341', 'version': asm341.__version__}
+        }
+
+    def shutdown(self, params: dict) -> None:
+        self.shut_down = True
+        return None
+
+    def did_open(self, params: dict) -> None:
+        document = Document(params['textDocument']['uri'], params['textDocument']['text'])
+        self.documents[document.uri] = document
+        self.publish(document)
+
+    def did_change(self, params: dict) -> None:
+        document = self._document(params)
+        for change in params['contentChanges']:
+            if 'range' in change:
+                start, end = change['range']['start'], change['range']['end']
+                document.edit((start['line'], start['character']), (end['line'], end['character']), change['text'])
+            else: # the whole document
+                document.lines = _split_lines(change['text'])
+                document.reparse()
+        self.publish(document)
+
+    def did_close(self, params: dict) -> None:
+        document = self.documents.pop(params['textDocument']['uri'], None)
+        if document is not None:
+            self.notify('textDocument/publishDiagnostics', {'uri': document.uri, 'diagnostics': []})
+
+    def did_save(self, params: dict) -> None:
+        # the saved file might be included by any open document, and included files aren't tracked line by line
+        for document in self.documents.values():
+            if any(len(entry['includes']) > 0 for entry in document.index):
+                document.reparse()
+                self.publish(document)
+
+def main():
+    parser = argparse.ArgumentParser(description='Language server for CME341 asm, for editors that support LSP.')
+    parser.add_argument('--stdio', action='store_true', help='talk to the editor over stdin and stdout (the default, and only, option)')
+    parser.add_argument('--isa', help='an ISA description file to use instead of the standard instruction set')
+    args = parser.parse_args()
+
+    if args.isa is not None:
+        try:
+            asm341.load_isa(args.isa)
+        except (IOError, ValueError) as e:
+            print(f'Could not load ISA description {args.isa}: {e}', file=sys.stderr)
+            return 1
+
+    return Server(sys.stdout.buffer).run(sys.stdin.buffer)
+
+
+if __name__ == "__main__":
+    exit(main())
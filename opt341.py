@@ -0,0 +1,242 @@
+
+# ----------------------------------------------------------------------------------------
+# opt341.py - a peephole optimizer for the 4-bit microcontroller developed in CME341 at the U of S
+# Deletes instructions that can't change what a program does, used by asm341.py -O
+# ----------------------------------------------------------------------------------------
+
+import asm341
+
+# every place an instruction can read or write
+# pins is the input pins, which can change at any time, and dm is all of data memory
+LOCATIONS = frozenset(['x0', 'x1', 'y0', 'y1', 'o_reg', 'm', 'i', 'r', 'zero', 'dm', 'pins'])
+_register_names = ['x0', 'x1', 'y0', 'y1', 'o_reg', 'm', 'i', 'dm'] # by register number, as a destination
+
+# what each alu operation calculates, for folding operations on known values
+_alu_functions = {
+    0: lambda x, y: -x & 15,         # neg
+    1: lambda x, y: (x - y) & 15,    # sub
+    2: lambda x, y: (x + y) & 15,    # add
+    3: lambda x, y: (x * y) >> 4,    # muh
+    4: lambda x, y: (x * y) & 15,    # mul
+    5: lambda x, y: x ^ y,           # xor
+    6: lambda x, y: x & y,           # and
+    7: lambda x, y: ~x & 15          # not
+}
+
+def _decode(opcode: int) -> dict:
+    """
+    Works out what one opcode does, in terms of the locations it reads and writes.
+    :param opcode: A byte of machine code.
+    :return: A dict with the instruction's kind ('ld', 'mov', 'alu', 'nop', 'jmp' or 'jnz'), the sets of locations it
+             reads and writes, and whether it does anything visible outside the registers (fixed), which means it can
+             never be deleted.
+    """
+    reads, writes = set(), set()
+
+    if opcode < 0b10000000:
+        kind = 'ld'
+        dest, src = (opcode >> 4) & 7, None
+    elif opcode < 0b11000000:
+        kind = 'mov'
+        dest, src = (opcode >> 3) & 7, opcode & 7
+        if src == dest:
+            reads.add('pins') # moving a register to itself reads the input pins instead
+        elif src == 4:
+            reads.add('r')
+        else:
+            reads.add(_register_names[src])
+    elif opcode < 0b11100000:
+        if (opcode >> 3) & 1 and opcode & 7 in (0, 7):
+            kind = 'nop'
+        else:
+            kind = 'alu'
+            reads.add(f'x{(opcode >> 4) & 1}')
+            if opcode & 7 not in (0, 7): # neg and not ignore y
+                reads.add(f'y{(opcode >> 3) & 1}')
+            writes |= {'r', 'zero'}
+        dest = src = None
+    else:
+        kind = 'jmp' if opcode < 0b11110000 else 'jnz'
+        if kind == 'jnz':
+            reads.add('zero')
+        dest = src = None
+
+    if dest is not None:
+        writes.add(_register_names[dest])
+    if 'dm' in reads or 'dm' in writes: # any access to dm moves i forward by m
+        reads |= {'i', 'm'}
+        writes.add('i')
+
+    return {
+        'kind': kind,
+        'reads': frozenset(reads),
+        'writes': frozenset(writes),
+        'fixed': 'dm' in reads or 'dm' in writes or 'o_reg' in writes or kind in ('jmp', 'jnz')
+    }
+
+effects = [_decode(opcode) for opcode in range(256)]
+
+def _values_after(opcode: int, values: dict, fresh: list) -> dict:
+    """
+    Works out the value of each location an instruction writes, using value numbering - every value is either
+    ('const', n) when it's known, or some other tuple that's equal to another value only when they're sure to be equal.
+    :param opcode: The instruction.
+    :param values: The value in each location before the instruction.
+    :param fresh: A one item list holding a counter, used to make up values that can't be equal to anything else.
+    :return: The value in each location the instruction writes.
+    """
+    effect = effects[opcode]
+    kind = effect['kind']
+
+    def unknown():
+        fresh[0] += 1
+        return ('unknown', fresh[0])
+
+    if 'dm' in effect['reads'] or 'dm' in effect['writes'] or 'pins' in effect['reads']:
+        return {location: unknown() for location in effect['writes']}
+
+    if kind == 'ld':
+        return {_register_names[(opcode >> 4) & 7]: ('const', opcode & 15)}
+
+    if kind == 'mov':
+        source, = effect['reads']
+        return {_register_names[(opcode >> 3) & 7]: values[source]}
+
+    if kind == 'alu':
+        x, y, operation = values[f'x{(opcode >> 4) & 1}'], values[f'y{(opcode >> 3) & 1}'], opcode & 7
+        if operation in (0, 7):
+            y = None # neg and not ignore y
+        if x[0] == 'const' and (y is None or y[0] == 'const'):
+            result = _alu_functions[operation](x[1], 0 if y is None else y[1])
+            return {'r': ('const', result), 'zero': ('const', result == 0)}
+        result = ('alu', operation, x, y)
+        return {'r': result, 'zero': ('zero', result)}
+
+    return {}
+
+def _is_nop(unit: list, index: int, before: dict, live_after: frozenset) -> bool:
+    return effects[unit[index][0]]['kind'] == 'nop'
+
+def _is_unreachable(unit: list, index: int, before: dict, live_after: frozenset) -> bool:
+    # only the start of a block can be jumped to, so nothing after a jmp in the same block can ever run
+    return any(effects[opcode]['kind'] == 'jmp' for opcode, _ in unit[:index])
+
+def _is_redundant(unit: list, index: int, before: dict, live_after: frozenset) -> bool:
+    # e.g. loading a constant that's already there, or repeating an alu operation on the same inputs
+    if 'pins' in effects[unit[index][0]]['reads']:
+        return False # the pins can change every cycle
+    after = _values_after(unit[index][0], before, [0])
+    return len(after) > 0 and all(before[location] == value for location, value in after.items())
+
+def _is_dead_store(unit: list, index: int, before: dict, live_after: frozenset) -> bool:
+    # e.g. mov x0 r when x0 is loaded again before anything reads it
+    return len(effects[unit[index][0]]['writes'] & live_after) == 0
+
+# the safe rewrites, tried in order on each instruction - each one gets (unit, index, values before the instruction,
+# locations that might be read after it) and says whether the instruction can be deleted
+# the last item says whether the rule applies to instructions that access dm or o_reg and to jumps - most don't, since
+# those do something visible however the registers end up
+# jumps to relocatable blocks are never deleted, so the assembler still checks the block they jump to exists
+rules = [
+    ('nop', _is_nop, False),
+    ('unreachable', _is_unreachable, True),
+    ('redundant', _is_redundant, False),
+    ('dead-store', _is_dead_store, False)
+]
+
+def _analyse(unit: list) -> tuple:
+    """
+    Runs the forward (value numbering) and backward (liveness) passes over a unit.
+    Everything is assumed to be unknown at the start of the unit and read after its end, and a jump might go anywhere,
+    so everything is read before a jump too.
+    :param unit: A list of (opcode, fixup) tuples.
+    :return: A tuple of (values before each instruction, locations live after each instruction).
+    """
+    fresh = [0]
+    values = {location: ('entry', location) for location in LOCATIONS}
+    before = []
+    for opcode, _ in unit:
+        before.append(values)
+        values = {**values, **_values_after(opcode, values, fresh)}
+
+    live = LOCATIONS
+    live_after = [None] * len(unit)
+    for index in range(len(unit) - 1, -1, -1):
+        live_after[index] = live
+        effect = effects[unit[index][0]]
+        if effect['kind'] in ('jmp', 'jnz'):
+            live = LOCATIONS
+        else:
+            live = (live - effect['writes']) | effect['reads']
+
+    return before, live_after
+
+def optimize_unit(unit: list, counts: dict, origins: list = None) -> list:
+    """
+    Deletes every instruction the rules allow from one unit of straight-line code - a block placed with .block or a
+    relocatable block - one at a time until there's nothing left to delete, since each deletion can make another one
+    possible. Only the start of a unit can be jumped to, so no rule ever has to worry about jump targets.
+    :param unit: A list of (opcode, fixup) tuples, where fixup is None or the fixup for a jump to a relocatable block.
+    :param counts: How many instructions each rule deleted, by rule name, added to as instructions are deleted.
+    :param origins: Optionally, a list the same length as the unit, e.g. where each instruction came from. Items are
+                    deleted from it along with their instructions.
+    :return: The optimized unit.
+    """
+    unit = list(unit)
+    changed = True
+    while changed:
+        changed = False
+        before, live_after = _analyse(unit)
+        for index, (opcode, fixup) in enumerate(unit):
+            if fixup is not None:
+                continue
+            for name, rule, applies_to_fixed in rules:
+                if (applies_to_fixed or not effects[opcode]['fixed']) and rule(unit, index, before[index], live_after[index]):
+                    del unit[index]
+                    if origins is not None:
+                        del origins[index]
+                    counts[name] = counts.get(name, 0) + 1
+                    changed = True
+                    break
+            if changed:
+                break # the analysis is out of date now
+    return unit
+
+def optimize(state: dict, blocks: bytearray) -> dict:
+    """
+    Optimizes a whole program after every line has been assembled but before relocatable blocks are placed, so
+    relocatable blocks that shrink can free up blocks for others. Moves the jump fixups and the line map along with
+    their instructions.
+    :param state: The assembler state object, after every line has been assembled.
+    :param blocks: The program being assembled, NUM_BLOCKS * BLOCK_SIZE bytes long.
+    :return: How many instructions each rule deleted, by rule name. The sum is the number of bytes saved.
+    """
+    nop = asm341.instruction_base_values['nop']
+    counts = {}
+
+    fixups = {fixup[0]: fixup[1:] for fixup in state['fixups']}
+    lines = {location: (line, file) for location, line, file in state['line_map']}
+    state['fixups'] = []
+    state['line_map'] = []
+    for block in sorted(state['used_blocks']):
+        start = block * asm341.BLOCK_SIZE
+        length = asm341.BLOCK_SIZE
+        while length > 0 and blocks[start + length - 1] == nop:
+            length -= 1 # unused space is filled with nops anyway, so trailing ones aren't counted as saved
+        origins = [lines.get(address) for address in range(start, start + length)]
+        unit = optimize_unit([(blocks[address], fixups.get(address)) for address in range(start, start + length)], counts, origins)
+
+        blocks[start:start + asm341.BLOCK_SIZE] = bytes(opcode for opcode, _ in unit) + bytes([nop] * (asm341.BLOCK_SIZE - len(unit)))
+        state['fixups'] += [(start + offset,) + fixup for offset, (_, fixup) in enumerate(unit) if fixup is not None]
+        state['line_map'] += [(start + offset,) + origin for offset, origin in enumerate(origins) if origin is not None]
+
+    for name, section in state['sections'].items():
+        fixups = {fixup[0]: fixup[1:] for fixup in section['fixups']}
+        origins = [lines.get((name, offset)) for offset in range(len(section['code']))]
+        unit = optimize_unit([(opcode, fixups.get(offset)) for offset, opcode in enumerate(section['code'])], counts, origins)
+
+        section['code'] = bytearray(opcode for opcode, _ in unit)
+        section['fixups'] = [(offset,) + fixup for offset, (_, fixup) in enumerate(unit) if fixup is not None]
+        state['line_map'] += [((name, offset),) + origin for offset, origin in enumerate(origins) if origin is not None]
+
+    return counts
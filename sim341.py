@@ -0,0 +1,651 @@
+
+# ----------------------------------------------------------------------------------------
+# sim341.py - a simulator for the 4-bit microcontroller developed in CME341 at the U of S
+# Runs the 256 byte programs made by asm341.py without needing the FPGA
+# ----------------------------------------------------------------------------------------
+
+import argparse
+import time
+
+import asm341
+
+try:
+    import numpy as np # only needed for BatchSimulator
+except ImportError:
+    np = None
+
+# the machine state is kept in a flat list so the instruction handlers can get at it quickly
+# indices 0 to 6 line up with asm341.register_values, so the handlers can use register numbers straight from the opcode
+X0, X1, Y0, Y1, O_REG, M, I = range(7)
+R = 7       # alu result - shares register number 4 with o_reg, but is only ever read
+ZERO = 8    # 1 if the last alu operation had a result of zero, which is what jnz checks
+I_PINS = 9  # the value on the input pins, read by mov <register> i_pins
+STATE_SIZE = 10
+
+register_names = ['x0', 'x1', 'y0', 'y1', 'o_reg', 'm', 'i', 'r']
+
+# how each alu operation is calculated, as python expressions of x and y
+# opcodes with the y bit set and an operation of 0 or 7 (neg and not don't use y) are nops, like 0b11001000
+alu_expressions = {
+    0: '-x & 15',         # neg
+    1: '(x - y) & 15',    # sub
+    2: '(x + y) & 15',    # add
+    3: '(x * y) >> 4',    # muh
+    4: '(x * y) & 15',    # mul
+    5: 'x ^ y',           # xor
+    6: 'x & y',           # and
+    7: '~x & 15'          # not
+}
+
+def _handler_source(opcode: int) -> list:
+    """
+    Writes the body of the function that executes one opcode.
+    Every handler takes (s, dm, pc) - the machine state list, the data memory and the program counter -
+    and returns the next program counter.
+    :param opcode: The byte of machine code to write a handler for.
+    :return: The lines of the handler's body.
+    """
+    next_pc = 'return (pc + 1) & 255'
+    read_dm = [f'v = dm[s[{I}]]', f's[{I}] = (s[{I}] + s[{M}]) & 15']  # any access to dm moves i forward by m
+
+    if opcode < 0b10000000: # ld
+        dest, value = (opcode >> 4) & 7, opcode & 15
+        if dest == 7:
+            return [f'dm[s[{I}]] = {value}', f's[{I}] = (s[{I}] + s[{M}]) & 15', next_pc]
+        return [f's[{dest}] = {value}', next_pc]
+
+    if opcode < 0b11000000: # mov
+        dest, src = (opcode >> 3) & 7, opcode & 7
+        if src == dest:
+            body = [f'v = s[{I_PINS}]'] # moving a register to itself reads the input pins instead
+        elif src == 7:
+            body = list(read_dm)
+        elif src == 4:
+            body = [f'v = s[{R}]']
+        else:
+            body = [f'v = s[{src}]']
+
+        if dest == 7:
+            body += [f'dm[s[{I}]] = v', f's[{I}] = (s[{I}] + s[{M}]) & 15']
+        else:
+            body += [f's[{dest}] = v'] # when dest is i this comes after the auto-increment, so the written value wins
+        return body + [next_pc]
+
+    if opcode < 0b11100000: # alu
+        x, y, operation = X0 + ((opcode >> 4) & 1), Y0 + ((opcode >> 3) & 1), opcode & 7
+        if (opcode >> 3) & 1 and operation in (0, 7):
+            return [next_pc] # nop
+        return [f'x = s[{x}]', f'y = s[{y}]', f'v = {alu_expressions[operation]}',
+                f's[{R}] = v', f's[{ZERO}] = v == 0', next_pc]
+
+    target = (opcode & 15) << 4
+    if opcode < 0b11110000: # jmp
+        return [f'return {target}']
+
+    # jnz
+    return [f'if s[{ZERO}]:', f'    {next_pc}', f'return {target}']
+
+def _build_dispatch_table() -> tuple:
+    """
+    Builds one small function for each of the 256 possible opcodes, so that the simulator never has to decode an
+    instruction while it's running, only look it up.
+    :return: A tuple of 256 functions, indexed by opcode.
+    """
+    source = []
+    for opcode in range(256):
+        source.append(f'def op_{opcode:02x}(s, dm, pc):')
+        source += ['    ' + line for line in _handler_source(opcode)]
+    namespace = {}
+    exec('\n'.join(source), namespace)
+    return tuple(namespace[f'op_{opcode:02x}'] for opcode in range(256))
+
+dispatch_table = _build_dispatch_table()
+
+def _is_back_edge(address: int, opcode: int) -> bool:
+    """
+    :return: True if the instruction is a jnz that jumps back to the start of its own block or an earlier one,
+             which is how loops are written.
+    """
+    return opcode >= 0b11110000 and (opcode & 15) << 4 <= address
+
+class Profile:
+    """
+    Where a program spends its cycles, filled in by Simulator.run_profiled(): how many times each address ran, and for
+    every loop (a jnz that jumps backwards) how many iterations it ran for each time round. Optionally also the last
+    few instructions run, in a ring buffer of 3 bytes per cycle - pc, opcode, and o_reg after the instruction - so
+    long runs can be recorded without running out of memory.
+    """
+
+    def __init__(self, trace_size: int = 0):
+        """
+        :param trace_size: How many of the most recent cycles to keep in the trace, or 0 to not keep a trace.
+        """
+        self.counts = [0] * 256  # how many times each address ran
+        self.loops = {}  # for each back-edge jnz address, how many times the loop ran each number of iterations
+        self._streaks = {}  # for each back-edge jnz address, a one item list of how many times it's jumped back in a row
+        self.trace = bytearray(trace_size * 3) if trace_size > 0 else None
+        self.trace_size = trace_size
+        self.recorded = 0  # how many cycles have gone through the trace, including ones it's since overwritten
+
+    @property
+    def cycles(self) -> int:
+        return sum(self.counts)
+
+    def block_counts(self) -> list:
+        """
+        :return: How many instructions ran in each block, for the blocks asm341 is set up for.
+        """
+        size = asm341.BLOCK_SIZE
+        return [sum(self.counts[block * size:(block + 1) * size]) for block in range(asm341.NUM_BLOCKS)]
+
+    def trace_entries(self) -> list:
+        """
+        :return: The cycles in the trace, oldest first, as (pc, opcode, o_reg) tuples.
+        """
+        if self.trace is None:
+            return []
+        count = min(self.recorded, self.trace_size)
+        start = (self.recorded - count) % self.trace_size
+        ordered = self.trace[start * 3:] + self.trace[:start * 3]
+        return [tuple(ordered[n * 3:n * 3 + 3]) for n in range(count)]
+
+    def annotate(self, lines: list, line_map: dict, file: str = None) -> list:
+        """
+        Puts the counts next to the source they came from, using the line map the assembler makes.
+        Lines that are assembled more than once (e.g. from an included file) get the counts of every address they're at.
+        :param lines: The lines of the source file.
+        :param line_map: The (line, file) each address was assembled from, like asm341.AssemblyResult.line_map.
+        :param file: Which file the lines are from, as it's named in the line map - None for the file that was assembled.
+        :return: The lines of the source, each with how many times it ran and what fraction of the cycles that is. Loops
+                 are followed by how many iterations they ran for.
+        """
+        counts = {}
+        loops = {}
+        for address, (line, line_file) in line_map.items():
+            if line_file == file:
+                counts[line] = counts.get(line, 0) + self.counts[address]
+                if address in self.loops:
+                    loops.setdefault(line, {})
+                    for iterations, times in self.loops[address].items():
+                        loops[line][iterations] = loops[line].get(iterations, 0) + times
+
+        total = max(1, self.cycles)
+        annotated = []
+        for number, text in enumerate(lines, 1):
+            text = text.rstrip('\n')
+            if number in counts:
+                annotated.append(f'{counts[number]:>10} {counts[number] / total:6.1%} {number:5} | {text}')
+            else:
+                annotated.append(f'{"":>10} {"":>6} {number:5} | {text}')
+            if number in loops:
+                histogram = ', '.join(f'{iterations} iterations x{times}' for iterations, times in sorted(loops[number].items()))
+                finished = sum(loops[number].values())
+                annotated.append(f'{"":>10} {"":>6} {"":>5} |     ; loop finished {finished} time{"s" if finished != 1 else ""}: {histogram}')
+        return annotated
+
+class Simulator:
+    """
+    Simulates the CME341 microcontroller running a 256 byte program, one instruction per clock cycle.
+    All registers, the zero flag and data memory start at zero.
+    """
+
+    def __init__(self, image: bytes, i_pins: int = 0, line_map: dict = None):
+        """
+        :param image: The program, 256 bytes long, like asm341.AssemblyResult.image.
+        :param i_pins: The value on the input pins.
+        :param line_map: Where each address was assembled from, like asm341.AssemblyResult.line_map, for Profile.annotate().
+        """
+        if len(image) != 256:
+            raise ValueError(f'Program must be 256 bytes long, got {len(image)}')
+        self.image = bytes(image)
+        self._code = [dispatch_table[opcode] for opcode in self.image] # handler for each address
+        self.line_map = line_map if line_map is not None else {}
+        self.reset()
+        self.i_pins = i_pins
+
+    @classmethod
+    def from_source(cls, source, i_pins: int = 0):
+        """
+        Assembles a program and makes a simulator for it.
+        :param source: The program, in any form asm341.assemble() accepts.
+        :param i_pins: The value on the input pins.
+        :raises ValueError: If the program has errors.
+        """
+        result = asm341.assemble(source)
+        if not result.ok:
+            raise ValueError('Program has errors:\n' + '\n'.join(str(e) for e in result.errors))
+        return cls(result.image, i_pins, result.line_map)
+
+    def reset(self) -> None:
+        """
+        Puts the microcontroller back in its reset state: everything zero, running from address 0.
+        The input pins are left alone.
+        """
+        i_pins = self._state[I_PINS] if hasattr(self, '_state') else 0
+        self._state = [0] * STATE_SIZE
+        self._state[I_PINS] = i_pins
+        self.dm = [0] * 16
+        self.pc = 0
+        self.cycles = 0
+
+    def step(self) -> None:
+        """
+        Runs one instruction.
+        """
+        self.pc = self._code[self.pc](self._state, self.dm, self.pc)
+        self.cycles += 1
+
+    def run(self, cycles: int) -> None:
+        """
+        Runs the given number of instructions. The microcontroller has no halt instruction, so this is how long to let it go.
+        :param cycles: How many clock cycles to run for.
+        """
+        code = self._code
+        s = self._state
+        dm = self.dm
+        pc = self.pc
+        for _ in range(cycles):
+            pc = code[pc](s, dm, pc)
+        self.pc = pc
+        self.cycles += cycles
+
+    def run_traced(self, cycles: int) -> list:
+        """
+        Runs the given number of instructions, recording every time the output register changes.
+        Slower than run(), since it has to check o_reg every cycle.
+        :param cycles: How many clock cycles to run for.
+        :return: A list of (cycle, value) pairs, one for each time o_reg changed.
+        """
+        code = self._code
+        s = self._state
+        dm = self.dm
+        pc = self.pc
+        trace = []
+        last = s[O_REG]
+        for cycle in range(self.cycles + 1, self.cycles + cycles + 1):
+            pc = code[pc](s, dm, pc)
+            if s[O_REG] != last:
+                last = s[O_REG]
+                trace.append((cycle, last))
+        self.pc = pc
+        self.cycles += cycles
+        return trace
+
+    def run_profiled(self, cycles: int, profile: Profile = None) -> Profile:
+        """
+        Runs the given number of instructions, counting how many times each address runs and how many iterations each
+        loop goes round for. Only the jnz instructions that close loops are wrapped to count iterations, so the rest of
+        the program runs at about two thirds of the speed of run(), or a third with a trace.
+        A loop that's still going when the run ends is counted when it finishes, if the same profile is passed to the
+        next call.
+        :param cycles: How many clock cycles to run for.
+        :param profile: The profile to add to, or None to start a new one without a trace.
+        :return: The profile.
+        """
+        if profile is None:
+            profile = Profile()
+
+        code = list(self._code)
+        for address, opcode in enumerate(self.image):
+            if _is_back_edge(address, opcode):
+                streak = profile._streaks.setdefault(address, [0])
+                code[address] = self._count_loop(code[address], streak, profile.loops.setdefault(address, {}))
+
+        s = self._state
+        dm = self.dm
+        pc = self.pc
+        counts = profile.counts
+        trace = profile.trace
+        if trace is None:
+            for _ in range(cycles):
+                counts[pc] += 1
+                pc = code[pc](s, dm, pc)
+        else:
+            image = self.image
+            size = profile.trace_size
+            offset = profile.recorded % size * 3
+            end = size * 3
+            for _ in range(cycles):
+                counts[pc] += 1
+                trace[offset] = pc
+                trace[offset + 1] = image[pc]
+                pc = code[pc](s, dm, pc)
+                trace[offset + 2] = s[O_REG]
+                offset += 3
+                if offset == end:
+                    offset = 0
+            profile.recorded += cycles
+        self.pc = pc
+        self.cycles += cycles
+        return profile
+
+    @staticmethod
+    def _count_loop(handler, streak: list, histogram: dict):
+        """
+        Wraps the handler for a jnz that closes a loop, so every time the loop ends (the jnz doesn't jump), the number
+        of iterations it ran is added to the histogram.
+        """
+        def counted(s, dm, pc):
+            if s[ZERO]: # jnz doesn't jump, so the loop is done
+                iterations = streak[0] + 1
+                histogram[iterations] = histogram.get(iterations, 0) + 1
+                streak[0] = 0
+            else:
+                streak[0] += 1
+            return handler(s, dm, pc)
+        return counted
+
+    @property
+    def i_pins(self) -> int:
+        return self._state[I_PINS]
+
+    @i_pins.setter
+    def i_pins(self, value: int) -> None:
+        self._state[I_PINS] = value & 15
+
+    @property
+    def zero(self) -> bool:
+        """True if the last alu operation had a result of zero."""
+        return bool(self._state[ZERO])
+
+    @property
+    def registers(self) -> dict:
+        """The value of every register, by name."""
+        registers = {name: self._state[index] for index, name in enumerate(register_names)}
+        registers['dm'] = self.dm[self._state[I]]
+        return registers
+
+    def __getattr__(self, name):
+        # lets registers be read as attributes, e.g. sim.x0 or sim.o_reg
+        if name in register_names:
+            return self._state[register_names.index(name)]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in register_names:
+            self._state[register_names.index(name)] = value & 15
+        else:
+            super().__setattr__(name, value)
+
+# layout of the per-lane state in BatchSimulator - rows 0 to 6 are the registers by number, like in Simulator
+_B_DM = 7       # the value in data memory at address i, filled in before each instruction so it can be read like a register
+_B_R = 8
+_B_PINS = 9
+_B_HEIGHT = 10
+
+def _select(mask, a, b):
+    """
+    Picks a where mask is 255 and b where mask is 0. Much faster than np.where for uint8 arrays.
+    """
+    return b ^ ((a ^ b) & mask)
+
+def _mask(condition):
+    """
+    Turns a bool array into a uint8 mask for _select() - 255 where True, 0 where False.
+    """
+    return -condition.view(np.uint8)
+
+def _mux(bit_masks: list, values: list):
+    """
+    Picks one of 2**len(bit_masks) values for every lane, like a hardware mux - a lot faster than indexing per lane.
+    :param bit_masks: Masks from _mask() for each bit of the selector, least significant bit first.
+    :param values: The arrays to pick from, indexed by the selector.
+    """
+    for bit_mask in bit_masks:
+        values = [_select(bit_mask, values[n + 1], values[n]) for n in range(0, len(values), 2)]
+    return values[0]
+
+class BatchSimulator:
+    """
+    Simulates many copies of the microcontroller at once using NumPy, for running one program against every
+    input, or many programs at once. Each copy (lane) has its own registers, data memory and program counter, and
+    every lane runs one instruction per step. Each register is one uint8 array with a value for every lane, and every
+    lane does the same array operations each step with the results masked by what its opcode actually does, so a
+    step costs the same no matter which instructions the lanes are on.
+    It only pays off with many thousands of lanes - at 100,000 lanes it's about 7 times faster than Simulator when
+    they share a program and 3 times when they each have their own, and at 1,000 or fewer Simulator is as fast or faster.
+    """
+
+    def __init__(self, images, i_pins=0):
+        """
+        :param images: Either one 256 byte program, which every lane runs, or a list of programs, one per lane.
+        :param i_pins: The value on the input pins, either one value for every lane or a list with one per lane.
+                       If images is just one program, the number of lanes is the length of this list.
+        """
+        if np is None:
+            raise ImportError('BatchSimulator needs NumPy, install it with "pip install numpy"')
+
+        if isinstance(images, (bytes, bytearray)):
+            images = np.frombuffer(images, dtype=np.uint8)
+        else:
+            images = np.array([np.frombuffer(bytes(image), dtype=np.uint8) for image in images])
+        if images.shape[-1] != 256:
+            raise ValueError(f'Programs must be 256 bytes long, got {images.shape[-1]}')
+
+        i_pins = np.asarray(i_pins, dtype=np.uint8) & 15
+        self.lanes = i_pins.size if images.ndim == 1 else images.shape[0]
+        self._image = images.ravel()
+        self._shared_image = images.ndim == 1 # if every lane runs the same program there's no need to look it up per lane
+        self._i_pins = np.broadcast_to(i_pins, (self.lanes,)).copy()
+        self._lane = np.arange(self.lanes)
+
+        self.reset()
+
+    @classmethod
+    def for_all_inputs(cls, image):
+        """
+        Makes a simulator with 16 lanes that all run the same program, each with a different value on the input pins.
+        :param image: The 256 byte program.
+        """
+        return cls(image, np.arange(16))
+
+    def reset(self) -> None:
+        """
+        Puts every lane back in its reset state: everything zero, running from address 0.
+        """
+        # one row per register and one column per lane, so a register picked by the opcode is at row * lanes + lane
+        self._state = np.zeros((_B_HEIGHT, self.lanes), dtype=np.uint8)
+        self._state[_B_PINS] = self._i_pins
+        self._dm = np.zeros((17, self.lanes), dtype=np.uint8) # the last row is where lanes not writing to dm write
+        self._zero = np.zeros(self.lanes, dtype=np.uint8)
+        self.pc = np.zeros(self.lanes, dtype=np.uint8) # uint8 wraps from 255 back to 0 on its own, like the real pc
+        self.cycles = 0
+
+    def step(self) -> None:
+        """
+        Runs one instruction in every lane.
+        """
+        lanes = self.lanes
+        state = self._state
+
+        if self._shared_image:
+            op = self._image.take(self.pc)
+        else:
+            op = self._image.take(self._lane * 256 + self.pc)
+
+        # decode - every field is worked out for every lane, whether or not the lane's instruction uses it
+        is_ld = op < 0b10000000
+        is_mov = (op >> 6) == 0b10
+        is_alu = (op >> 5) == 0b110
+        bits = [_mask(((op >> bit) & 1).view(bool)) for bit in range(5)]
+        dest = (op >> (3 + is_ld.view(np.uint8))) & 7 # ld has the destination one bit higher than mov
+        low = op & 7 # the source register for mov, the operation for alu instructions
+        reads_pins = low == dest
+        writes_dm = (is_ld | is_mov) & (dest == 7)
+        reads_dm = is_mov & (low == 7) & ~reads_pins
+        writes_reg = _mask((is_ld | is_mov) & (dest != 7))
+
+        # ld and mov
+        # data memory is only touched when some lane is actually using it, since picking an address per lane is slow
+        i = state[I]
+        accesses_dm = writes_dm | reads_dm
+        if accesses_dm.any():
+            state[_B_DM] = self._dm.reshape(-1).take(i.astype(np.intp) * lanes + self._lane)
+
+        sources = [state[X0], state[X1], state[Y0], state[Y1], state[_B_R], state[M], state[I], state[_B_DM]] # 4 reads r, not o_reg
+        value = _mux(bits[:3], sources)
+        value = _select(_mask(reads_pins), state[_B_PINS], value) # moving a register to itself reads the input pins
+        value = _select(_mask(is_ld), op & 15, value)
+
+        if writes_dm.any(): # lanes that aren't writing to dm write to the spare row at the end instead
+            self._dm.reshape(-1)[_select(_mask(writes_dm), i, 16).astype(np.intp) * lanes + self._lane] = value
+        if accesses_dm.any():
+            state[I] = (i + (state[M] & _mask(accesses_dm))) & 15 # any access to dm moves i forward by m
+        for register in range(7): # after the auto-increment, so a value written to i wins
+            state[register] = _select(writes_reg & _mask(dest == register), value, state[register])
+
+        # alu - work out all eight operations and pick one with the bits of the opcode
+        x = _select(bits[4], state[X1], state[X0])
+        y = _select(bits[3], state[Y1], state[Y0])
+        product = x * y
+        result = _mux(bits[:3], [-x, x - y, x + y, product >> 4, product, x ^ y, x & y, ~x]) & 15
+        nop = bits[3] & _mask((low == 0) | (low == 7))
+        alu_mask = _mask(is_alu) & ~nop
+        state[_B_R] = _select(alu_mask, result, state[_B_R])
+        self._zero = _select(alu_mask, (result == 0).view(np.uint8), self._zero)
+
+        # jumps
+        jump = ((op >> 4) == 0b1110) | (((op >> 4) == 0b1111) & (self._zero == 0))
+        self.pc = _select(_mask(jump), (op & 15) << 4, self.pc + 1)
+        self.cycles += 1
+
+    def run(self, cycles: int, trace: bool = False):
+        """
+        Runs the given number of instructions in every lane.
+        :param cycles: How many clock cycles to run for.
+        :param trace: If True, record o_reg in every lane after every cycle.
+        :return: If trace is True, an array of shape (cycles, lanes) holding o_reg after each cycle, otherwise None.
+        """
+        history = np.empty((cycles, self.lanes), dtype=np.uint8) if trace else None
+        for cycle in range(cycles):
+            self.step()
+            if trace:
+                history[cycle] = self._state[O_REG]
+        return history
+
+    @property
+    def o_reg(self):
+        """The output register of every lane."""
+        return self._state[O_REG].copy()
+
+    @property
+    def zero(self):
+        """For every lane, True if the last alu operation had a result of zero."""
+        return self._zero.astype(bool)
+
+    @property
+    def dm(self):
+        """The data memory of every lane, as an array of shape (lanes, 16)."""
+        return self._dm[:16].T.copy()
+
+    def lane_registers(self, lane: int) -> dict:
+        """
+        The value of every register in one lane, by name, in the same form as Simulator.registers.
+        :param lane: Which lane to look at.
+        """
+        registers = {name: int(self._state[index, lane]) for index, name in enumerate(register_names[:7])}
+        registers['r'] = int(self._state[_B_R, lane])
+        registers['dm'] = int(self._dm[self._state[I, lane], lane])
+        return registers
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a program for the CME341 microcontroller.')
+    parser.add_argument('infile', help='the .341asm program to run')
+    parser.add_argument('-c', '--cycles', type=int, default=1000, help='how many clock cycles to run for (default %(default)s)')
+    parser.add_argument('-i', '--i-pins', type=lambda v: int(v, 16), default=0, help='the value on the input pins, in hex')
+    parser.add_argument('-t', '--trace', action='store_true', help='print every change of o_reg')
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help='count how many times each instruction runs, and print the busiest blocks and how many iterations each loop ran for')
+    parser.add_argument('--annotate', action='store_true', help='like --profile, but print the source with the counts next to each line')
+    parser.add_argument('--record', type=int, default=0, metavar='N',
+                        help='keep the last N cycles (pc, opcode and o_reg) and print them at the end')
+    parser.add_argument('--record-file', metavar='FILE',
+                        help='write the recorded cycles to this file instead, 3 bytes each (pc, opcode, o_reg), oldest first')
+    parser.add_argument('-a', '--all-inputs', action='store_true',
+                        help='run the program once for every value of the input pins at the same time (needs NumPy), '
+                             'and print o_reg at the end of each run')
+    args = parser.parse_args()
+
+    if args.record_file is not None and args.record <= 0:
+        parser.error('--record-file needs --record')
+    if args.trace and (args.profile or args.annotate or args.record > 0):
+        parser.error('--trace can\'t be used with --profile, --annotate or --record')
+
+    try:
+        with open(args.infile, 'r') as f:
+            lines = f.readlines()
+        sim = Simulator.from_source(lines, args.i_pins)
+    except IOError:
+        print(f"Could not open {args.infile}. Please ensure it exists and that you have the necessary permissions to read it.")
+        return 1
+    except ValueError as e:
+        print(e)
+        return 1
+
+    if args.all_inputs:
+        try:
+            batch = BatchSimulator.for_all_inputs(sim.image)
+        except ImportError as e:
+            print(e)
+            return 1
+        start = time.perf_counter()
+        batch.run(args.cycles)
+        seconds = time.perf_counter() - start
+        for i_pins, o_reg in enumerate(batch.o_reg):
+            print(f'i_pins={i_pins:x} o_reg={o_reg:x}')
+        print(f'{batch.cycles} cycles of {batch.lanes} programs in {seconds:.3f} s')
+        return 0
+
+    profile = None
+    start = time.perf_counter()
+    if args.profile or args.annotate or args.record > 0:
+        profile = sim.run_profiled(args.cycles, Profile(args.record))
+    elif args.trace:
+        for cycle, value in sim.run_traced(args.cycles):
+            print(f'cycle {cycle:8}: o_reg = {value:x}')
+    else:
+        sim.run(args.cycles)
+    seconds = time.perf_counter() - start
+
+    print(' '.join(f'{name}={value:x}' for name, value in sim.registers.items()) + f' pc={sim.pc:02x} zero={int(sim.zero)}')
+    print('data memory: ' + ' '.join(f'{value:x}' for value in sim.dm))
+    print(f'{sim.cycles} cycles in {seconds:.3f} s ({sim.cycles / seconds / 1e6:.1f} million instructions per second)')
+
+    if profile is not None and (args.profile or args.annotate):
+        print('\nbusiest blocks:')
+        blocks = profile.block_counts()
+        for block in sorted(range(len(blocks)), key=lambda block: -blocks[block]):
+            if blocks[block] == 0:
+                break
+            lines_run = sorted({sim.line_map[address][0] for address in range(block * asm341.BLOCK_SIZE, (block + 1) * asm341.BLOCK_SIZE)
+                                if profile.counts[address] > 0 and address in sim.line_map and sim.line_map[address][1] is None})
+            where = f' (lines {lines_run[0]}-{lines_run[-1]})' if len(lines_run) > 0 else ''
+            print(f'    block {block:x}: {blocks[block]:10} cycles {blocks[block] / sim.cycles:6.1%}{where}')
+        for address, histogram in sorted(profile.loops.items()):
+            if len(histogram) > 0:
+                line = sim.line_map.get(address, (None, None))[0]
+                print(f'loop closed at {address:02x}' + (f' (line {line})' if line is not None else '') + ': ' +
+                      ', '.join(f'{iterations} iterations x{times}' for iterations, times in sorted(histogram.items())))
+    if args.annotate:
+        print()
+        print('\n'.join(profile.annotate(lines, sim.line_map)))
+
+    if profile is not None and profile.trace is not None:
+        entries = profile.trace_entries()
+        if args.record_file is not None:
+            try:
+                with open(args.record_file, 'wb') as f:
+                    f.write(bytes(value for entry in entries for value in entry))
+            except IOError:
+                print(f"Could not open {args.record_file} for writing. Make sure you have write permissions.")
+                return 1
+        else:
+            first = sim.cycles - len(entries) + 1
+            print()
+            for cycle, (pc, opcode, o_reg) in enumerate(entries, first):
+                print(f'cycle {cycle:8}: pc={pc:02x} opcode={opcode:02x} o_reg={o_reg:x}')
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
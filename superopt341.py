@@ -0,0 +1,401 @@
+
+# ----------------------------------------------------------------------------------------
+# superopt341.py - a superoptimizer for the 4-bit microcontroller developed in CME341 at the U of S
+# Searches every sequence of instructions for the shortest one that computes a given function
+# ----------------------------------------------------------------------------------------
+
+import argparse
+import concurrent.futures
+import os
+import time
+from dataclasses import dataclass, field
+
+import asm341
+import opt341
+import sim341
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# each candidate is run on every combination of input values at once - the machine state is a 2D uint8 array with one
+# row per location, laid out like sim341's state list, and one column (lane) per combination of inputs
+row_names = ['x0', 'x1', 'y0', 'y1', 'o_reg', 'm', 'i', 'r', 'zero', 'i_pins']
+rows = {name: row for row, name in enumerate(row_names)}
+MAX_INPUTS = 4 # 16**4 lanes - any more and every candidate takes too long to check
+
+_alu_functions = {operation: eval(f'lambda x, y: {expression}') for operation, expression in sim341.alu_expressions.items()}
+
+@dataclass
+class Spec:
+    """
+    What the code being searched for has to do. Data memory and jumps are left out of the search, so the code is
+    always straight-line and only uses registers.
+    """
+    inputs: list   # the locations the code may read, e.g. ['x0', 'y0'] - every combination of their values is tried
+    outputs: dict  # the location each result goes in -> the value it must have in each lane, as a uint8 array
+    scratch: list = field(default_factory=lambda: ['x0', 'x1', 'y0', 'y1'])  # registers the code may overwrite
+                                                                             # besides the outputs, r and zero are always allowed
+
+    def initial_state(self):
+        """
+        Makes the state every candidate starts from. Lane n has input j set to bits 4j to 4j+3 of n.
+        :return: The state array. Locations that aren't inputs are zero, but candidates are never allowed to read them.
+        """
+        lanes = np.arange(16 ** len(self.inputs))
+        state = np.zeros((len(row_names), lanes.size), dtype=np.uint8)
+        for j, name in enumerate(self.inputs):
+            state[rows[name]] = (lanes >> (4 * j)) & 15
+        return state
+
+def _compile_ops(spec: Spec) -> list:
+    """
+    Makes the list of instructions the search tries - every instruction that doesn't jump, touch dm or overwrite a
+    register it isn't allowed to.
+    :param spec: What the code has to do.
+    :return: A list of dicts, each with the opcode, what it does (kind, dest, source or operation), the rows it reads,
+             and a bit mask of the rows it writes.
+    """
+    writable = {rows[name] for name in list(spec.outputs) + spec.scratch} | {rows['r'], rows['zero']}
+    ops = []
+    for opcode, effect in enumerate(opt341.effects):
+        kind = effect['kind']
+        if kind not in ('ld', 'mov', 'alu') or 'dm' in effect['reads'] or 'dm' in effect['writes']:
+            continue
+
+        if kind == 'ld':
+            op = {'dest': (opcode >> 4) & 7, 'value': opcode & 15, 'reads': ()}
+        elif kind == 'mov':
+            dest, source = (opcode >> 3) & 7, opcode & 7
+            if source == dest:
+                source = rows['i_pins'] # moving a register to itself reads the input pins instead
+            elif source == 4:
+                source = rows['r']
+            op = {'dest': dest, 'source': source, 'reads': (source,)}
+        else:
+            x, y, operation = rows['x0'] + ((opcode >> 4) & 1), rows['y0'] + ((opcode >> 3) & 1), opcode & 7
+            op = {'dest': rows['r'], 'x': x, 'y': y, 'operation': operation, 'reads': (x,) if operation in (0, 7) else (x, y)}
+
+        if op['dest'] not in writable:
+            continue
+        op.update(opcode=opcode, kind=kind, writes=1 << op['dest'] | (1 << rows['zero'] if kind == 'alu' else 0))
+        ops.append(op)
+    return ops
+
+def _apply(state, op: dict):
+    """
+    Runs one instruction in every lane.
+    :param state: The state array before the instruction. Not changed.
+    :param op: The instruction, from _compile_ops().
+    :return: The state array after the instruction.
+    """
+    new = state.copy()
+    if op['kind'] == 'ld':
+        new[op['dest']] = op['value']
+    elif op['kind'] == 'mov':
+        new[op['dest']] = state[op['source']]
+    else:
+        result = _alu_functions[op['operation']](state[op['x']], state[op['y']])
+        new[rows['r']] = result
+        new[rows['zero']] = result == 0
+    return new
+
+# every instruction the search could ever use, by opcode
+_all_ops = {op['opcode']: op for op in _compile_ops(Spec([], {}, row_names))}
+
+# everything a search needs, set up once per process - in worker processes by _init_worker()
+_context = {}
+
+def _init_worker(spec: Spec) -> None:
+    """
+    Sets up _context for searching for code that meets a spec.
+    :param spec: What the code has to do.
+    """
+    ops = _compile_ops(spec)
+    _context['spec'] = spec
+    _context['ops'] = ops
+    _context['ops_by_dest'] = {row: [op for op in ops if op['dest'] == row] for row in range(len(row_names))}
+    _context['targets'] = [(rows[name], target) for name, target in spec.outputs.items()]
+    _context['state'] = spec.initial_state()
+    _context['defined'] = sum(1 << rows[name] for name in spec.inputs)
+
+def _pointless(op: dict, previous: dict, state, defined: int) -> bool:
+    """
+    Checks if an instruction can't be part of a shortest program when it comes right after another one, without
+    running it. These checks only skip programs that have a shorter or equivalent version which gets searched anyway.
+    :param op: The instruction to check.
+    :param previous: The instruction before it, or None at the start of the program.
+    :param state: The state array before the instruction.
+    :param defined: A bit mask of the rows that hold something meaningful.
+    :return: True if the instruction should be skipped.
+    """
+    dest = op['dest']
+    if not all(defined >> row & 1 for row in op['reads']):
+        return True # reading anything else would give a garbage result
+    if op['kind'] == 'ld' and defined >> dest & 1 and (state[dest] == op['value']).all():
+        return True # writes what's already there
+    if op['kind'] == 'mov' and defined >> dest & 1 and np.array_equal(state[dest], state[op['source']]):
+        return True
+    if previous is not None:
+        if previous['dest'] == dest and dest not in op['reads']:
+            return True # overwrites the previous instruction's result before anything reads it
+        if dest not in previous['reads'] and previous['dest'] not in op['reads'] and op['opcode'] < previous['opcode']:
+            return True # the two don't depend on each other, so only one of their two orders needs trying
+    return False
+
+def _search(state, defined: int, remaining: int, program: list, seen: dict, previous: dict = None):
+    """
+    Depth-first search for code that finishes the job in at most remaining more instructions.
+    Prunes a branch when more outputs are wrong than there are instructions left (each instruction only writes one of
+    them), or when the same state was already reached with at least as many instructions left. With one instruction
+    left, only instructions that write the one wrong output are tried.
+    :param state: The state array so far.
+    :param defined: A bit mask of the rows that hold something meaningful - inputs and anything written since.
+    :param remaining: How many more instructions are allowed.
+    :param program: The opcodes so far.
+    :param seen: Maps a hash of each state reached to the most instructions that were left when it was reached.
+    :param previous: The last instruction in the program so far.
+    :return: The opcodes of the whole program, or None if there isn't one.
+    """
+    wrong = [row for row, target in _context['targets'] if not (defined >> row & 1 and np.array_equal(state[row], target))]
+    if len(wrong) == 0:
+        return program
+    if len(wrong) > remaining:
+        return None
+
+    # zero and i_pins are never read, so they don't matter, but the last instruction does, since it changes what
+    # _pointless() lets come next
+    key = hash((defined, state[:rows['zero']].tobytes(), previous['opcode'] if previous is not None else -1))
+    if seen.get(key, -1) >= remaining:
+        return None
+    seen[key] = remaining
+
+    for op in _context['ops'] if remaining > 1 else _context['ops_by_dest'][wrong[0]]:
+        if not _pointless(op, previous, state, defined):
+            found = _search(_apply(state, op), defined | op['writes'], remaining - 1, program + [op['opcode']], seen, op)
+            if found is not None:
+                return found
+    return None
+
+def _search_from(first: int, length: int):
+    """
+    Searches every program of the given length that starts with one particular instruction. Runs in a worker process.
+    :param first: Index of the first instruction in the worker's op list.
+    :param length: How many instructions the program has, including the first.
+    :return: The opcodes of a program that meets the spec, or None.
+    """
+    op = _context['ops'][first]
+    state, defined = _context['state'], _context['defined']
+    if _pointless(op, None, state, defined):
+        return None
+    return _search(_apply(state, op), defined | op['writes'], length - 1, [op['opcode']], {}, op)
+
+def superoptimize(spec: Spec, max_length: int = 4, jobs: int = 1, progress=None):
+    """
+    Finds the shortest program that meets a spec, trying every length from 0 up. Every candidate is checked against
+    every combination of input values, so whatever is found is correct for all of them, not just a sample.
+    :param spec: What the code has to do.
+    :param max_length: The longest program to look for. Every extra instruction makes the search around a hundred
+                       times slower in the worst case, though pruning keeps it well below that.
+    :param jobs: How many worker processes to split the search over. 1 searches in this process.
+    :param progress: If given, called with each length once it's been searched, e.g. to print progress.
+    :return: The opcodes of the shortest program, or None if there isn't one up to max_length instructions.
+    :raises ImportError: If NumPy isn't installed.
+    """
+    if np is None:
+        raise ImportError('superopt341 needs NumPy, install it with "pip install numpy"')
+
+    _init_worker(spec)
+    found = _search(_context['state'], _context['defined'], 0, [], {})
+    length = 0
+    executor = concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(spec,)) if jobs > 1 else None
+    try:
+        while found is None and length < max_length:
+            length += 1
+            firsts = range(len(_context['ops']))
+            if executor is None:
+                results = (_search_from(first, length) for first in firsts)
+            else:
+                results = executor.map(_search_from, firsts, [length] * len(firsts), chunksize=4)
+            found = next((program for program in results if program is not None), None)
+            if progress is not None:
+                progress(length, found)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return found
+
+def spec_from_expressions(expressions: list, inputs: list = None, scratch: list = None) -> Spec:
+    """
+    Makes a spec from Python expressions, like 'x0 = x0 * 3 + y0'. The result of each one is kept to its low 4 bits.
+    :param expressions: Strings of the form '<register> = <expression>'. Every expression sees the values from before
+                        any of them run.
+    :param inputs: The locations the code may read. Defaults to every register and i_pins the expressions use.
+    :param scratch: Registers the code may overwrite besides the outputs, or None for x0, x1, y0 and y1.
+    :return: The spec.
+    :raises ValueError: If an expression is invalid.
+    """
+    parsed = []
+    for expression in expressions:
+        name, equals, body = expression.partition('=')
+        name = name.strip()
+        if equals == '' or name not in rows or name in ('zero', 'i_pins'):
+            raise ValueError(f'Expected <register> = <expression>, got: {expression}')
+        try:
+            code = compile(body.strip(), '<expression>', 'eval')
+        except SyntaxError as e:
+            raise ValueError(f'Invalid expression: {expression}\n{e}') from None
+        unknown = [n for n in code.co_names if n not in rows]
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown name {unknown[0]} in {expression}, expressions can only use registers and i_pins')
+        parsed.append((name, code))
+
+    if inputs is None:
+        inputs = sorted({n for _, code in parsed for n in code.co_names}, key=row_names.index)
+    if len(inputs) > MAX_INPUTS:
+        raise ValueError(f'Too many inputs ({", ".join(inputs)}), the most is {MAX_INPUTS}')
+
+    spec = Spec(inputs, {}, ['x0', 'x1', 'y0', 'y1'] if scratch is None else scratch)
+    state = spec.initial_state().astype(np.int64) # so expressions don't overflow before they're cut down to 4 bits
+    variables = {name: state[row] for name, row in rows.items()}
+    for name, code in parsed:
+        value = eval(code, {'__builtins__': {}}, variables)
+        spec.outputs[name] = (np.broadcast_to(value, state[0].shape) & 15).astype(np.uint8)
+    return spec
+
+def spec_from_reference(source, inputs: list = None, outputs: list = None, scratch: list = None, filename: str = None) -> tuple:
+    """
+    Makes a spec from an existing snippet of 341 asm - the search then looks for something shorter that does the same.
+    :param source: The snippet, in any form asm341.assemble() accepts. It can use .define and .include, but not jumps or dm.
+    :param inputs: The locations the code may read. Defaults to everything the snippet reads before writing it.
+    :param outputs: The locations the code has to set. Defaults to every register the snippet writes, apart from r.
+    :param scratch: Registers the code may overwrite besides the outputs, or None for x0, x1, y0 and y1.
+    :param filename: The file the snippet came from, so .include can find files next to it.
+    :return: A tuple of (spec, the snippet's opcodes).
+    :raises ValueError: If the snippet has errors, jumps or uses dm.
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    state = asm341.new_state()
+    reference = []
+    errors = []
+    stack = state['include_stack'] # .include pushes the file it names here, and it's read before the rest of this one
+    stack.append({'path':filename, 'label':None, 'lines':iter(source), 'line':0})
+    while len(stack) > 0:
+        current = stack[-1]
+        line = next(current['lines'], None)
+        if line is None:
+            stack.pop()
+            continue
+        current['line'] += 1
+        state['current_line'] = current['line']
+        state['current_file'] = current['label']
+        state['line_text'] = line
+        try:
+            processed = asm341.preprocess(line, state)
+            if len(processed) > 0:
+                opcode = asm341.parse(processed, state)
+                if opcode != -1:
+                    reference.append(opcode)
+        except asm341.AssemblyError as e:
+            where = f' in {current["label"]}' if current['label'] is not None else ''
+            errors.append(f'Error{where} on line {state["current_line"]}: {e.message}')
+    if len(errors) > 0:
+        raise ValueError('\n'.join(errors))
+
+    spec = Spec([], {}, ['x0', 'x1', 'y0', 'y1'] if scratch is None else scratch)
+    read_first, written = [], []
+    for opcode in reference:
+        if opcode not in _all_ops:
+            raise ValueError(f'{asm341.decode_table()[opcode]} can\'t be superoptimized, only code without jumps or dm can')
+        op = _all_ops[opcode]
+        read_first += [row_names[row] for row in op['reads'] if row_names[row] not in written + read_first]
+        written += [row_names[op['dest']]]
+
+    spec.inputs = read_first if inputs is None else inputs
+    if outputs is None:
+        outputs = sorted({name for name in written if name != 'r'}, key=row_names.index)
+    if len(spec.inputs) > MAX_INPUTS:
+        raise ValueError(f'Too many inputs ({", ".join(spec.inputs)}), the most is {MAX_INPUTS}')
+    if len(outputs) == 0:
+        raise ValueError('The snippet doesn\'t write any registers, use --outputs to say which results matter')
+
+    result = spec.initial_state()
+    for opcode in reference:
+        result = _apply(result, _all_ops[opcode])
+    spec.outputs = {name: result[rows[name]] for name in outputs}
+    return spec, reference
+
+def to_asm(program: list, spec: Spec) -> str:
+    """
+    Writes a program found by superoptimize() as 341 asm that can be pasted straight into a .341asm file.
+    :param program: The opcodes.
+    :param spec: The spec it was found for, described in a comment above the code.
+    :return: The asm, as one string.
+    """
+    written = {row_names[_all_ops[opcode]['dest']] for opcode in program}
+    overwritten = sorted(written - set(spec.outputs), key=row_names.index)
+    lines = [f'; {len(program)} instruction{"" if len(program) == 1 else "s"} found by superopt341.py',
+             f'; inputs: {" ".join(spec.inputs) or "none"}, outputs: {" ".join(spec.outputs)}, '
+             f'also overwrites: {" ".join(overwritten) or "nothing"}']
+    lines += ['    ' + asm341.decode_table()[opcode] for opcode in program]
+    return '\n'.join(lines) + '\n'
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the shortest CME341 code that computes a function, by trying every program.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-e', '--expression', action='append',
+                        help="what to compute, like 'x0 = x0 * 3 + y0' (python syntax, kept to 4 bits), can be given more than once")
+    source.add_argument('-r', '--reference', metavar='SNIPPET', help='a .341asm snippet (no jumps or dm) to find shorter code for')
+    registers = row_names[:rows['zero']]
+    parser.add_argument('--inputs', nargs='+', choices=registers + ['i_pins'], metavar='REG', help='the locations the code may read')
+    parser.add_argument('--outputs', nargs='+', choices=registers, metavar='REG', help='with --reference, the registers whose values matter')
+    parser.add_argument('--scratch', nargs='*', choices=registers, metavar='REG',
+                        help='registers the code may overwrite besides the outputs (default x0 x1 y0 y1, r is always allowed)')
+    parser.add_argument('-n', '--max-length', type=int, default=4, help='the longest program to search for (default %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='worker processes to search with')
+    parser.add_argument('-o', '--output', help='write the asm to this file instead of printing it')
+    args = parser.parse_args()
+
+    try:
+        if args.reference is not None:
+            with open(args.reference, 'r') as f:
+                spec, reference = spec_from_reference(f, args.inputs, args.outputs, args.scratch, args.reference)
+            print(f'Reference is {len(reference)} instructions long.')
+            max_length = min(args.max_length, len(reference) - 1)
+        else:
+            spec = spec_from_expressions(args.expression, args.inputs, args.scratch)
+            max_length = args.max_length
+    except IOError:
+        print(f"Could not open {args.reference}. Please ensure it exists and that you have the necessary permissions to read it.")
+        return 1
+    except ValueError as e:
+        print(e)
+        return 1
+
+    start = time.perf_counter()
+    def progress(length, found):
+        print(f"length {length}: {'found' if found else 'nothing'} ({time.perf_counter() - start:.1f} s)")
+
+    program = superoptimize(spec, max_length, max(1, args.jobs), progress)
+    if program is None:
+        print(f'Nothing found up to {max_length} instructions long.')
+        return 1
+
+    asm = to_asm(program, spec)
+    if args.output is not None:
+        try:
+            with open(args.output, 'w') as f:
+                f.write(asm)
+        except IOError:
+            print(f"Could not open {args.output} for writing. Make sure you have write permissions.")
+            return 1
+    else:
+        print(asm, end='')
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())